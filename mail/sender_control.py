@@ -38,26 +38,52 @@
 #    -o smtpd_soft_error_limit=1001
 #    -o smtpd_hard_error_limit=1000
 #
+# Daemon mode: with --listen it runs as an SMTP content filter, one process
+# for all the messages, reusing its LDAP connections. With --mapinterval it
+# keeps the delegations in memory instead of searching LDAP. The authenticated
+# user is taken from the Received: header Postfix adds on top, so
+# smtpd_sasl_authenticated_header must be enabled.
+#sender_control     unix  -       -       n       -       20       smtp
+#    -o smtp_send_xforward_command=yes
+#    -o disable_dns_lookups=yes
+#and content_filter=sender_control:[127.0.0.1]:10026 where it was pipe, with
+#sender_control.py --listen=127.0.0.1:10026 --workers=20 --ldapuri=...
+#(the rest of the options as above but the envelope ones).
+#
 
 import sys
 import os
 import atexit
 import shutil
 import uuid
+import copy
+import time
+import random
+import marshal
+import socket
+import sqlite3
+import threading
 
 import warnings
 warnings.filterwarnings('ignore', category=DeprecationWarning)
 
 from optparse import OptionParser
-from smtplib import SMTP, CRLF
-from tempfile import NamedTemporaryFile
+from collections import OrderedDict
+from cStringIO import StringIO
+from smtplib import SMTP, CRLF, SMTPException, SMTPResponseException, \
+                    SMTPServerDisconnected, SMTPConnectError, \
+                    SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError, \
+                    quoteaddr, quotedata
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
 from subprocess import PIPE, Popen
 from syslog import openlog, syslog, LOG_MAIL
 from email.utils import parseaddr, formataddr
-from twisted.mail.smtp import sendmail
-from twisted.internet import reactor
+from zope.interface import implementer
+from twisted.mail import smtp
+from twisted.internet import reactor, defer, threads, task
 
 import ldap
+from ldap.controls import SimplePagedResultsControl
 import re
 
 FROM = 'from'
@@ -67,23 +93,56 @@ MAIL = 'mail'
 CN = 'cn'
 UID = 'uid'
 KOLABDELEGATE = 'kolabDelegate'
+ENTRYUUID = 'entryUUID'
+MODIFYTIMESTAMP = 'modifyTimestamp'
 SENDAS = 'sendas-'
 CALENDAR_REGEX = 'content-type.*text/calendar'
+#only the line Postfix adds right after "Received: from", HELO is client data
+AUTH_SENDER_REGEX = r'^\t\(Authenticated sender: ([^)\s]+)\)$'
 
 #arguments that are not required
-opts = [ 'user', 'sender' ]
-
-def die(msg = 'Internal error', errcode = 421):
+opts = [ 'user', 'sender', 'listen', 'workers', 'cachettl', 'negativettl',
+        'cachesize', 'cachefile', 'mapinterval', 'mapreload', 'mapfile',
+        'spoolsize' ]
+#arguments not used in daemon mode
+daemon_opts = [ 'recipient' ]
+
+class Reject(Exception):
+    """
+    The message can't be delivered, errcode is like in die().
+    """
+    def __init__(self, msg, errcode = 421):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.errcode = errcode
+
+
+def status(errcode):
+    """
+    Enhanced status code of errcode: 544 -> 5.4.4
+    """
     errcode = str(errcode)
     if len(errcode) != 3:
         errcode = '421'
-    errcode = '%c.%c.%c ' % tuple(errcode)
-    msg = errcode + msg
+    return '%c.%c.%c' % tuple(errcode)
+
+
+def die(msg = 'Internal error', errcode = 421):
+    msg = status(errcode) + ' ' + msg
     syslog(msg)
     print msg
     sys.exit(-1)
 
 
+def ldap_connect(options):
+    try:
+        conn = ldap.initialize(options.ldapuri)
+        conn.bind(options.binddn, options.bindpw)
+    except ldap.LDAPError, e:
+        raise Reject('LDAP Connection error')
+    return conn
+
+
 def parse_opts():
     usage = "usage: %s" % (sys.argv[0])
     parser = OptionParser(usage)
@@ -124,12 +183,55 @@ def parse_opts():
     parser.add_option("--disclaimer", dest = "disclaimer",
                         help = "Envelope sender.")
 
+    parser.add_option("--listen", dest = "listen",
+                        help = "Run as SMTP content filter on [address:]port.")
+
+    parser.add_option("--workers", dest = "workers", type = "int",
+                        default = 20,
+                        help = "Messages processed at once in daemon mode.")
+
+    parser.add_option("--spoolsize", dest = "spoolsize", type = "int",
+                        default = 1024 * 1024,
+                        help = "Bytes of a message kept in memory in daemon " \
+                                "mode, the rest goes to TMPDIR.")
+
+    parser.add_option("--cachettl", dest = "cachettl", type = "int",
+                        default = 300,
+                        help = "Seconds LDAP lookups are cached, 0 disables.")
+
+    parser.add_option("--negativettl", dest = "negativettl", type = "int",
+                        default = 60,
+                        help = "Seconds missing LDAP entries are cached.")
+
+    parser.add_option("--cachesize", dest = "cachesize", type = "int",
+                        default = 10000,
+                        help = "LDAP lookups cached.")
+
+    parser.add_option("--cachefile", dest = "cachefile",
+                        help = "LDAP lookups cache shared between processes.")
+
+    parser.add_option("--mapinterval", dest = "mapinterval", type = "int",
+                        default = 0,
+                        help = "Keep the delegations in memory in daemon " \
+                                "mode, polling LDAP for changes every " \
+                                "MAPINTERVAL seconds.")
+
+    parser.add_option("--mapreload", dest = "mapreload", type = "int",
+                        default = 3600,
+                        help = "Seconds between full loads of the " \
+                                "delegations, it's also their max age.")
+
+    parser.add_option("--mapfile", dest = "mapfile",
+                        help = "Snapshot of the delegations, to start with.")
+
     (options, args) = parser.parse_args()
 
     syslog(str(options))
 
     for opt in parser.option_list:
         if opt.dest and opt.dest not in opts:
+            if options.listen and opt.dest in daemon_opts:
+                continue
             if not getattr(options, str(opt.dest)):
                 die('Missing argument: ' + opt.dest)
 
@@ -137,27 +239,327 @@ def parse_opts():
 
 
 
+class LookupCache:
+    """
+    LDAP lookups cached for ttl seconds, and for negative_ttl the ones that
+    found nothing, at most size of them. With filename they're also kept in
+    a sqlite database, shared by the processes using the same file.
+    """
+    def __init__(self, ttl = 300, negative_ttl = 60, size = 10000,
+                    filename = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def db(self):
+        """
+        sqlite connection of this thread.
+        """
+        conn = getattr(self.local, 'db', None)
+        if conn is None:
+            if not os.path.exists(self.filename):
+                #It has directory data, only for us
+                os.close(os.open(self.filename, os.O_WRONLY | os.O_CREAT,
+                                    0600))
+            conn = sqlite3.connect(self.filename, timeout = 5)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS lookups ' \
+                            '(key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+            conn.commit()
+            self.local.db = conn
+        return conn
+
+    def get(self, key):
+        """
+        Cached value of key, None if it isn't cached.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.entries[key] = entry
+                return entry[1]
+
+        if self.filename is None:
+            return None
+        try:
+            row = self.db().execute('SELECT expires, value FROM lookups ' \
+                            'WHERE key = ? AND expires > ?',
+                            (repr(key), now)).fetchone()
+        except sqlite3.Error, e:
+            syslog('WARNING: cache %s: %s' % (self.filename, e))
+            return None
+        if row is None:
+            return None
+        value = marshal.loads(str(row[1]))
+        self._remember(key, row[0], value)
+        return value
+
+    def put(self, key, value):
+        """
+        Cache value, False for lookups that found nothing.
+        """
+        expires = time.time() + (value and self.ttl or self.negative_ttl)
+        self._remember(key, expires, value)
+
+        if self.filename is None:
+            return
+        try:
+            db = self.db()
+            db.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                        (repr(key), expires,
+                        sqlite3.Binary(marshal.dumps(value))))
+            #Every process puts a few entries, clean once in a while
+            if random.random() < 0.01:
+                db.execute('DELETE FROM lookups WHERE expires <= ?',
+                            (time.time(), ))
+                db.execute('DELETE FROM lookups WHERE key NOT IN ' \
+                            '(SELECT key FROM lookups ORDER BY expires DESC ' \
+                            'LIMIT ?)', (self.size, ))
+            db.commit()
+        except sqlite3.Error, e:
+            syslog('WARNING: cache %s: %s' % (self.filename, e))
+
+    def _remember(self, key, expires, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+
+
+def entry_info(attrs, attr, value, req_attrs, opt_attrs):
+    """
+    get_info() result of the LDAP entry attrs found by attr=value.
+    """
+    ret_attrs = {}
+
+    for req_attr in req_attrs:
+        if not req_attr in attrs.keys():
+            raise Reject("FATAL: invalid %s=%s object doesn't have %s attr in LDAP" %
+                (attr, value, req_attr))
+
+        ret_attrs[req_attr] = attrs[req_attr][0]
+
+    for opt_attr in opt_attrs:
+        if opt_attr in attrs.keys():
+            ret_attrs[opt_attr] = attrs[opt_attr]
+
+    return ret_attrs
+
+
+def paged_search(conn, base, filterstr, attrs, page_size = 500):
+    """
+    search_s() in pages, so the server size limit doesn't apply.
+    """
+    result = []
+    ctrl = SimplePagedResultsControl(True, size = page_size, cookie = '')
+    while True:
+        msgid = conn.search_ext(base, ldap.SCOPE_SUBTREE, filterstr, attrs,
+                                serverctrls = [ ctrl ])
+        rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+        result.extend(rdata)
+        cookie = None
+        for c in serverctrls:
+            if c.controlType == SimplePagedResultsControl.controlType:
+                cookie = c.cookie
+        if not cookie:
+            return result
+        ctrl.cookie = cookie
+
+
+class DelegationMap:
+    """
+    The uid, mail, cn and kolabDelegate of all the entries under base,
+    indexed by uid and mail to answer get_info() without searching.
+
+    refresh() loads everything every reload seconds and in between only the
+    entries modified since the last time (by modifyTimestamp, entries are
+    kept by entryUUID, so renames are updates). Deleted entries go away on
+    the next full load. If it couldn't refresh for reload seconds it
+    doesn't answer, so lookups go to LDAP again.
+    """
+    attrs = [ UID, MAIL, CN, KOLABDELEGATE ]
+    indexed = [ UID, MAIL ]
+    entries_filter = '(|(%s=*)(%s=*))' % (UID, MAIL)
+
+    def __init__(self, base, reload = 3600, filename = None):
+        self.base = base
+        self.reload = reload
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.index = {}
+        #Last modifyTimestamp seen, by the server clock
+        self.timestamp = None
+        #When it was loaded and refreshed for the last time
+        self.loaded = 0
+        self.refreshed = 0
+
+    def info(self, attr, value, req_attrs, opt_attrs):
+        """
+        get_info(), None if the map can't answer it.
+        """
+        if attr not in self.indexed or \
+                not set(req_attrs + opt_attrs) <= set(self.attrs):
+            return None
+        with self.lock:
+            if time.time() - self.refreshed > self.reload:
+                return None
+            keys = self.index.get((attr, value.lower()), ())
+            if len(keys) != 1:
+                return False
+            attrs = self.entries[iter(keys).next()]
+        return entry_info(attrs, attr, value, req_attrs, opt_attrs)
+
+    def _add(self, entries, index, key, attrs):
+        entries[key] = attrs
+        for attr in self.indexed:
+            for value in attrs.get(attr, ()):
+                index.setdefault((attr, value.lower()), set()).add(key)
+
+    def _remove(self, entries, index, key):
+        attrs = entries.pop(key)
+        for attr in self.indexed:
+            for value in attrs.get(attr, ()):
+                keys = index[(attr, value.lower())]
+                keys.discard(key)
+                if not keys:
+                    del index[(attr, value.lower())]
+
+    def _search(self, conn, filterstr):
+        """
+        Return {key: attrs} of the entries matching filterstr and the
+        highest modifyTimestamp of them.
+        """
+        res = paged_search(conn, self.base, filterstr,
+                            self.attrs + [ ENTRYUUID, MODIFYTIMESTAMP ])
+        found = {}
+        timestamp = self.timestamp
+        for dn, attrs in res:
+            if dn is None:
+                #Referrals
+                continue
+            key = attrs.pop(ENTRYUUID, [ dn ])[0]
+            modified = attrs.pop(MODIFYTIMESTAMP, [ None ])[0]
+            if modified and modified > timestamp:
+                timestamp = modified
+            found[key] = attrs
+        return found, timestamp
+
+    def load(self, conn):
+        """
+        Load all the entries.
+        """
+        found, timestamp = self._search(conn, self.entries_filter)
+        entries = {}
+        index = {}
+        for key, attrs in found.iteritems():
+            self._add(entries, index, key, attrs)
+        with self.lock:
+            self.entries = entries
+            self.index = index
+            self.timestamp = timestamp
+            self.loaded = self.refreshed = time.time()
+        syslog('Delegation map loaded, %d entries' % len(entries))
+
+    def update(self, conn):
+        """
+        Load the entries modified since the last load or update.
+        """
+        found, timestamp = self._search(conn, '(&%s(%s>=%s))' % \
+                        (self.entries_filter, MODIFYTIMESTAMP, self.timestamp))
+        with self.lock:
+            for key, attrs in found.iteritems():
+                if key in self.entries:
+                    self._remove(self.entries, self.index, key)
+                self._add(self.entries, self.index, key, attrs)
+            self.timestamp = timestamp
+            self.refreshed = time.time()
+
+    def refresh(self, conn):
+        if self.timestamp is None or time.time() - self.loaded > self.reload:
+            self.load(conn)
+        else:
+            self.update(conn)
+        if self.filename:
+            self.save()
+
+    def save(self):
+        """
+        Write the entries to filename, atomically.
+        """
+        tmp = self.filename + '.tmp'
+        with self.lock:
+            data = marshal.dumps((self.timestamp, self.entries))
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.write(fd, data)
+        os.close(fd)
+        os.rename(tmp, self.filename)
+
+    def restore(self):
+        """
+        Start with the entries of filename, they're as old as the file.
+        """
+        try:
+            mtime = os.path.getmtime(self.filename)
+            timestamp, found = marshal.loads(open(self.filename).read())
+        except (IOError, OSError, EOFError, ValueError, TypeError), e:
+            syslog('WARNING: delegation map %s: %s' % (self.filename, e))
+            return
+        entries = {}
+        index = {}
+        for key, attrs in found.iteritems():
+            self._add(entries, index, key, attrs)
+        with self.lock:
+            self.entries = entries
+            self.index = index
+            self.timestamp = timestamp
+            self.loaded = self.refreshed = mtime
+
+
+def lookup_cache(options):
+    """
+    The LookupCache of the options, None if disabled.
+    """
+    if options.cachettl <= 0:
+        return None
+    return LookupCache(options.cachettl, options.negativettl,
+                        options.cachesize, options.cachefile)
+
+
 class Message:
-    def __init__(self, options):
+    def __init__(self, options, conn = None, cache = None,
+                    delegation_map = None):
+        """
+        conn is a bound LDAP connection, a new one is made when it's needed
+        if None. cache is a LookupCache and delegation_map a DelegationMap
+        for get_info().
+        """
         self.options = options
-	try:
-        	self.ldap = ldap.initialize(options.ldapuri)
-        	self.ldap.bind(options.binddn, options.bindpw)
-	except ldap.LDAPError, e:
-		die('LDAP Connection error')
+        self.ldap = conn
+        self.cache = cache
+        self.delegation_map = delegation_map
 
     def __del__(self):
-        os.unlink(self.msg_tempfile)
+        #Only add_disclaimer() needs one
+        if getattr(self, 'msg_tempfile', None):
+            os.unlink(self.msg_tempfile)
         #shutil.move(self.msg_tempfile, self.options.tmpdir + '/SENT-' + \
         #            uuid.uuid1().hex)
         pass
 
-    def save_mail(self):
+    def save_mail(self, input = sys.stdin):
         """
-        Read the mail from stdin and fix From:, Sender: and Reply-to: headers.
+        Read the headers of the mail from input and fix From:, Sender: and
+        Reply-to:. The body is left in input, it's read when it's sent.
         """
-        self.msg = NamedTemporaryFile(dir = self.options.tmpdir, delete = False)
-        self.msg_tempfile = self.msg.name
+        self.msg = StringIO()
+        self.body = input
 
         self.from_hdr = False
         self.sender_hdr = False
@@ -170,7 +572,7 @@ class Message:
         else:
             headers = False
         while True:
-            line = sys.stdin.readline()
+            line = input.readline()
             if not line:
                 break
 
@@ -193,9 +595,15 @@ class Message:
 
             self.msg.write(line)
 
-        self.msg.close()
+            if not headers:
+                break
+
 
-        return self.msg_tempfile
+    def message_file(self):
+        """
+        File object with the whole fixed mail.
+        """
+        return MessageFile(self.msg.getvalue(), self.body)
 
 
     def fix_headers(self):
@@ -206,7 +614,7 @@ class Message:
         user = self.options.user.split('@')[0]
         user_info = self.get_info(UID, user)
         if not user_info:
-            die("FATAL: user %s doesn't exists or is duplicated." % \
+            raise Reject("FATAL: user %s doesn't exists or is duplicated." % \
                     (user))
 
         if (not self.sender_hdr and not self.reply_to_hdr) or not self.from_hdr:
@@ -249,7 +657,7 @@ class Message:
                     break
 
         if not delegate:
-            die("Permission denied: you don't have permission on %s" % \
+            raise Reject("Permission denied: you don't have permission on %s" % \
                 (from_hdr[1]), 544)
 
         if delegate and delegate.startswith(SENDAS):
@@ -260,33 +668,38 @@ class Message:
         self.write_hdr(FROM, from_info[CN], from_info[MAIL])
 
 
-    def get_info(self, attr, value, req_attrs = [ CN, MAIL ], opt_attrs = []): 
+    def get_info(self, attr, value, req_attrs = [ CN, MAIL ], opt_attrs = []):
+        if self.delegation_map is not None:
+            info = self.delegation_map.info(attr, value, req_attrs, opt_attrs)
+            if info is not None:
+                return info
+
+        if self.cache is None:
+            return self.search_info(attr, value, req_attrs, opt_attrs)
+
+        key = (attr, value, tuple(req_attrs), tuple(opt_attrs))
+        info = self.cache.get(key)
+        if info is None:
+            info = self.search_info(attr, value, req_attrs, opt_attrs)
+            self.cache.put(key, info)
+        return info
+
+
+    def search_info(self, attr, value, req_attrs, opt_attrs):
+        if self.ldap is None:
+            self.ldap = ldap_connect(self.options)
         try:
             res = self.ldap.search_s(self.options.ldapbase, ldap.SCOPE_SUBTREE,
                     '%s=%s' % (attr, value),
                     req_attrs + opt_attrs)
         except ldap.LDAPError, e:
-            die('LDAP search ERROR (%s). That means a config option is wrong.' \
+            raise Reject('LDAP search ERROR (%s). That means a config option is wrong.' \
                     % (e))
 	
         if len(res) != 1:
             return False
 
-        attrs = res[0][1]
-        ret_attrs = {}
-
-        for req_attr in req_attrs:
-            if not req_attr in attrs.keys():
-                die("FATAL: invalid %s=%s object doesn't have %s attr in LDAP" %
-                    (req_attr))
-
-            ret_attrs[req_attr] = attrs[req_attr][0]
-
-        for opt_attr in opt_attrs:
-            if opt_attr in attrs.keys():
-                ret_attrs[opt_attr] = attrs[opt_attr]
-
-        return ret_attrs
+        return entry_info(res[0][1], attr, value, req_attrs, opt_attrs)
 
 
     def write_hdr(self, hdr, info, mail):
@@ -295,24 +708,25 @@ class Message:
         self.msg.write(hdr_line + CRLF)
 
 
-    def send_mail(self):
-        msg_fd = open(self.msg_tempfile)
-        dfr = sendmail(self.options.smtp, self.options.sender,
-                        self.options.recipient,
-                        msg_fd, port = int(self.options.smtpport))
-
-        def success(r):
-            reactor.stop()
-
-        def error(e):
-            reactor.stop()
-
-        dfr.addCallback(success)
-        dfr.addErrback(error)
-        reactor.run()
+    def send_mail(self, pool = None):
+        """
+        Send the saved mail to the SMTP server, through the connections of
+        pool (a RelayPool) if given.
+        """
+        if pool is None:
+            #No idle connections, it's closed after this mail
+            pool = RelayPool(self.options.smtp, int(self.options.smtpport), 0)
+        pool.send(self.options.sender, self.options.recipient,
+                    self.message_file())
 
 
     def add_disclaimer(self):
+        #altermime needs the whole mail in a file
+        tmp = NamedTemporaryFile(dir = self.options.tmpdir, delete = False)
+        self.msg_tempfile = tmp.name
+        shutil.copyfileobj(self.message_file(), tmp, 1024 * 1024)
+        tmp.close()
+
         altermime_cmd = "%s --input=%s --disclaimer=%s "
         altermime_cmd += "--disclaimer-html=%s "
         altermime_cmd += " > /dev/null 2>&1" 
@@ -325,22 +739,468 @@ class Message:
             syslog('WARNING: "%s" execution failure (rc = %s).' % \
                 (altermime_cmd, ret))
 
+        self.msg = StringIO()
+        self.body = open(self.msg_tempfile)
+
+
+class RelayPool:
+    """
+    Persistent connections to the SMTP server the mails are relayed to, at
+    most size of them are kept idle, for idle seconds.
+
+    A reused connection gets a RSET, which also finds out if the server
+    closed it, sent with MAIL FROM and RCPT TO in one round trip if the
+    server has PIPELINING. A mail is sent to all its recipients or none.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, host, port, size = 4, idle = 60, timeout = 60):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conns = []
+
+    def connect(self):
+        conn = SMTP(timeout = self.timeout)
+        code, msg = conn.connect(self.host, self.port)
+        if code != 220:
+            conn.close()
+            raise SMTPConnectError(code, msg)
+        conn.ehlo_or_helo_if_needed()
+        return conn
+
+    def get(self):
+        """
+        Return a connection and if it was used before.
+        """
+        with self.lock:
+            while self.conns:
+                conn, used = self.conns.pop()
+                if time.time() - used < self.idle:
+                    return conn, True
+                self.discard(conn)
+        return self.connect(), False
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.conns) < self.size:
+                self.conns.append((conn, time.time()))
+                return
+        try:
+            conn.quit()
+        except (SMTPException, socket.error):
+            conn.close()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+    def close(self):
+        with self.lock:
+            conns, self.conns = self.conns, []
+        for conn, used in conns:
+            try:
+                conn.quit()
+            except (SMTPException, socket.error):
+                conn.close()
+
+    def envelope(self, conn, sender, recipients, reset):
+        commands = [ 'MAIL FROM:' + quoteaddr(sender) ]
+        commands += [ 'RCPT TO:' + quoteaddr(rcpt) for rcpt in recipients ]
+        if reset:
+            commands.insert(0, 'RSET')
+
+        if conn.has_extn('pipelining'):
+            conn.send(CRLF.join(commands) + CRLF)
+            replies = [ conn.getreply() for command in commands ]
+        else:
+            replies = []
+            for command in commands:
+                conn.putcmd(command)
+                replies.append(conn.getreply())
+                #Every recipient is tried, only RSET and MAIL end the envelope
+                if replies[-1][0] not in (250, 251) and \
+                        not command.startswith('RCPT'):
+                    break
+
+        refused = {}
+        for command, (code, msg) in zip(commands, replies):
+            if code in (250, 251):
+                continue
+            if command.startswith('MAIL'):
+                raise SMTPSenderRefused(code, msg, sender)
+            if command.startswith('RCPT'):
+                refused[command[8:]] = (code, msg)
+            else:
+                raise SMTPResponseException(code, msg)
+        if refused:
+            raise SMTPRecipientsRefused(refused)
+
+    def data(self, conn, fp):
+        code, msg = conn.docmd('DATA')
+        if code != 354:
+            raise SMTPDataError(code, msg)
+        #Only whole lines are quoted, the rest waits for the next chunk.
+        #The last chunk goes with the final dot.
+        rest = ''
+        pending = ''
+        while True:
+            chunk = fp.read(self.chunk_size)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind('\n') + 1
+            rest = chunk[end:]
+            if pending:
+                conn.send(pending)
+            pending = quotedata(chunk[:end])
+        if rest:
+            pending += quotedata(rest) + CRLF
+        conn.send(pending + '.' + CRLF)
+        code, msg = conn.getreply()
+        if code != 250:
+            raise SMTPDataError(code, msg)
+
+    def send(self, sender, recipients, fp):
+        """
+        Send the mail in fp, raises Reject if it isn't taken.
+        """
+        try:
+            conn, reused = self.get()
+        except (SMTPException, socket.error), e:
+            raise Reject('Relay error: %s' % e)
+        try:
+            try:
+                self.envelope(conn, sender, recipients, reused)
+            except (SMTPServerDisconnected, socket.error):
+                if not reused:
+                    raise
+                #The server closed it while it was idle
+                self.discard(conn)
+                conn = self.connect()
+                self.envelope(conn, sender, recipients, False)
+            self.data(conn, fp)
+        except (SMTPConnectError, SMTPServerDisconnected, socket.error), e:
+            self.discard(conn)
+            raise Reject('Relay error: %s' % e)
+        except SMTPRecipientsRefused, e:
+            self.put(conn)
+            codes = [ code for code, msg in e.recipients.values() ]
+            #The reply covers every recipient, the ones taken would be lost
+            #with a permanent error
+            errcode = 451
+            if len(e.recipients) >= len(set(recipients)) and min(codes) >= 500:
+                errcode = 554
+            raise Reject('Relay refused %s' % ', '.join('%s (%d %s)' % \
+                        (rcpt, code, msg) for rcpt, (code, msg) in \
+                        e.recipients.items()), errcode)
+        except SMTPResponseException, e:
+            self.put(conn)
+            errcode = 451
+            if e.smtp_code >= 500:
+                errcode = 554
+            raise Reject('Relay error: %d %s' % (e.smtp_code, e.smtp_error),
+                        errcode)
+        except SMTPException, e:
+            self.discard(conn)
+            raise Reject('Relay error: %s' % e)
+        self.put(conn)
+
+
+class MessageFile:
+    """
+    File object reading the fixed headers and then the rest of the mail
+    from the file it was being read, so the body isn't copied.
+    """
+    def __init__(self, headers, body):
+        self.parts = [ StringIO(headers), body ]
+
+    def read(self, size = -1):
+        if size < 0:
+            return ''.join(part.read() for part in self.parts)
+        data = []
+        while self.parts and size > 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def close(self):
+        self.parts = []
+
+
+def authenticated_user(fp):
+    """
+    SASL user in the first header of the mail in fp, the Received: added by
+    Postfix with smtpd_sasl_authenticated_header. None if it isn't there.
+    Only the line after "Received: from" is trusted, the rest of the header
+    has the HELO and addresses given by the client.
+
+    >>> authenticated_user(StringIO('Received: from mx (mx [10.0.0.1])\\n'
+    ...     '\\t(Authenticated sender: alice)\\n'
+    ...     '\\tby mx (Postfix) with ESMTPSA id 1\\n'))
+    'alice'
+    >>> authenticated_user(StringIO('Received: from x (Authenticated sender:'
+    ...     ' ceo) (mx [10.0.0.1])\\n'
+    ...     '\\tby mx (Postfix) with ESMTP id 1\\n'))
+    >>> authenticated_user(StringIO('Received: from mx (mx [10.0.0.1])\\n'
+    ...     '\\tby mx (Postfix) with ESMTP id 1\\n'
+    ...     '\\tfor <(Authenticated sender: ceo)>\\n'))
+    """
+    user = None
+    if fp.readline().lower().startswith('received: from '):
+        m = re.match(AUTH_SENDER_REGEX, fp.readline().rstrip('\r\n'))
+        if m:
+            user = m.group(1)
+    fp.seek(0)
+    return user
+
+
+def smtp_reply(failure):
+    """
+    SMTP reply code and text for the failure of a message.
+    """
+    if failure.check(Reject):
+        errcode = str(failure.value.errcode)
+        code = 451
+        if errcode.startswith('5'):
+            code = 554
+        return code, status(errcode) + ' ' + failure.value.msg
+
+    return 451, '4.3.0 Internal error: ' + failure.getErrorMessage()
+
+
+class SenderControl:
+    """
+    The daemon: fixes the headers of the messages in a pool of threads, each
+    one with its own LDAP connection, sharing the lookups cache, and relays
+    them through a pool of SMTP connections.
+    """
+    def __init__(self, options):
+        self.options = options
+        self.local = threading.local()
+        self.cache = lookup_cache(options)
+        self.relay_pool = RelayPool(options.smtp, int(options.smtpport),
+                                    options.workers)
+        self.delegation_map = None
+        self.map_ldap = None
+        if options.mapinterval > 0:
+            self.delegation_map = DelegationMap(options.ldapbase,
+                                    options.mapreload, options.mapfile)
+            if options.mapfile and os.path.exists(options.mapfile):
+                self.delegation_map.restore()
+
+    def refresh_map(self):
+        """
+        Refresh the delegation map, runs in a worker thread.
+        """
+        try:
+            if self.map_ldap is None:
+                self.map_ldap = ldap_connect(self.options)
+            self.delegation_map.refresh(self.map_ldap)
+        except (Reject, ldap.LDAPError), e:
+            self.map_ldap = None
+            syslog('WARNING: delegation map refresh failed: %s' % e)
+        except Exception, e:
+            #Keep polling anyway, LoopingCall stops on errors
+            syslog('WARNING: delegation map refresh failed: %s' % e)
+
+    def start(self):
+        if self.delegation_map is not None:
+            loop = task.LoopingCall(threads.deferToThread, self.refresh_map)
+            loop.start(self.options.mapinterval)
+
+    def fix(self, sender, recipients, data):
+        """
+        Fix the headers of the mail in data, runs in a worker thread.
+        Returns the Message to relay.
+        """
+        options = copy.copy(self.options)
+        options.sender = sender
+        options.recipient = recipients
+        try:
+            data.seek(0)
+            options.user = authenticated_user(data)
+            msg = Message(options, getattr(self.local, 'ldap', None),
+                            self.cache, self.delegation_map)
+            msg.save_mail(data)
+            self.local.ldap = msg.ldap
+        except Reject, e:
+            #Temporary errors are mostly from LDAP, start again with it
+            if not str(e.errcode).startswith('5'):
+                self.local.ldap = None
+            raise
+        return msg
+
+    def handle(self, sender, recipients, data):
+        """
+        Fix and relay a message, runs in a worker thread.
+        """
+        try:
+            msg = self.fix(sender, recipients, data)
+            msg.send_mail(self.relay_pool)
+        finally:
+            data.close()
+
+    def process(self, sender, recipients, data):
+        """
+        Fix and relay a message, the rest of data after the headers is sent
+        as it is. Returns a Deferred.
+        """
+        return threads.deferToThread(self.handle, sender, recipients, data)
+
+
+@implementer(smtp.IMessage)
+class FilterMessage:
+    """
+    A message received in daemon mode, with all its recipients.
+    """
+    def __init__(self, server, sender, recipients):
+        self.server = server
+        self.sender = sender
+        self.recipients = recipients
+        self.data = SpooledTemporaryFile(server.options.spoolsize,
+                                        dir = server.options.tmpdir)
+        self.waiters = []
+
+    def lineReceived(self, line):
+        self.data.write(line + '\n')
+
+    def eomReceived(self):
+        dfr = self.server.process(self.sender, self.recipients, self.data)
+        dfr.addBoth(self.done)
+        return self.wait()
+
+    def connectionLost(self):
+        self.data.close()
+
+    def wait(self):
+        dfr = defer.Deferred()
+        self.waiters.append(dfr)
+        return dfr
+
+    def done(self, result):
+        for dfr in self.waiters:
+            dfr.callback(result)
+
+
+@implementer(smtp.IMessage)
+class FollowerMessage:
+    """
+    The SMTP server wants a message per recipient, the ones after the first
+    get this, that waits for the FilterMessage.
+    """
+    def __init__(self, message):
+        self.message = message
+
+    def lineReceived(self, line):
+        pass
+
+    def eomReceived(self):
+        return self.message.wait()
+
+    def connectionLost(self):
+        pass
+
+
+@implementer(smtp.IMessageDelivery)
+class FilterDelivery:
+    def __init__(self, server):
+        self.server = server
+        self.message = None
+
+    def receivedHeader(self, helo, origin, recipients):
+        return None
+
+    def validateFrom(self, helo, origin):
+        self.sender = str(origin)
+        self.recipients = []
+        return origin
+
+    def validateTo(self, user):
+        self.recipients.append(str(user.dest))
+        first = len(self.recipients) == 1
+        return lambda: self.get_message(first)
+
+    def get_message(self, first):
+        if first:
+            self.message = FilterMessage(self.server, self.sender,
+                                        self.recipients)
+            return self.message
+        return FollowerMessage(self.message)
+
+
+class FilterProtocol(smtp.ESMTP):
+    #Lines longer than RFC 5322 allows are common, don't drop them
+    MAX_LENGTH = 1024 * 1024
+
+    def _messageHandled(self, resultList):
+        for success, result in resultList:
+            if not success:
+                code, text = smtp_reply(result)
+                syslog('%d %s' % (code, text))
+                self.sendCode(code, text)
+                return
+        self.sendCode(250, '2.0.0 Ok: queued')
+
+
+class FilterFactory(smtp.SMTPFactory):
+    protocol = FilterProtocol
+
+    def __init__(self, server):
+        smtp.SMTPFactory.__init__(self)
+        self.server = server
+
+    def buildProtocol(self, addr):
+        p = smtp.SMTPFactory.buildProtocol(self, addr)
+        p.delivery = FilterDelivery(self.server)
+        return p
+
+
+def serve(options):
+    address, port = '', options.listen
+    if ':' in port:
+        address, port = port.rsplit(':', 1)
+    reactor.suggestThreadPoolSize(options.workers)
+    server = SenderControl(options)
+    server.start()
+    reactor.listenTCP(int(port), FilterFactory(server), interface = address)
+    reactor.addSystemEventTrigger('before', 'shutdown', server.relay_pool.close)
+    syslog('Listening on ' + options.listen)
+    reactor.run()
+
 
 def main():
     openlog('sender_control.py', 0, LOG_MAIL)
 
     options = parse_opts()
 
-    msg = Message(options)
-    msg.save_mail()
-    #msg.add_disclaimer()
-    msg.send_mail()
+    if options.listen:
+        serve(options)
+        return
+
+    try:
+        msg = Message(options, cache = lookup_cache(options))
+        msg.save_mail()
+        #msg.add_disclaimer()
+        msg.send_mail()
+    except Reject, e:
+        die(e.msg, e.errcode)
 
 
 #I know, we must not do this... but I have to ensure that the emails are
 #deferred if something goes wrong.
-try:
-    main()
-except Exception, e:
-    die('Internal error: ' + str(e))
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception, e:
+        die('Internal error: ' + str(e))
 
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Geometry of the Karlsruhe Schema address lines, computed with NumPy for
+# every vertex at once. Angles are in degrees, counter-clockwise from the
+# east, and positions are in a y-up frame (meters or lon/lat).
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import numpy
+
+#Meters per degree of latitude, and of longitude at the equator
+METERS_LAT = 110574.0
+METERS_LON = 111320.0
+
+def bearings(x1, y1, x2, y2):
+    """Angle of every line from (x1, y1) to (x2, y2), in [0, 360)."""
+    return numpy.degrees(numpy.arctan2(y2 - y1, x2 - x1)) % 360
+
+def turn_angles(count, index, angles):
+    """Minimum and maximum of the angles of each vertex.
+
+    angles is a flat array, index tells the vertex of each angle. Vertices
+    without angles get 180, as if the street went on straight."""
+    min_angles = numpy.empty(count)
+    min_angles.fill(180)
+    max_angles = min_angles.copy()
+    if len(index) == 0:
+        return min_angles, max_angles
+
+    #Group the angles by vertex and reduce every group, ufunc.at is slow
+    index = numpy.asarray(index)
+    angles = numpy.asarray(angles)
+    if (index[1:] < index[:-1]).any():
+        order = numpy.argsort(index, kind = 'mergesort')
+        index = index[order]
+        angles = angles[order]
+    starts = numpy.flatnonzero(numpy.r_[True, index[1:] != index[:-1]])
+    min_angles[index[starts]] = numpy.minimum.reduceat(angles, starts)
+    max_angles[index[starts]] = numpy.maximum.reduceat(angles, starts)
+    return min_angles, max_angles
+
+def hypotenuses(dest, angles):
+    """Length of the lines at angles from the street reaching dest away."""
+    return dest / numpy.sin(numpy.radians(angles))
+
+def offset(x, y, angles, lengths):
+    """Endpoints of the lines of lengths leaving (x, y) at angles."""
+    radians = numpy.radians(angles)
+    return x + lengths * numpy.cos(radians), y + lengths * numpy.sin(radians)
+
+def offset_lines(x1, y1, x2, y2, angle1, angle2, dest):
+    """Address lines parallel to the lines from (x1, y1) to (x2, y2).
+
+    They start at angle1 from the line at its first point and end at
+    -angle2 from the reversed line at its second one, dest away from it.
+    Positive angles give the left side. Returns (sx, sy, ex, ey)."""
+    angle1 = numpy.asarray(angle1, dtype = float)
+    angle2 = numpy.asarray(angle2, dtype = float)
+    forward = bearings(x1, y1, x2, y2)
+    sx, sy = offset(x1, y1, forward + angle1,
+                    hypotenuses(dest, numpy.abs(angle1)))
+    ex, ey = offset(x2, y2, forward + 180 - angle2,
+                    hypotenuses(dest, numpy.abs(angle2)))
+    return sx, sy, ex, ey
+
+def address_points(lon, lat, next_lon, next_lat, adj_index, adj_lon,
+                    adj_lat, dest = 30, min_angle = 10):
+    """Left and right address points of every street vertex.
+
+    Vertex i is at (lon[i], lat[i]) and the street goes on towards
+    (next_lon[i], next_lat[i]). The other streets leaving the vertex are
+    given flat: adj_index[j] is the vertex of the adjacent node at
+    (adj_lon[j], adj_lat[j]). The points are dest meters away from the
+    street, on the bisector of the angle between the street and the
+    nearest adjacent street of each side (at least min_angle).
+
+    Returns the arrays left_lon, left_lat, right_lon, right_lat."""
+    lon = numpy.asarray(lon, dtype = float)
+    lat = numpy.asarray(lat, dtype = float)
+    adj_index = numpy.asarray(adj_index, dtype = int)
+
+    #Local equirectangular frame in meters around every vertex
+    scale_lon = METERS_LON * numpy.cos(numpy.radians(lat))
+    street = bearings(0, 0, (numpy.asarray(next_lon) - lon) * scale_lon,
+                        (numpy.asarray(next_lat) - lat) * METERS_LAT)
+    adjacent = bearings(0, 0,
+                (numpy.asarray(adj_lon) - lon[adj_index]) * scale_lon[adj_index],
+                (numpy.asarray(adj_lat) - lat[adj_index]) * METERS_LAT)
+
+    min_angles, max_angles = turn_angles(len(lon), adj_index,
+                                        (adjacent - street[adj_index]) % 360)
+    angle_left = numpy.maximum(min_angles / 2, min_angle)
+    angle_right = numpy.maximum((360 - max_angles) / 2, min_angle)
+
+    left_x, left_y = offset(0, 0, street + angle_left,
+                            hypotenuses(dest, angle_left))
+    right_x, right_y = offset(0, 0, street - angle_right,
+                            hypotenuses(dest, angle_right))
+
+    return lon + left_x / scale_lon, lat + left_y / METERS_LAT, \
+            lon + right_x / scale_lon, lat + right_y / METERS_LAT
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Dialog of karl.py, kept apart so the batch mode runs without PyQt4
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import sys
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+import KarlGeometry
+
+
+class MiniWay(QLineF):
+    DEST = 30
+    LEFT = 0
+    RIGHT = 1
+    def __init__(self, lat1, long1, lat2, long2):
+        super(MiniWay, self).__init__(QPointF(lat1, long1),
+                                        QPointF(lat2, long2))
+
+    def start_end(self):
+        line_start = QLineF(self)
+        line_end = QLineF(self.p2(), self.p1())
+
+        return line_start, line_end
+ 
+    def line(self, angle1 = 45, angle2 = 10, side = 0):
+#Seguir probando esto, la idea es usar los angulos y la tangente
+#para calcular la longitud del cateto que coincide con el highway
+        if side != 0:
+            angle1, angle2 = -angle1, -angle2
+        #Qt y grows downwards, KarlGeometry works with y upwards
+        sx, sy, ex, ey = KarlGeometry.offset_lines(self.x1(), -self.y1(),
+                                    self.x2(), -self.y2(), angle1, angle2,
+                                    self.DEST)
+        return QLineF(float(sx), -float(sy), float(ex), -float(ey))
+
+    def right(self, angle1, angle2):
+        return self.line(45, 45, self.LEFT)
+
+    def left(self, angle1, angle2):
+        return self.line(45, 45, self.RIGHT)
+
+
+class Karl(QDialog):
+    def __init__(self, args, do_karl):
+        super(Karl, self).__init__()
+        self.do_karl = do_karl
+ 
+        self.setGeometry(200, 200, 400, 200)
+        self.setWindowTitle('Address numbers helper')
+
+        main_layout = QGridLayout(self)
+
+        main_layout.addWidget(QLabel('First node: '), 0, 0)
+        self.first = QLineEdit()
+        main_layout.addWidget(self.first, 0, 1)
+        if len(args) >= 2:
+            self.first.setText(args[1])
+
+        main_layout.addWidget(QLabel('Last node: '), 1, 0)
+        self.last = QLineEdit()
+        main_layout.addWidget(self.last, 1, 1)
+        if len(args) >= 3:
+            self.last.setText(args[2])
+
+        button_ok = QPushButton('OK')
+        button_cancel = QPushButton('Cancel')
+        main_layout.addWidget(button_ok, 2, 0)
+        main_layout.addWidget(button_cancel, 2, 1)
+
+        self.connect(button_ok, SIGNAL("clicked()"),
+                        self, SLOT('accept()'))
+        self.connect(button_cancel, SIGNAL("clicked()"),
+                        self, SLOT('reject()'))
+
+    def accept(self):
+        print 'ACCEPTED', self.first.text(), self.last.text()
+        self.do_karl(self.first.text(), self.last.text())
+
+    def in_range(self, node):
+        for way in Ways.node_ways[node]:
+            try:
+                way_name = Ways.ways_d[way]['tag']['name']
+            except KeyError:
+                print 'ERROR: name tag missing'
+                return False
+
+            if self.in_range_f < 0 and way_name == self.start_name:
+                self.in_range_f = 0
+            elif self.in_range_f <= int(self.n_blocks):
+                self.in_range_f = -1
+            elif self.in_range_f >= 0:
+                self.in_range_f += 1 
+
+        return self.in_range_f
+
+    def interpolate(self, way_id):
+        way = Ways.ways_d[way_id]
+        nodes = way['nd']
+        self.in_range_f = -1
+        for i in range(0, len(nodes) - 1):
+            if not self.in_range(nodes[i]):
+                continue
+
+            print 'UUU'
+
+
+    def reject(self):
+        print 'REJECTED'
+        sys.exit(0)
+ 
+    def paintEvent(self, e):
+        qp = QPainter()
+ 
+        qp.begin(self)        
+        self.doDrawing(qp)        
+        qp.end()
+        
+    def doDrawing(self, qp):
+        miniway1 = MiniWay(600, 100, 400, 100)        
+
+        pen = QPen(Qt.black, 2, Qt.SolidLine)
+        qp.setPen(pen)
+
+        qp.drawLine(miniway1)
+
+        pen.setColor(Qt.blue)
+        qp.setPen(pen)
+        qp.drawLine(miniway1.right(45, 45))
+        pen.setColor(Qt.yellow)
+        qp.setPen(pen)
+        qp.drawLine(miniway1.left(45, 45))
@@ -53,18 +53,228 @@
 
 __version__ = '0.2.19'
 
-import httplib, base64, xml.dom.minidom, time, sys, urllib
+import httplib, base64, xml.dom.minidom, time, sys, urllib, threading, Queue, zlib, re, random, socket, calendar, errno, warnings
+import email.utils
+import xml.etree.cElementTree as ElementTree
+from cStringIO import StringIO
 
 class ApiError(Exception):
     	
-    def __init__(self, status, reason, payload):
+    def __init__(self, status, reason, payload, headers = None):
         self.status  = status
         self.reason  = reason
         self.payload = payload
+        self.headers = headers or {}    # response headers, lower case names
     
     def __str__(self):
         return "Request failed: " + str(self.status) + " - " + self.reason + " - " + self.payload
 
+# Characters to escape in xml attributes
+_XmlSpecial = re.compile(u"[&\"<>]")
+
+# Timestamps of the API
+_TimeFormat = "%Y-%m-%dT%H:%M:%SZ"
+
+def _ParseTime(value):
+    """ Returns the seconds since the epoch of an API timestamp. """
+    return calendar.timegm(time.strptime(value, _TimeFormat))
+
+def _Closed(error):
+    """ Returns True if error shows the server closed the connection before answering anything. """
+    if isinstance(error, httplib.BadStatusLine):
+        return error.line in ("", "''") or error.line.startswith("No status line")
+    if isinstance(error, socket.error) and not isinstance(error, socket.timeout):
+        return error.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+    return False
+
+###########################################################################
+## Http connection pool                                                  ##
+
+class ConnectionPool(object):
+    """ Keep-alive http(s) connections to one host, shared between threads. """
+
+    def __init__(self, host, port = None, secure = False, maxsize = 4, keepalive = 10.0):
+        self.host      = host
+        self.secure    = secure
+        self.port      = port           # None: from host or the default
+        self.maxsize   = maxsize        # idle connections kept open
+        self.keepalive = keepalive      # seconds an idle connection is reused, servers close them
+        self._idle     = []             # (connection, time it was put back)
+        self._lock   = threading.Lock()
+        # statistics
+        self.requests  = 0
+        self.created   = 0
+        self.reused    = 0
+        self.discarded = 0
+
+    def get(self):
+        """ Returns an idle connection or a new one, and if it was used before. """
+        expired = []
+        with self._lock:
+            self.requests += 1
+            while self._idle:
+                conn, idle = self._idle.pop()
+                if time.time() - idle < self.keepalive:
+                    self.reused += 1
+                    break
+                expired.append(conn)
+            else:
+                conn = None
+        for old in expired:
+            old.close()
+        if conn is not None:
+            return conn, True
+        return self.connect(), False
+
+    def connect(self):
+        """ Returns a new connection. """
+        with self._lock:
+            self.created += 1
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, self.port)
+        return httplib.HTTPConnection(self.host, self.port)
+
+    def put(self, conn):
+        """ Gives back a connection whose response has been read. """
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def discard(self, conn):
+        """ Closes a connection which can't be reused. """
+        with self._lock:
+            self.discarded += 1
+        conn.close()
+
+    def close(self):
+        """ Closes the idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, since in idle:
+            conn.close()
+
+    def stats(self):
+        """ Returns dict with requests, created, reused and discarded connections count. """
+        return {"requests": self.requests, "created": self.created, "reused": self.reused, "discarded": self.discarded}
+
+###########################################################################
+## Retry policy                                                          ##
+
+class RetryPolicy(object):
+    """ When and how long to wait before retrying a failed request.
+
+    Retries back off exponentially with full jitter, or wait what the server asks in Retry-After.
+    Every request adds budget retries to a bucket shared by all the requests (holding at most
+    burst), every retry takes one, so a failing server gets a bounded extra load. After breakerfailures
+    failures in a row a host is given up for breakertimeout seconds (ApiError 503 without trying),
+    then a single request probes it. Only GET is retried after a network error or 5xx; other
+    methods only when the server refused them with 429 or 503. A kept alive connection closed by
+    the server is replaced once without counting as a retry, see OsmApi._http_request. """
+
+    def __init__(self, tries = 5, backoff = 1.0, maxbackoff = 60.0, maxretryafter = 300.0,
+                 budget = 0.2, burst = 10, breakerfailures = 5, breakertimeout = 30.0,
+                 networkerrors = (IOError, socket.error, httplib.HTTPException),
+                 timer = time.time, sleep = time.sleep):
+        self.tries           = tries
+        self.backoff         = backoff
+        self.maxbackoff      = maxbackoff
+        self.maxretryafter   = maxretryafter
+        self.budget          = budget
+        self.burst           = burst
+        self.breakerfailures = breakerfailures
+        self.breakertimeout  = breakertimeout
+        self.networkerrors   = networkerrors
+        self.timer           = timer
+        self.sleep           = sleep
+        self._lock     = threading.Lock()
+        self._tokens   = float(burst)
+        self._failures = {}             # host: consecutive failures
+        self._opened   = {}             # host: time the breaker opened
+        self._probing  = set()          # hosts with a half open probe running
+        # statistics
+        self.retries  = 0
+        self.rejected = 0
+
+    def before(self, host):
+        """ Called before every request, raises ApiError 503 while the breaker of host is open. """
+        with self._lock:
+            self._tokens = min(self._tokens + self.budget, self.burst)
+            opened = self._opened.get(host)
+            if opened is None:
+                return
+            if self.timer() - opened < self.breakertimeout or host in self._probing:
+                self.rejected += 1
+                raise ApiError(503, "Circuit open", host)
+            self._probing.add(host)
+
+    def success(self, host):
+        """ The server answered, even with an error which isn't its fault. """
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+            self._probing.discard(host)
+
+    def failure(self, host):
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if host in self._probing or self._failures[host] >= self.breakerfailures:
+                self._opened[host] = self.timer()
+            self._probing.discard(host)
+
+    def retryable(self, cmd, error):
+        """ Returns True if error is worth a retry for a cmd request. """
+        if isinstance(error, ApiError):
+            if error.status in (429, 503):
+                return error.reason <> "Circuit open"
+            return cmd == "GET" and error.status >= 500
+        return cmd == "GET" and isinstance(error, self.networkerrors)
+
+    def servererror(self, error):
+        """ Returns True if error counts as a failure of the server for the breaker. """
+        if isinstance(error, ApiError):
+            return error.status >= 500 or error.status == 429
+        return isinstance(error, self.networkerrors)
+
+    def delay(self, attempt, error):
+        """ Returns the seconds to wait before retry number attempt (from 0) after error. """
+        retryafter = self.retryafter(error)
+        if retryafter is not None:
+            return retryafter
+        return random.uniform(0, min(self.maxbackoff, self.backoff * 2 ** attempt))
+
+    def retryafter(self, error):
+        """ Returns the seconds of the Retry-After header of error, if any. """
+        value = getattr(error, "headers", {}).get("retry-after")
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return None
+            seconds = email.utils.mktime_tz(date) - self.timer()
+        return min(max(seconds, 0), self.maxretryafter)
+
+    def retry(self, cmd, attempt, error):
+        """ Returns the seconds to wait before retrying after error, None to give up. """
+        if attempt + 1 >= self.tries or not self.retryable(cmd, error):
+            return None
+        with self._lock:
+            if self._tokens < 1:
+                self.rejected += 1
+                return None
+            self._tokens -= 1
+            self.retries += 1
+        return self.delay(attempt, error)
+
+    def stats(self):
+        """ Returns dict with retries, rejected retries and requests, budget left and open hosts. """
+        with self._lock:
+            return {"retries": self.retries, "rejected": self.rejected, "budget": self._tokens, "open": sorted(self._opened)}
+
 ###########################################################################
 ## Main class                                                            ##
 
@@ -81,11 +291,28 @@ class OsmApi(object):
         changesetautotags = {},
         changesetautosize = 500,
         changesetautomulti = 1,
+        parser = "dom",
+        maxurllen = 2000,
+        threads = 4,
+        https = False,
+        poolsize = 4,
+        gzip = True,
+        retry = None,
+        instrument = None,
         debug = False
         ):
     
         # debug
         self._debug = debug
+
+        # Xml parser: "dom" builds a minidom tree, "stream" uses iterparse
+        if parser not in ("dom", "stream"):
+            raise ValueError("Unknown parser " + repr(parser))
+        self._parser = parser
+
+        # Multi fetch: split id lists in urls of maxurllen, fetched by threads
+        self._maxurllen = maxurllen
+        self._threads   = threads
         
         # Get username
         if username:
@@ -123,14 +350,34 @@ class OsmApi(object):
         # Initialisation     
         self._CurrentChangesetId = 0
         
-        # Http connection
-        self._conn = httplib.HTTPConnection(self._api, 80)
+        # Http connections, pooled by host
+        self._https    = https
+        self._poolsize = poolsize
+        self._gzip     = gzip
+        self._pools    = {}
+        self._poolslock = threading.Lock()
+
+        # Retries, a RetryPolicy can be shared by several instances
+        self._retry = retry or RetryPolicy()
+
+        # Instrumentation hooks, see OsmStats.Instrument
+        self._instrument = instrument
 
     def __del__(self):
-        if self._changesetauto:
+        # __init__ may have failed before setting everything up
+        if getattr(self, "_changesetauto", False):
             self._changesetautoflush(True)
+        if hasattr(self, "_pools"):
+            OsmApi.close(self)
         return None
 
+    def close(self):
+        """ Closes the idle http connections. """
+        with self._poolslock:
+            pools, self._pools = self._pools.values(), {}
+        for pool in pools:
+            pool.close()
+
     #######################################################################
     # Capabilities                                                        #
     #######################################################################
@@ -165,9 +412,7 @@ class OsmApi(object):
         if NodeVersion <> -1: uri += "/"+str(NodeVersion)
         data = self._get(uri)
         if not data: return data
-        data = xml.dom.minidom.parseString(data)
-        data = data.getElementsByTagName("osm")[0].getElementsByTagName("node")[0]
-        return self._DomParseNode(data)
+        return self._ParseElements(data, u"node")[0]
 
     def NodeCreate(self, NodeData):
         """ Creates a node. Returns updated NodeData (without timestamp). """
@@ -185,10 +430,8 @@ class OsmApi(object):
         """ Returns dict(NodeVerrsion: NodeData). """
         uri = "/api/0.6/node/"+str(NodeId)+"/history"
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = {}
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("node"):
-            data = self._DomParseNode(data)
+        for data in self._ParseElements(data, u"node"):
             result[data[u"version"]] = data
         return result
 
@@ -196,10 +439,8 @@ class OsmApi(object):
         """ Returns [WayData, ... ] containing node #NodeId. """
         uri = "/api/0.6/node/%d/ways"%NodeId
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = []
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("way"):
-            data = self._DomParseRelation(data)
+        for data in self._ParseElements(data, u"way"):
             result.append(data)
         return result
     
@@ -207,23 +448,14 @@ class OsmApi(object):
         """ Returns [RelationData, ... ] containing node #NodeId. """
         uri = "/api/0.6/node/%d/relations"%NodeId
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = []
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("relation"):
-            data = self._DomParseRelation(data)
+        for data in self._ParseElements(data, u"relation"):
             result.append(data)
         return result
 
     def NodesGet(self, NodeIdList):
         """ Returns dict(NodeId: NodeData) for each node in NodeIdList """
-        uri  = "/api/0.6/nodes?nodes=" + ",".join([str(x) for x in NodeIdList])
-        data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
-        result = {}
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("node"):
-            data = self._DomParseNode(data)
-            result[data[u"id"]] = data
-        return result
+        return self._GetMulti("/api/0.6/nodes?nodes=", NodeIdList, u"node")
 
     #######################################################################
     # Way                                                                 #
@@ -235,9 +467,7 @@ class OsmApi(object):
         if WayVersion <> -1: uri += "/"+str(WayVersion)
         data = self._get(uri)
         if not data: return data
-        data = xml.dom.minidom.parseString(data)
-        data = data.getElementsByTagName("osm")[0].getElementsByTagName("way")[0]
-        return self._DomParseWay(data)
+        return self._ParseElements(data, u"way")[0]
     
     def WayCreate(self, WayData):
         """ Creates a way. Returns updated WayData (without timestamp). """
@@ -255,10 +485,8 @@ class OsmApi(object):
         """ Returns dict(WayVerrsion: WayData). """
         uri = "/api/0.6/way/"+str(WayId)+"/history"
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = {}
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("way"):
-            data = self._DomParseWay(data)
+        for data in self._ParseElements(data, u"way"):
             result[data[u"version"]] = data
         return result
     
@@ -266,10 +494,8 @@ class OsmApi(object):
         """ Returns [RelationData, ...] containing way #WayId. """
         uri = "/api/0.6/way/%d/relations"%WayId
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = []
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("relation"):
-            data = self._DomParseRelation(data)
+        for data in self._ParseElements(data, u"relation"):
             result.append(data)
         return result
 
@@ -281,14 +507,7 @@ class OsmApi(object):
 
     def WaysGet(self, WayIdList):
         """ Returns dict(WayId: WayData) for each way in WayIdList """
-        uri = "/api/0.6/ways?ways=" + ",".join([str(x) for x in WayIdList])
-        data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
-        result = {}
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("way"):
-            data = self._DomParseWay(data)
-            result[data[u"id"]] = data
-        return result
+        return self._GetMulti("/api/0.6/ways?ways=", WayIdList, u"way")
 
     #######################################################################
     # Relation                                                            #
@@ -300,9 +519,7 @@ class OsmApi(object):
         if RelationVersion <> -1: uri += "/"+str(RelationVersion)
         data = self._get(uri)
         if not data: return data
-        data = xml.dom.minidom.parseString(data)
-        data = data.getElementsByTagName("osm")[0].getElementsByTagName("relation")[0]
-        return self._DomParseRelation(data)
+        return self._ParseElements(data, u"relation")[0]
 
     def RelationCreate(self, RelationData):
         """ Creates a relation. Returns updated RelationData (without timestamp). """
@@ -320,10 +537,8 @@ class OsmApi(object):
         """ Returns dict(RelationVerrsion: RelationData). """
         uri = "/api/0.6/relation/"+str(RelationId)+"/history"
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = {}
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("relation"):
-            data = self._DomParseRelation(data)
+        for data in self._ParseElements(data, u"relation"):
             result[data[u"version"]] = data
         return result
     
@@ -331,30 +546,33 @@ class OsmApi(object):
         """ Returns list of RelationData containing relation #RelationId. """
         uri = "/api/0.6/relation/%d/relations"%RelationId
         data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
         result = []
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("relation"):
-            data = self._DomParseRelation(data)
+        for data in self._ParseElements(data, u"relation"):
             result.append(data)
         return result
 
     def RelationFullRecur(self, RelationId):
         """ Return full data for relation RelationId. Recurisve version relation of relations. """
-        data = []
+        return list(self.RelationFullRecurIter(RelationId))
+
+    def RelationFullRecurIter(self, RelationId):
+        """ Yields full data for relation RelationId and its sub relations as {type: node|way|relation, data: {}}. Each level of sub relations is fetched in parallel and elements are yielded once per (type, id, version). """
+        yielded = set()
+        done = set([RelationId])
         todo = [RelationId]
-        done = []
         while todo:
-            rid = todo.pop(0)
-            done.append(rid)
-            temp = self.RelationFull(rid)
-            for item in temp:
-                if item["type"] <> "relation":
-                    continue
-                if item["data"]["id"] in done:
-                    continue
-                todo.append(item["data"]["id"])            
-            data += temp
-        return data
+            frontier = []
+            for temp in self._ParallelMap(self.RelationFull, todo):
+                for item in temp:
+                    key = (item["type"], item["data"]["id"], item["data"].get("version"))
+                    if key in yielded:
+                        continue
+                    yielded.add(key)
+                    if item["type"] == "relation" and item["data"]["id"] not in done:
+                        done.add(item["data"]["id"])
+                        frontier.append(item["data"]["id"])
+                    yield item
+            todo = frontier
     
     def RelationFull(self, RelationId):
         """ Return full data for relation RelationId as list of {type: node|way|relation, data: {}}. """
@@ -364,14 +582,7 @@ class OsmApi(object):
 
     def RelationsGet(self, RelationIdList):
         """ Returns dict(RelationId: RelationData) for each relation in RelationIdList """
-        uri = "/api/0.6/relations?relations=" + ",".join([str(x) for x in RelationIdList])
-        data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
-        result = {}
-        for data in data.getElementsByTagName("osm")[0].getElementsByTagName("relation"):
-            data = self._DomParseRelation(data)
-            result[data[u"id"]] = data            
-        return result
+        return self._GetMulti("/api/0.6/relations?relations=", RelationIdList, u"relation")
 
     #######################################################################
     # Changeset                                                           #
@@ -380,9 +591,7 @@ class OsmApi(object):
     def ChangesetGet(self, ChangesetId):
         """ Returns ChangesetData for changeset #ChangesetId. """
         data = self._get("/api/0.6/changeset/"+str(ChangesetId))
-        data = xml.dom.minidom.parseString(data)
-        data = data.getElementsByTagName("osm")[0].getElementsByTagName("changeset")[0]
-        return self._DomParseChangeset(data)
+        return self._ParseElements(data, u"changeset")[0]
     
     def ChangesetUpdate(self, ChangesetTags = {}):
         """ Updates current changeset with ChangesetTags. """
@@ -414,16 +623,11 @@ class OsmApi(object):
 
     def ChangesetUpload(self, ChangesData):
         """ Upload data. ChangesData is a list of dict {type: node|way|relation, action: create|delete|modify, data: {}}. Returns list with updated ids. """
-        data = ""
-        data += u"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
-        data += u"<osmChange version=\"0.6\" generator=\"" + self._created_by + "\">\n"
         for change in ChangesData:
-            data += u"<"+change["action"]+">\n"
             change["data"]["changeset"] = self._CurrentChangesetId
-            data += self._XmlBuild(change["type"], change["data"], False).decode("utf-8")
-            data += u"</"+change["action"]+">\n"
-        data += u"</osmChange>"
-        data = self._http("POST", "/api/0.6/changeset/"+str(self._CurrentChangesetId)+"/upload", True, data.encode("utf-8"))
+        data = []
+        self._OscWrite(data.append, ChangesData)
+        data = self._http("POST", "/api/0.6/changeset/"+str(self._CurrentChangesetId)+"/upload", True, "".join(data))
         data = xml.dom.minidom.parseString(data)
         data = data.getElementsByTagName("diffResult")[0]
         data = [x for x in data.childNodes if x.nodeType == x.ELEMENT_NODE]
@@ -445,8 +649,46 @@ class OsmApi(object):
                       closed_after=None, created_before=None,
                       only_open=False, only_closed=False):
         """ Returns dict(ChangsetId: ChangesetData) matching all criteria. """
-        
+        uri = self._ChangesetsUri(min_lon, min_lat, max_lon, max_lat, userid, username, closed_after, created_before, only_open, only_closed)
+        data = self._get(uri)
+        result = {}
+        for tmpCS in self._ParseElements(data, u"changeset"):
+            result[tmpCS["id"]] = tmpCS
+        return result
+
+    def ChangesetsGetIter(self, min_lon=None, min_lat=None, max_lon=None, max_lat=None,
+                      userid=None, username=None,
+                      closed_after=None, created_before=None,
+                      only_open=False, only_closed=False, window=None):
+        """ Yields ChangesetData matching all criteria, newest first. The server returns at most ChangesetsPage changesets per request, so they are paged backwards by creation time, which has one second precision: if more than ChangesetsPage were created in the same second, a warning tells the rest are missing. With window (seconds) and closed_after, the time range is split in windows paged by up to self._threads threads and still yielded in order, holding a few pages in memory. """
+        if window and not closed_after:
+            raise ValueError("window needs closed_after")
+        params = self._ChangesetsParams(min_lon, min_lat, max_lon, max_lat, userid, username, only_open, only_closed)
+        closed_after = closed_after or "1970-01-01T00:00:00Z"
+        created_before = created_before or time.strftime(_TimeFormat, time.gmtime(time.time() + 1))
+        if not window or self._threads <= 1:
+            pages = self._ChangesetsPages(params, closed_after, created_before, None)
+            return (changeset for page in pages for changeset in page)
+        windows = self._ChangesetsWindows(closed_after, created_before, window)
+        pages = self._ParallelIter([(lambda lower = lower, upper = upper: self._ChangesetsPages(params, closed_after, upper, lower)) for lower, upper in windows])
+        return (changeset for page in pages for changeset in page)
+
+    def _ChangesetsUri(self, min_lon, min_lat, max_lon, max_lat, userid, username, closed_after, created_before, only_open, only_closed):
+        """ Returns the uri of ChangesetsGet. """
         uri = "/api/0.6/changesets"
+        params = self._ChangesetsParams(min_lon, min_lat, max_lon, max_lat, userid, username, only_open, only_closed)
+        if closed_after and not created_before:
+            params["time"] = closed_after
+        if created_before:
+            if not closed_after:
+                closed_after = "1970-01-01T00:00:00Z"
+            params["time"] = closed_after + "," + created_before
+        if params:
+            uri += "?" + urllib.urlencode(params)
+        return uri
+
+    def _ChangesetsParams(self, min_lon, min_lat, max_lon, max_lat, userid, username, only_open, only_closed):
+        """ Returns the query parameters of ChangesetsGet but time. """
         params = {}
         if min_lon or min_lat or max_lon or max_lat:
             params["bbox"] = ",".join([str(min_lon),str(min_lat),str(max_lon),str(max_lat)])
@@ -454,28 +696,58 @@ class OsmApi(object):
             params["user"] = userid
         if username:
             params["display_name"] = username
-        if closed_after and not created_before:
-            params["time"] = closed_after
-        if created_before:
-            if not closed_after:
-                closed_after = "1970-01-01T00:00:00Z"
-            params["time"] = closed_after + "," + created_before
         if only_open:
             params["open"] = 1
         if only_closed:
             params["closed"] = 1
-            
-        if params:
-            uri += "?" + urllib.urlencode(params)
-                
-        data = self._get(uri)
-        data = xml.dom.minidom.parseString(data)
-        data = data.getElementsByTagName("osm")[0].getElementsByTagName("changeset")
-        result = {}
-        for curChangeset in data:
-            tmpCS = self._DomParseChangeset(curChangeset)
-            result[tmpCS["id"]] = tmpCS
-        return result
+        return params
+
+    def _ChangesetsWindows(self, closed_after, created_before, window):
+        """ Returns the (created_after, created_before) windows of window seconds of creation time, newest first, the oldest one without lower limit. """
+        start = _ParseTime(closed_after)
+        end = _ParseTime(created_before)
+        windows = []
+        while end - window > start:
+            windows.append((time.strftime(_TimeFormat, time.gmtime(end - window)), time.strftime(_TimeFormat, time.gmtime(end))))
+            end -= window
+        windows.append((None, time.strftime(_TimeFormat, time.gmtime(end))))
+        return windows
+
+    def _ChangesetsPages(self, params, closed_after, created_before, created_after):
+        """ Yields lists of the changesets closed after closed_after and created between created_after (None: any time) and created_before, newest first, a page at a time. """
+        seen = set()
+        while created_before:
+            data = self._get("/api/0.6/changesets?" + urllib.urlencode(dict(params, time = closed_after + "," + created_before)))
+            result, created_before = self._ChangesetsPage(data, created_before, created_after, seen)
+            if result:
+                yield result
+
+    def _ChangesetsPage(self, data, created_before, created_after, seen):
+        """ Returns the changesets of the page in data not yielded yet, newest first, and the created_before of the next page (None after the last one). seen holds the ids already yielded created in the second before created_before, it's updated for the next page. """
+        page = self._ParseElements(data, u"changeset")
+        page.sort(key = lambda x: x.get(u"created_at"), reverse = True)
+        result = []
+        older = False
+        for changeset in page:
+            if created_after and changeset[u"created_at"] < created_after:
+                older = True
+                break
+            if changeset[u"id"] not in seen:
+                result.append(changeset)
+        if older or len(page) < self.ChangesetsPage:
+            return result, None
+        # The next page starts with the second of the last changeset, as
+        # times have one second precision, the ones already yielded are skipped
+        last = page[-1][u"created_at"]
+        before = time.strftime(_TimeFormat, time.gmtime(_ParseTime(last) + 1))
+        if not result:
+            # A full page created in the same second, the rest of it can't be asked for
+            warnings.warn("More than %d changesets created at %s, some are missing" % (self.ChangesetsPage, last))
+            before = last
+        if before <> created_before:
+            seen.clear()
+        seen.update([x[u"id"] for x in page if x[u"created_at"] == last])
+        return result, before
     
     #######################################################################
     # Other                                                               #
@@ -487,12 +759,85 @@ class OsmApi(object):
         data = self._get(uri)
         return self.ParseOsm(data)
 
+    def MapIter(self, min_lon, min_lat, max_lon, max_lat):
+        """ Download data in bounding box. Yields dict {type: node|way|relation, data: {}} while parsing. """
+        uri = "/api/0.6/map?bbox=%f,%f,%f,%f"%(min_lon, min_lat, max_lon, max_lat)
+        data = self._get(uri)
+        return self.ParseOsmIter(data)
+
+    def MapTiled(self, min_lon, min_lat, max_lon, max_lat, maxarea = 0.25):
+        """ Download data in a bounding box of any size. Returns list of dict {type: node|way|relation, data: {}}. """
+        return list(self.MapTiledIter(min_lon, min_lat, max_lon, max_lat, maxarea))
+
+    def MapTiledIter(self, min_lon, min_lat, max_lon, max_lat, maxarea = 0.25):
+        """ Download data in a bounding box of any size, as a quadtree of tiles of at most maxarea square degrees fetched in parallel. Tiles refused by the server are split again. Yields dict {type: node|way|relation, data: {}} once per element. """
+        yielded = set()
+        todo = self._SplitBbox((min_lon, min_lat, max_lon, max_lat), maxarea)
+        while todo:
+            refused = []
+            for bbox, data in zip(todo, self._ParallelMap(self._MapTile, todo)):
+                if data is None:
+                    refused.extend(self._QuarterBbox(bbox))
+                    continue
+                for item in data:
+                    key = (item["type"], item["data"]["id"])
+                    if key in yielded:
+                        continue
+                    yielded.add(key)
+                    yield item
+            todo = refused
+
+    def _MapTile(self, bbox):
+        """ Returns Map(*bbox) or None if the server refuses the tile as too large. """
+        try:
+            return self.Map(*bbox)
+        except ApiError, e:
+            # 400: too many nodes or area too large
+            if e.status <> 400 or bbox[2] - bbox[0] < 0.0001:
+                raise
+            return None
+
+    def _QuarterBbox(self, bbox):
+        """ Returns the four quarters of bbox. """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        mid_lon = (min_lon + max_lon) / 2.0
+        mid_lat = (min_lat + max_lat) / 2.0
+        return [(min_lon, min_lat, mid_lon, mid_lat), (mid_lon, min_lat, max_lon, mid_lat),
+                (min_lon, mid_lat, mid_lon, max_lat), (mid_lon, mid_lat, max_lon, max_lat)]
+
+    def _SplitBbox(self, bbox, maxarea):
+        """ Returns the quadtree tiles of bbox with an area of at most maxarea. """
+        result = []
+        todo = [bbox]
+        while todo:
+            bbox = todo.pop()
+            if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) <= maxarea:
+                result.append(bbox)
+            else:
+                todo.extend(self._QuarterBbox(bbox))
+        return result
+
+    def RetryStats(self):
+        """ Returns dict(retries, rejected, budget, open) of the retry policy. """
+        return self._retry.stats()
+
+    # Most changesets returned by a /changesets request
+    ChangesetsPage = 100
+
+    def ConnectionStats(self):
+        """ Returns dict(host: dict(requests, created, reused, discarded)) of the http connections. """
+        with self._poolslock:
+            return dict([(host, pool.stats()) for host, pool in self._pools.items()])
+
     #######################################################################
     # Data parser                                                         #
     #######################################################################
     
     def ParseOsm(self, data):
         """ Parse osm data. Returns list of dict {type: node|way|relation, data: {}}. """
+        start = time.time()
+        if self._parser == "stream":
+            return self._Parsed(u"osm", start, list(self.ParseOsmIter(data)))
         data = xml.dom.minidom.parseString(data)
         data = data.getElementsByTagName("osm")[0]
         result = []
@@ -503,10 +848,13 @@ class OsmApi(object):
                 result.append({u"type": elem.nodeName, u"data": self._DomParseWay(elem)})                        
             elif elem.nodeName == u"relation":
                 result.append({u"type": elem.nodeName, u"data": self._DomParseRelation(elem)})
-        return result    
+        return self._Parsed(u"osm", start, result)
 
     def ParseOsc(self, data):
         """ Parse osc data. Returns list of dict {type: node|way|relation, action: create|delete|modify, data: {}}. """
+        start = time.time()
+        if self._parser == "stream":
+            return self._Parsed(u"osc", start, list(self.ParseOscIter(data)))
         data = xml.dom.minidom.parseString(data)
         data = data.getElementsByTagName("osmChange")[0]
         result = []
@@ -519,6 +867,42 @@ class OsmApi(object):
                     result.append({u"action":action.nodeName, u"type": elem.nodeName, u"data": self._DomParseWay(elem)})                        
                 elif elem.nodeName == u"relation":
                     result.append({u"action":action.nodeName, u"type": elem.nodeName, u"data": self._DomParseRelation(elem)})
+        return self._Parsed(u"osc", start, result)
+
+    def ParseOsmIter(self, data):
+        """ Parse osm data (string or file object) incrementally. Yields dict {type: node|way|relation, data: {}}. """
+        for parent, elem in self._EtIterElements(data, 1):
+            if elem.tag in ("node", "way", "relation"):
+                yield {u"type": unicode(elem.tag), u"data": self._EtParse(elem)}
+
+    def ParseOscIter(self, data):
+        """ Parse osc data (string or file object) incrementally. Yields dict {type: node|way|relation, action: create|delete|modify, data: {}}. """
+        for parent, elem in self._EtIterElements(data, 2):
+            if elem.tag in ("node", "way", "relation"):
+                yield {u"action": unicode(parent), u"type": unicode(elem.tag), u"data": self._EtParse(elem)}
+
+    def _ParseElements(self, data, OsmType):
+        """ Returns the list of parsed OsmType elements of an osm document. """
+        start = time.time()
+        return self._Parsed(OsmType, start, self._ParseElementList(data, OsmType))
+
+    def _ParseElementList(self, data, OsmType):
+        if self._parser == "stream":
+            return [self._EtParse(elem) for parent, elem in self._EtIterElements(data, 1) if elem.tag == OsmType]
+        data = xml.dom.minidom.parseString(data)
+        data = data.getElementsByTagName("osm")[0].getElementsByTagName(OsmType)
+        if OsmType == u"node":
+            return [self._DomParseNode(elem) for elem in data]
+        elif OsmType == u"way":
+            return [self._DomParseWay(elem) for elem in data]
+        elif OsmType == u"relation":
+            return [self._DomParseRelation(elem) for elem in data]
+        return [self._DomParseChangeset(elem) for elem in data]
+
+    def _Parsed(self, kind, start, result):
+        """ Reports the parsing of result, started at start, to the instrument. Returns result. """
+        if self._instrument is not None:
+            self._instrument.parse(kind, time.time() - start, len(result))
         return result
 
     #######################################################################
@@ -580,42 +964,90 @@ class OsmApi(object):
             if len(path2) > 50:
                 path2 = path2[:50]+"[...]"
             print >>sys.stderr, "%s %s %s"%(time.strftime("%Y-%m-%d %H:%M:%S"),cmd,path2)
-        self._conn.putrequest(cmd, path)
-        self._conn.putheader('User-Agent', self._created_by)
-        if auth:
-            self._conn.putheader('Authorization', 'Basic ' + base64.encodestring(self._username + ':' + self._password).strip())
-        if send <> None:
-            self._conn.putheader('Content-Length', len(send))
-        self._conn.endheaders()
-        if send:
-            self._conn.send(send)
-        response = self._conn.getresponse()
+        start = time.time()
+        pool = self._GetPool(self._api)
+        conn, reused = pool.get()
+        try:
+            try:
+                response = self._http_send(conn, cmd, path, auth, send)
+            except (socket.error, httplib.BadStatusLine), e:
+                # A kept alive connection the server closed meanwhile fails before
+                # any answer, the request wasn't processed and is sent once again
+                if not reused or not _Closed(e):
+                    raise
+                pool.discard(conn)
+                conn = pool.connect()
+                response = self._http_send(conn, cmd, path, auth, send)
+            payload = response.read()
+        except:
+            pool.discard(conn)
+            if self._instrument is not None:
+                self._instrument.request(cmd, path, None, time.time() - start, 0)
+            raise
+        if response.will_close:
+            pool.discard(conn)
+        else:
+            pool.put(conn)
+        size = len(payload)
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            payload = zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+        if self._instrument is not None:
+            self._instrument.request(cmd, path, response.status, time.time() - start, size)
         if response.status <> 200:
-            payload = response.read().strip()
+            payload = payload.strip()
             if response.status == 410:
                 return None
-            raise ApiError(response.status, response.reason, payload)
+            raise ApiError(response.status, response.reason, payload, dict(response.getheaders()))
         if self._debug:
             print >>sys.stderr, "%s %s %s done"%(time.strftime("%Y-%m-%d %H:%M:%S"),cmd,path2)
-        return response.read()
+        return payload
     
+    def _http_send(self, conn, cmd, path, auth, send):
+        """ Sends the request on conn, returns the httplib response. """
+        conn.putrequest(cmd, path, skip_accept_encoding = True)
+        conn.putheader('User-Agent', self._created_by)
+        if self._gzip:
+            conn.putheader('Accept-Encoding', 'gzip')
+        if auth:
+            conn.putheader('Authorization', 'Basic ' + base64.encodestring(self._username + ':' + self._password).strip())
+        if send <> None:
+            conn.putheader('Content-Length', len(send))
+        conn.endheaders()
+        if send:
+            conn.send(send)
+        return conn.getresponse()
+
     def _http(self, cmd, path, auth, send):
-        i = 0
+        attempt = 0
         while True:
-            i += 1
+            self._retry.before(self._api)
             try:
-                return self._http_request(cmd, path, auth, send)
-            except ApiError, e:
-                if e.status >= 500:
-                    if i == 5: raise
-                    if i <> 1: time.sleep(5)
-                    self._conn = httplib.HTTPConnection(self._api, 80)
-                else: raise
-            except Exception:
-                if i == 5: raise
-                if i <> 1: time.sleep(5)
-                self._conn = httplib.HTTPConnection(self._api, 80)
+                result = self._http_request(cmd, path, auth, send)
+            except Exception, e:
+                error = sys.exc_info()
+                if self._retry.servererror(e):
+                    self._retry.failure(self._api)
+                else:
+                    self._retry.success(self._api)
+                delay = self._retry.retry(cmd, attempt, e)
+                if delay is None: raise error[0], error[1], error[2]
+                if self._instrument is not None:
+                    self._instrument.retry(cmd, path, attempt, delay, e)
+                if self._debug:
+                    print >>sys.stderr, "%s %s %s retry in %.1fs: %s"%(time.strftime("%Y-%m-%d %H:%M:%S"),cmd,path[:50],delay,e)
+                self._retry.sleep(delay)
+                attempt += 1
+                continue
+            self._retry.success(self._api)
+            return result
     
+    def _GetPool(self, host):
+        """ Returns the ConnectionPool for host. """
+        with self._poolslock:
+            if host not in self._pools:
+                self._pools[host] = ConnectionPool(host, secure = self._https, maxsize = self._poolsize)
+            return self._pools[host]
+
     def _get(self, path):
         return self._http('GET', path, False, None)
 
@@ -625,6 +1057,107 @@ class OsmApi(object):
     def _delete(self, path, data):
         return self._http('DELETE', path, True, data)
     
+    #######################################################################
+    # Internal multi fetch function                                       #
+    #######################################################################
+
+    def _SplitUri(self, prefix, IdList):
+        """ Returns the list of uris prefix+ids needed for IdList, each one shorter than self._maxurllen. """
+        result = []
+        chunk = []
+        length = len(prefix)
+        for x in IdList:
+            x = str(x)
+            if chunk and length + len(x) > self._maxurllen:
+                result.append(prefix + ",".join(chunk))
+                chunk = []
+                length = len(prefix)
+            chunk.append(x)
+            length += len(x) + 1
+        if chunk:
+            result.append(prefix + ",".join(chunk))
+        return result
+
+    def _GetMulti(self, prefix, IdList, OsmType):
+        """ Returns dict(Id: Data) of OsmType for IdList, fetched with uris of at most self._maxurllen. """
+        result = {}
+        fetch = lambda uri: self._ParseElements(self._get(uri), OsmType)
+        for data in self._ParallelMap(fetch, self._SplitUri(prefix, IdList)):
+            for elem in data:
+                result[elem[u"id"]] = elem
+        return result
+
+    def _ParallelMap(self, func, items):
+        """ Returns [func(item) for item in items], calling func from up to self._threads threads. """
+        items = list(items)
+        if self._threads <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        results = [None] * len(items)
+        errors = []
+        todo = Queue.Queue()
+        for i in range(len(items)):
+            todo.put(i)
+        def worker():
+            while not errors:
+                try:
+                    i = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = func(items[i])
+                except Exception:
+                    errors.append(sys.exc_info())
+        workers = [threading.Thread(target = worker) for i in range(min(self._threads, len(items)))]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def _ParallelIter(self, funcs, queuesize = 2):
+        """ Yields the items of the iterators returned by funcs, in order, consuming up to self._threads of them at once from threads. Each thread keeps at most queuesize items ahead. """
+        stop = threading.Event()
+        end = object()
+        def put(queue, value):
+            # Give up once the consumer is gone
+            while not stop.is_set():
+                try:
+                    queue.put(value, timeout = 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        def worker(func, queue):
+            try:
+                for item in func():
+                    if not put(queue, (None, item)):
+                        return
+                put(queue, (None, end))
+            except Exception:
+                put(queue, (sys.exc_info(), None))
+        running = []
+        todo = list(funcs)
+        try:
+            while todo or running:
+                while todo and len(running) < self._threads:
+                    queue = Queue.Queue(queuesize)
+                    thread = threading.Thread(target = worker, args = (todo.pop(0), queue))
+                    thread.daemon = True
+                    thread.start()
+                    running.append(queue)
+                error, item = running[0].get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if item is end:
+                    running.pop(0)
+                    continue
+                yield item
+        finally:
+            stop.set()
+
     #######################################################################
     # Internal dom function                                               #
     #######################################################################
@@ -694,53 +1227,134 @@ class OsmApi(object):
         result[u"tag"] = self._DomGetTag(DomElement)
         return result
 
+    #######################################################################
+    # Internal iterparse function                                         #
+    #######################################################################
+
+    def _EtIterElements(self, data, depth):
+        """ Yields (parent tag, element) for each complete element at depth below the root. Elements are freed once consumed. data can be a string or a file object. """
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if not hasattr(data, "read"):
+            data = StringIO(data)
+        stack = []
+        for event, elem in ElementTree.iterparse(data, ("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                continue
+            stack.pop()
+            if len(stack) == depth:
+                yield stack[-1].tag, elem
+                elem.clear()
+                # Drop the already consumed siblings kept by the parent
+                stack[-1].clear()
+
+    def _EtGetAttributes(self, EtElement):
+        """ Returns a formated dictionnary of attributes of an EtElement. """
+        result = {}
+        for k, v in EtElement.attrib.items():
+            if k == "uid"         : v = int(v)
+            elif k == "changeset" : v = int(v)
+            elif k == "version"   : v = int(v)
+            elif k == "id"        : v = int(v)
+            elif k == "lat"       : v = float(v)
+            elif k == "lon"       : v = float(v)
+            elif k == "open"      : v = v=="true"
+            elif k == "visible"   : v = v=="true"
+            elif k == "ref"       : v = int(v)
+            else                  : v = unicode(v)
+            result[unicode(k)] = v
+        return result
+
+    def _EtParse(self, EtElement):
+        """ Returns NodeData, WayData, RelationData or ChangesetData for the element. """
+        result = self._EtGetAttributes(EtElement)
+        tags = {}
+        nds = []
+        members = []
+        for child in EtElement:
+            if child.tag == "tag":
+                tags[unicode(child.get("k"))] = unicode(child.get("v"))
+            elif child.tag == "nd":
+                nds.append(int(child.get("ref")))
+            elif child.tag == "member":
+                members.append(self._EtGetAttributes(child))
+        result[u"tag"] = tags
+        if EtElement.tag == "way":
+            result[u"nd"] = nds
+        elif EtElement.tag == "relation":
+            result[u"member"] = members
+        return result
+
     #######################################################################
     # Internal xml builder                                                #
     #######################################################################
 
     def _XmlBuild(self, ElementType, ElementData, WithHeaders = True):
-
-        xml  = u""
+        """ Returns the utf-8 encoded xml of an element. """
+        chunks = []
         if WithHeaders:
-            xml += u"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
-            xml += u"<osm version=\"0.6\" generator=\"" + self._created_by + "\">\n"
+            chunks.append("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+            chunks.append((u"<osm version=\"0.6\" generator=\"" + self._created_by + u"\">\n").encode("utf-8"))
+        self._XmlWrite(chunks.append, ElementType, ElementData)
+        if WithHeaders:
+            chunks.append("</osm>\n")
+        return "".join(chunks)
+
+    def _XmlWrite(self, write, ElementType, ElementData):
+        """ Writes the xml of an element as utf-8 chunks, calling write(chunk). """
+        encode = self._XmlEncode
 
         # <element attr="val">
-        xml += u"  <" + ElementType
+        line = u"  <" + ElementType
         if u"id" in ElementData:
-            xml += u" id=\"" + str(ElementData[u"id"]) + u"\""        
+            line += u" id=\"%s\"" % ElementData[u"id"]
         if u"lat" in ElementData:
-            xml += u" lat=\"" + str(ElementData[u"lat"]) + u"\""        
+            line += u" lat=\"%s\"" % ElementData[u"lat"]
         if u"lon" in ElementData:
-            xml += u" lon=\"" + str(ElementData[u"lon"]) + u"\""
+            line += u" lon=\"%s\"" % ElementData[u"lon"]
         if u"version" in ElementData:
-            xml += u" version=\"" + str(ElementData[u"version"]) + u"\""
-        xml += u" visible=\"" + str(ElementData.get(u"visible", True)).lower() + u"\""
+            line += u" version=\"%s\"" % ElementData[u"version"]
+        line += u" visible=\"" + str(ElementData.get(u"visible", True)).lower() + u"\""
         if ElementType in [u"node", u"way", u"relation"]:
-            xml += u" changeset=\"" + str(self._CurrentChangesetId) + u"\""
-        xml += u">\n"
+            line += u" changeset=\"%s\"" % self._CurrentChangesetId
+        write((line + u">\n").encode("utf-8"))
 
         # <tag... />
-        for k, v in ElementData.get(u"tag", {}).items():
-            xml += u"    <tag k=\""+self._XmlEncode(k)+u"\" v=\""+self._XmlEncode(v)+u"\"/>\n"
+        for k, v in ElementData.get(u"tag", {}).iteritems():
+            write((u"    <tag k=\"%s\" v=\"%s\"/>\n" % (encode(k), encode(v))).encode("utf-8"))
 
         # <member... />
         for member in ElementData.get(u"member", []):
-            xml += u"    <member type=\""+member[u"type"]+"\" ref=\""+str(member[u"ref"])+u"\" role=\""+self._XmlEncode(member[u"role"])+"\"/>\n"
+            write((u"    <member type=\"%s\" ref=\"%s\" role=\"%s\"/>\n" % (member[u"type"], member[u"ref"], encode(member[u"role"]))).encode("utf-8"))
 
         # <nd... />
-        for ref in ElementData.get(u"nd", []):
-            xml += u"    <nd ref=\""+str(ref)+u"\"/>\n"
+        nds = ElementData.get(u"nd")
+        if nds:
+            write("".join(["    <nd ref=\"%s\"/>\n" % ref for ref in nds]))
 
         # </element>
-        xml += u"  </" + ElementType + u">\n"
-        
-        if WithHeaders:
-            xml += u"</osm>\n"
+        write("  </" + str(ElementType) + ">\n")
 
-        return xml.encode("utf8")
+    def _OscWrite(self, write, ChangesData):
+        """ Writes an osmChange document as utf-8 chunks, calling write(chunk). Consecutive changes with the same action share a block. """
+        write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+        write((u"<osmChange version=\"0.6\" generator=\"" + self._created_by + u"\">\n").encode("utf-8"))
+        action = None
+        for change in ChangesData:
+            if change["action"] <> action:
+                if action:
+                    write("</" + str(action) + ">\n")
+                action = change["action"]
+                write("<" + str(action) + ">\n")
+            self._XmlWrite(write, change["type"], change["data"])
+        if action:
+            write("</" + str(action) + ">\n")
+        write("</osmChange>")
 
     def _XmlEncode(self, text):
+        if not _XmlSpecial.search(text):
+            return text
         return text.replace("&", "&amp;").replace("\"", "&quot;").replace("<","&lt;").replace(">","&gt;")
 
 ## End of main class                                                     ##
@@ -0,0 +1,502 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Asynchronous OsmApi on top of twisted
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import time
+import base64
+import urllib
+from cStringIO import StringIO
+from twisted.internet import reactor, defer, task, error
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, ContentDecoderAgent, GzipDecoder, \
+                                HTTPConnectionPool, FileBodyProducer, readBody, \
+                                ResponseFailed, ResponseNeverReceived
+from twisted.web.http_headers import Headers
+from OsmApi import OsmApi, ApiError, RetryPolicy, _TimeFormat
+
+#Network errors worth a retry
+NETWORK_ERRORS = (error.ConnectError, error.ConnectionLost, error.TimeoutError,
+                    ResponseFailed, ResponseNeverReceived)
+
+def _gather(deferreds):
+    """Like defer.gatherResults but failing with the first error itself."""
+    d = defer.gatherResults(deferreds, consumeErrors = True)
+    return d.addErrback(lambda failure: failure.value.subFailure)
+
+
+class Throttle(object):
+    """Spaces calls to at most rate per second, None means no limit."""
+
+    def __init__(self, rate = None, clock = reactor):
+        self.rate = rate
+        self.clock = clock
+        self.next_slot = 0
+
+    def run(self, func, *args, **kwargs):
+        """Call func when its slot comes, returns a Deferred of its result."""
+        if not self.rate:
+            return defer.maybeDeferred(func, *args, **kwargs)
+        now = self.clock.seconds()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + 1.0 / self.rate
+        return task.deferLater(self.clock, slot - now, func, *args, **kwargs)
+
+
+class OsmAsync(OsmApi):
+    """OsmApi whose methods return Deferreds instead of blocking.
+
+    Up to concurrency requests are kept in flight over persistent
+    connections and at most rate requests per second are started, so many
+    calls can be issued at once and gathered:
+
+        defer.gatherResults([ api.NodeHistory(i) for i in ids ])
+
+    Parsing is shared with OsmApi. The *Iter methods return a Deferred of
+    the iterator, fired once everything was downloaded. Automatic
+    changesets aren't available."""
+
+    def __init__(self, *args, **kwargs):
+        concurrency = kwargs.pop('concurrency', 16)
+        rate = kwargs.pop('rate', None)
+        kwargs.setdefault('retry', RetryPolicy(networkerrors = NETWORK_ERRORS))
+        super(OsmAsync, self).__init__(*args, **kwargs)
+        if self._changesetauto:
+            raise ValueError('changesetauto is not supported by OsmAsync')
+
+        self._url = ('https://' if self._https else 'http://') + self._api
+        self._pool = HTTPConnectionPool(reactor, persistent = True)
+        self._pool.maxPersistentPerHost = concurrency
+        self._agent = Agent(reactor, pool = self._pool)
+        if self._gzip:
+            self._agent = ContentDecoderAgent(self._agent,
+                                                [('gzip', GzipDecoder)])
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._throttle = Throttle(rate)
+
+    def close(self):
+        """Close the idle connections, returns a Deferred."""
+        super(OsmAsync, self).close()
+        return self._pool.closeCachedConnections()
+
+    #######################################################################
+    # Capabilities                                                        #
+    #######################################################################
+
+    @defer.inlineCallbacks
+    def Capabilities(self):
+        """ Returns a Deferred of ApiCapabilities. """
+        data = yield self._get("/api/capabilities")
+        result = {}
+        for parent, elem in self._EtIterElements(data, 2):
+            result[elem.tag] = {}
+            for k, v in elem.attrib.items():
+                try:
+                    result[elem.tag][k] = float(v)
+                except ValueError:
+                    result[elem.tag][k] = v
+        defer.returnValue(result)
+
+    #######################################################################
+    # Node                                                                #
+    #######################################################################
+
+    def NodeGet(self, NodeId, NodeVersion = -1):
+        uri = "/api/0.6/node/"+str(NodeId)
+        if NodeVersion <> -1: uri += "/"+str(NodeVersion)
+        return self._GetOne(uri, u"node")
+
+    def NodeCreate(self, NodeData):
+        return self._do("create", "node", NodeData)
+
+    def NodeUpdate(self, NodeData):
+        return self._do("modify", "node", NodeData)
+
+    def NodeDelete(self, NodeData):
+        return self._do("delete", "node", NodeData)
+
+    def NodeHistory(self, NodeId):
+        return self._GetHistory("/api/0.6/node/"+str(NodeId)+"/history", u"node")
+
+    def NodeWays(self, NodeId):
+        return self._GetList("/api/0.6/node/%d/ways"%NodeId, u"way")
+
+    def NodeRelations(self, NodeId):
+        return self._GetList("/api/0.6/node/%d/relations"%NodeId, u"relation")
+
+    def NodesGet(self, NodeIdList):
+        return self._GetMulti("/api/0.6/nodes?nodes=", NodeIdList, u"node")
+
+    #######################################################################
+    # Way                                                                 #
+    #######################################################################
+
+    def WayGet(self, WayId, WayVersion = -1):
+        uri = "/api/0.6/way/"+str(WayId)
+        if WayVersion <> -1: uri += "/"+str(WayVersion)
+        return self._GetOne(uri, u"way")
+
+    def WayCreate(self, WayData):
+        return self._do("create", "way", WayData)
+
+    def WayUpdate(self, WayData):
+        return self._do("modify", "way", WayData)
+
+    def WayDelete(self, WayData):
+        return self._do("delete", "way", WayData)
+
+    def WayHistory(self, WayId):
+        return self._GetHistory("/api/0.6/way/"+str(WayId)+"/history", u"way")
+
+    def WayRelations(self, WayId):
+        return self._GetList("/api/0.6/way/%d/relations"%WayId, u"relation")
+
+    def WayFull(self, WayId):
+        return self._get("/api/0.6/way/"+str(WayId)+"/full").addCallback(self.ParseOsm)
+
+    def WaysGet(self, WayIdList):
+        return self._GetMulti("/api/0.6/ways?ways=", WayIdList, u"way")
+
+    #######################################################################
+    # Relation                                                            #
+    #######################################################################
+
+    def RelationGet(self, RelationId, RelationVersion = -1):
+        uri = "/api/0.6/relation/"+str(RelationId)
+        if RelationVersion <> -1: uri += "/"+str(RelationVersion)
+        return self._GetOne(uri, u"relation")
+
+    def RelationCreate(self, RelationData):
+        return self._do("create", "relation", RelationData)
+
+    def RelationUpdate(self, RelationData):
+        return self._do("modify", "relation", RelationData)
+
+    def RelationDelete(self, RelationData):
+        return self._do("delete", "relation", RelationData)
+
+    def RelationHistory(self, RelationId):
+        return self._GetHistory("/api/0.6/relation/"+str(RelationId)+"/history", u"relation")
+
+    def RelationRelations(self, RelationId):
+        return self._GetList("/api/0.6/relation/%d/relations"%RelationId, u"relation")
+
+    @defer.inlineCallbacks
+    def RelationFullRecur(self, RelationId):
+        """ Returns a Deferred of the full data for relation RelationId and its sub relations, every level fetched concurrently. """
+        result = []
+        yielded = set()
+        done = set([RelationId])
+        todo = [RelationId]
+        while todo:
+            levels = yield _gather([self.RelationFull(x) for x in todo])
+            frontier = []
+            for temp in levels:
+                for item in temp:
+                    key = (item["type"], item["data"]["id"], item["data"].get("version"))
+                    if key in yielded:
+                        continue
+                    yielded.add(key)
+                    if item["type"] == "relation" and item["data"]["id"] not in done:
+                        done.add(item["data"]["id"])
+                        frontier.append(item["data"]["id"])
+                    result.append(item)
+            todo = frontier
+        defer.returnValue(result)
+
+    def RelationFullRecurIter(self, RelationId):
+        """ Returns a Deferred of an iterator over the RelationFullRecur elements. """
+        return self.RelationFullRecur(RelationId).addCallback(iter)
+
+    def RelationFull(self, RelationId):
+        return self._get("/api/0.6/relation/"+str(RelationId)+"/full").addCallback(self.ParseOsm)
+
+    def RelationsGet(self, RelationIdList):
+        return self._GetMulti("/api/0.6/relations?relations=", RelationIdList, u"relation")
+
+    #######################################################################
+    # Changeset                                                           #
+    #######################################################################
+
+    def ChangesetGet(self, ChangesetId):
+        return self._GetOne("/api/0.6/changeset/"+str(ChangesetId), u"changeset")
+
+    @defer.inlineCallbacks
+    def ChangesetUpdate(self, ChangesetTags = {}):
+        if self._CurrentChangesetId == -1:
+            raise Exception, "No changeset currently opened"
+        if u"created_by" not in ChangesetTags:
+            ChangesetTags[u"created_by"] = self._created_by
+        yield self._put("/api/0.6/changeset/"+str(self._CurrentChangesetId), self._XmlBuild("changeset", {u"tag": ChangesetTags}))
+        defer.returnValue(self._CurrentChangesetId)
+
+    @defer.inlineCallbacks
+    def ChangesetCreate(self, ChangesetTags = {}):
+        if self._CurrentChangesetId:
+            raise Exception, "Changeset alreadey opened"
+        if u"created_by" not in ChangesetTags:
+            ChangesetTags[u"created_by"] = self._created_by
+        result = yield self._put("/api/0.6/changeset/create", self._XmlBuild("changeset", {u"tag": ChangesetTags}))
+        self._CurrentChangesetId = int(result)
+        defer.returnValue(self._CurrentChangesetId)
+
+    @defer.inlineCallbacks
+    def ChangesetClose(self):
+        if not self._CurrentChangesetId:
+            raise Exception, "No changeset currently opened"
+        yield self._put("/api/0.6/changeset/"+str(self._CurrentChangesetId)+"/close", u"")
+        CurrentChangesetId = self._CurrentChangesetId
+        self._CurrentChangesetId = 0
+        defer.returnValue(CurrentChangesetId)
+
+    @defer.inlineCallbacks
+    def ChangesetUpload(self, ChangesData):
+        for change in ChangesData:
+            change["data"]["changeset"] = self._CurrentChangesetId
+        data = []
+        self._OscWrite(data.append, ChangesData)
+        data = yield self._http("POST", "/api/0.6/changeset/"+str(self._CurrentChangesetId)+"/upload", True, "".join(data))
+        data = [elem.get("new_id") for parent, elem in self._EtIterElements(data, 1)]
+        for i in range(len(ChangesData)):
+            if ChangesData[i]["action"] == "delete":
+                ChangesData[i]["data"].pop("version")
+            else:
+                ChangesData[i]["data"]["version"] = int(data[i])
+        defer.returnValue(ChangesData)
+
+    def ChangesetDownload(self, ChangesetId):
+        return self._get("/api/0.6/changeset/"+str(ChangesetId)+"/download").addCallback(self.ParseOsc)
+
+    @defer.inlineCallbacks
+    def ChangesetsGet(self, min_lon=None, min_lat=None, max_lon=None, max_lat=None,
+                      userid=None, username=None,
+                      closed_after=None, created_before=None,
+                      only_open=False, only_closed=False):
+        uri = self._ChangesetsUri(min_lon, min_lat, max_lon, max_lat, userid, username, closed_after, created_before, only_open, only_closed)
+        data = yield self._get(uri)
+        result = {}
+        for tmpCS in self._ParseElements(data, u"changeset"):
+            result[tmpCS["id"]] = tmpCS
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def ChangesetsGetIter(self, min_lon=None, min_lat=None, max_lon=None, max_lat=None,
+                      userid=None, username=None,
+                      closed_after=None, created_before=None,
+                      only_open=False, only_closed=False, window=None,
+                      callback=None):
+        """ Returns a Deferred of an iterator over the changesets matching all criteria, newest first, paged like OsmApi.ChangesetsGetIter. The iterator is built when the last page arrives, so it holds all of them. With callback, every page (a list of changesets) is passed to it in order as soon as it arrives and the Deferred fires with None, holding only the pages of the windows fetched ahead. With window (seconds) and closed_after, up to self._threads windows are paged concurrently. """
+        if window and not closed_after:
+            raise ValueError("window needs closed_after")
+        params = self._ChangesetsParams(min_lon, min_lat, max_lon, max_lat, userid, username, only_open, only_closed)
+        closed_after = closed_after or "1970-01-01T00:00:00Z"
+        created_before = created_before or time.strftime(_TimeFormat, time.gmtime(time.time() + 1))
+        windows = [(None, created_before)]
+        if window:
+            windows = self._ChangesetsWindows(closed_after, created_before, window)
+
+        result = None
+        if callback is None:
+            result = []
+            callback = result.extend
+        # Pages of the windows after the oldest unfinished one wait in pending
+        pending = [[] for w in windows]
+        done = [False] * len(windows)
+        head = [0]
+        def deliver():
+            while head[0] < len(windows):
+                pages, pending[head[0]] = pending[head[0]], []
+                for page in pages:
+                    callback(page)
+                if not done[head[0]]:
+                    return
+                head[0] += 1
+        def arrived(page, i):
+            pending[i].append(page)
+            deliver()
+        def finished(ignored, i):
+            done[i] = True
+            deliver()
+        running = defer.DeferredSemaphore(max(self._threads, 1))
+        yield _gather([running.run(self._ChangesetsPages, params, closed_after, upper, lower, lambda page, i = i: arrived(page, i)).addCallback(finished, i)
+                       for i, (lower, upper) in enumerate(windows)])
+        if result is not None:
+            defer.returnValue(iter(result))
+
+    @defer.inlineCallbacks
+    def _ChangesetsPages(self, params, closed_after, created_before, created_after, callback):
+        """ Calls callback with the pages of OsmApi._ChangesetsPages as they arrive, returns a Deferred fired after the last one. """
+        seen = set()
+        while created_before:
+            data = yield self._get("/api/0.6/changesets?" + urllib.urlencode(dict(params, time = closed_after + "," + created_before)))
+            page, created_before = self._ChangesetsPage(data, created_before, created_after, seen)
+            if page:
+                callback(page)
+
+    #######################################################################
+    # Other                                                               #
+    #######################################################################
+
+    def Map(self, min_lon, min_lat, max_lon, max_lat):
+        uri = "/api/0.6/map?bbox=%f,%f,%f,%f"%(min_lon, min_lat, max_lon, max_lat)
+        return self._get(uri).addCallback(self.ParseOsm)
+
+    @defer.inlineCallbacks
+    def MapTiled(self, min_lon, min_lat, max_lon, max_lat, maxarea = 0.25):
+        """ Returns a Deferred of the data in a bounding box of any size, its tiles fetched concurrently. """
+        result = []
+        yielded = set()
+        todo = self._SplitBbox((min_lon, min_lat, max_lon, max_lat), maxarea)
+        while todo:
+            tiles = yield _gather([self._MapTile(bbox) for bbox in todo])
+            refused = []
+            for bbox, data in zip(todo, tiles):
+                if data is None:
+                    refused.extend(self._QuarterBbox(bbox))
+                    continue
+                for item in data:
+                    key = (item["type"], item["data"]["id"])
+                    if key in yielded:
+                        continue
+                    yielded.add(key)
+                    result.append(item)
+            todo = refused
+        defer.returnValue(result)
+
+    def _MapTile(self, bbox):
+        def refused(failure):
+            failure.trap(ApiError)
+            if failure.value.status <> 400 or bbox[2] - bbox[0] < 0.0001:
+                return failure
+            return None
+        return self.Map(*bbox).addErrback(refused)
+
+    def MapIter(self, min_lon, min_lat, max_lon, max_lat):
+        """ Returns a Deferred of an iterator parsing the downloaded data. """
+        uri = "/api/0.6/map?bbox=%f,%f,%f,%f"%(min_lon, min_lat, max_lon, max_lat)
+        return self._get(uri).addCallback(self.ParseOsmIter)
+
+    def MapTiledIter(self, min_lon, min_lat, max_lon, max_lat, maxarea = 0.25):
+        """ Returns a Deferred of an iterator over the MapTiled elements. """
+        return self.MapTiled(min_lon, min_lat, max_lon, max_lat, maxarea).addCallback(iter)
+
+
+    def ConnectionStats(self):
+        """ Returns dict with the requests running and waiting. """
+        return {"running": self._semaphore.limit - self._semaphore.tokens, "waiting": len(self._semaphore.waiting)}
+
+    #######################################################################
+    # Internal http function                                              #
+    #######################################################################
+
+    @defer.inlineCallbacks
+    def _do_manu(self, action, OsmType, OsmData):
+        if not self._CurrentChangesetId:
+            raise Exception, "You need to open a changeset before uploading data"
+        if u"timestamp" in OsmData:
+            OsmData.pop(u"timestamp")
+        OsmData[u"changeset"] = self._CurrentChangesetId
+        if action == "create":
+            if OsmData.get(u"id", -1) > 0:
+                raise Exception, "This "+OsmType+" already exists"
+            result = yield self._put("/api/0.6/"+OsmType+"/create", self._XmlBuild(OsmType, OsmData))
+            OsmData[u"id"] = int(result.strip())
+            OsmData[u"version"] = 1
+        elif action == "modify":
+            result = yield self._put("/api/0.6/"+OsmType+"/"+str(OsmData[u"id"]), self._XmlBuild(OsmType, OsmData))
+            OsmData[u"version"] = int(result.strip())
+        elif action =="delete":
+            result = yield self._delete("/api/0.6/"+OsmType+"/"+str(OsmData[u"id"]), self._XmlBuild(OsmType, OsmData))
+            OsmData[u"version"] = int(result.strip())
+            OsmData[u"visible"] = False
+        defer.returnValue(OsmData)
+
+    def _http_request(self, cmd, path, auth, send):
+        headers = Headers({"User-Agent": [self._created_by]})
+        if auth:
+            headers.addRawHeader("Authorization", "Basic " + base64.encodestring(self._username + ":" + self._password).strip())
+        body = None
+        if send <> None:
+            if isinstance(send, unicode):
+                send = send.encode("utf-8")
+            body = FileBodyProducer(StringIO(send))
+        start = time.time()
+        d = self._agent.request(cmd, self._url + path, headers, body)
+        def response(response):
+            return readBody(response).addCallback(result, response)
+        def result(payload, response):
+            if self._instrument is not None:
+                self._instrument.request(cmd, path, response.code, time.time() - start, len(payload))
+            if response.code <> 200:
+                if response.code == 410:
+                    return None
+                headers = dict((k.lower(), v[-1]) for k, v in
+                                response.headers.getAllRawHeaders())
+                raise ApiError(response.code, response.phrase, payload.strip(),
+                                headers)
+            return payload
+        def failed(failure):
+            #ApiErrors were recorded with their status by result
+            if self._instrument is not None and not failure.check(ApiError):
+                self._instrument.request(cmd, path, None, time.time() - start, 0)
+            return failure
+        return d.addCallback(response).addErrback(failed)
+
+    @defer.inlineCallbacks
+    def _http(self, cmd, path, auth, send):
+        attempt = 0
+        while True:
+            self._retry.before(self._api)
+            try:
+                result = yield self._semaphore.run(self._throttle.run, self._http_request, cmd, path, auth, send)
+            except Exception, e:
+                failure = Failure()
+                if self._retry.servererror(e):
+                    self._retry.failure(self._api)
+                else:
+                    self._retry.success(self._api)
+                delay = self._retry.retry(cmd, attempt, e)
+                if delay is None:
+                    failure.raiseException()
+                if self._instrument is not None:
+                    self._instrument.retry(cmd, path, attempt, delay, e)
+                yield task.deferLater(reactor, delay, lambda: None)
+                attempt += 1
+                continue
+            self._retry.success(self._api)
+            defer.returnValue(result)
+
+    #######################################################################
+    # Internal fetch functions                                            #
+    #######################################################################
+
+    def _GetOne(self, uri, OsmType):
+        """ Returns a Deferred of the first OsmType element of uri, None if deleted. """
+        def parse(data):
+            if not data: return data
+            return self._ParseElements(data, OsmType)[0]
+        return self._get(uri).addCallback(parse)
+
+    def _GetList(self, uri, OsmType):
+        return self._get(uri).addCallback(self._ParseElements, OsmType)
+
+    def _GetHistory(self, uri, OsmType):
+        def parse(data):
+            result = {}
+            for data in self._ParseElements(data, OsmType):
+                result[data[u"version"]] = data
+            return result
+        return self._get(uri).addCallback(parse)
+
+    @defer.inlineCallbacks
+    def _GetMulti(self, prefix, IdList, OsmType):
+        uris = self._SplitUri(prefix, IdList)
+        chunks = yield _gather([self._GetList(uri, OsmType) for uri in uris])
+        result = {}
+        for data in chunks:
+            for elem in data:
+                result[elem[u"id"]] = elem
+        defer.returnValue(result)
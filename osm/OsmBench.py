@@ -0,0 +1,444 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks of OsmApi parsing, serialization, fetching and caches
+#
+# Usage: OsmBench.py [--sizes 1000,10000,100000] [--only parse_osm_stream,...]
+#                    [--save results.json] [--compare results.json]
+#
+# Every benchmark runs on synthetic data in its own process, so the peak
+# memory reported is its own, and how much it grew while timed. Requests
+# go to a local http server. Benchmarks whose modules can't be imported
+# here (OsmCache needs bsddb, karl PyQt4) are skipped.
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import os
+import sys
+import gc
+import json
+import time
+import gzip
+import random
+import shutil
+import resource
+import tempfile
+import threading
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from optparse import OptionParser
+from OsmApi import OsmApi
+
+#######################################################################
+# Synthetic data                                                      #
+#######################################################################
+
+def make_elements(count, seed = 1):
+    """Return the node, way and relation dicts of a synthetic area with
+    about count elements: 80% nodes, ways of 8 nodes, relations of 10
+    members."""
+    rand = random.Random(seed)
+    nodes = []
+    ways = []
+    relations = []
+    node_count = max(2, count * 8 / 10)
+    for node_id in xrange(1, node_count + 1):
+        tags = {}
+        if node_id % 10 == 0:
+            tags = { u'amenity': u'cafe', u'name': u'Café %d' % node_id }
+        nodes.append({ u'id': node_id, u'lat': rand.uniform(-35, -34),
+                        u'lon': rand.uniform(-59, -58), u'version': 1,
+                        u'changeset': 1, u'uid': 1, u'user': u'bench',
+                        u'visible': True, u'timestamp': u'2010-01-01T00:00:00Z',
+                        u'tag': tags })
+    for way_id in xrange(1, max(1, (count - node_count) * 9 / 10) + 1):
+        start = rand.randint(1, node_count - 1)
+        nds = [ (start + i) % node_count + 1 for i in range(8) ]
+        ways.append({ u'id': way_id, u'version': 1, u'changeset': 1,
+                        u'uid': 1, u'user': u'bench', u'visible': True,
+                        u'timestamp': u'2010-01-01T00:00:00Z', u'nd': nds,
+                        u'tag': { u'highway': u'residential',
+                                u'name': u'Calle %d' % way_id } })
+    for rel_id in xrange(1, max(1, count - node_count - len(ways)) + 1):
+        members = [ { u'type': u'way', u'ref': rand.randint(1, len(ways)),
+                        u'role': u'outer' } for i in range(10) ]
+        relations.append({ u'id': rel_id, u'version': 1, u'changeset': 1,
+                        u'uid': 1, u'user': u'bench', u'visible': True,
+                        u'timestamp': u'2010-01-01T00:00:00Z',
+                        u'member': members,
+                        u'tag': { u'type': u'multipolygon' } })
+    return nodes, ways, relations
+
+def make_changes(count, seed = 1):
+    """osmChange dicts of about count elements."""
+    nodes, ways, relations = make_elements(count, seed)
+    changes = []
+    for osm_type, elements in (('node', nodes), ('way', ways),
+                                ('relation', relations)):
+        for i, data in enumerate(elements):
+            action = ('create', 'modify', 'delete')[i % 3]
+            changes.append({ u'action': action, u'type': osm_type,
+                            u'data': data })
+    return changes
+
+def _attributes(data):
+    return u' '.join(u'%s="%s"' % (key, str(data[key]).lower()
+                    if key == u'visible' else data[key]) for key in
+                    (u'id', u'lat', u'lon', u'version', u'changeset', u'uid',
+                    u'user', u'visible', u'timestamp') if key in data)
+
+def make_osm(count, seed = 1):
+    """.osm document of about count elements, with the attributes the API
+    returns."""
+    out = [u'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n']
+    nodes, ways, relations = make_elements(count, seed)
+    for osm_type, elements in (('node', nodes), ('way', ways),
+                                ('relation', relations)):
+        for data in elements:
+            out.append(u' <%s %s>\n' % (osm_type, _attributes(data)))
+            for ref in data.get(u'nd', ()):
+                out.append(u'  <nd ref="%d"/>\n' % ref)
+            for member in data.get(u'member', ()):
+                out.append(u'  <member type="%(type)s" ref="%(ref)d" '
+                            u'role="%(role)s"/>\n' % member)
+            for item in data[u'tag'].iteritems():
+                out.append(u'  <tag k="%s" v="%s"/>\n' % item)
+            out.append(u' </%s>\n' % osm_type)
+    out.append(u'</osm>\n')
+    return u''.join(out).encode('utf-8')
+
+def make_osc(count, seed = 1):
+    """.osc document of about count elements."""
+    out = []
+    OsmApi()._OscWrite(out.append, make_changes(count, seed))
+    return ''.join(out)
+
+#######################################################################
+# Local API                                                           #
+#######################################################################
+
+class BenchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers node, nodes, way and map requests with synthetic data."""
+    protocol_version = 'HTTP/1.1'
+    node = '<node id="%s" lat="-34.6" lon="-58.4" version="1" ' \
+            'changeset="1" user="bench" uid="1" visible="true" ' \
+            'timestamp="2010-01-01T00:00:00Z"><tag k="name" v="x"/></node>'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path
+        if path.startswith('/api/0.6/nodes?nodes='):
+            ids = path.split('=', 1)[1].split(',')
+            body = ''.join(self.node % node_id for node_id in ids)
+        elif path.startswith('/api/0.6/node/'):
+            body = self.node % path.split('/')[4]
+        elif path.startswith('/api/0.6/map'):
+            body = self.server.osm
+        else:
+            self.send_error(404)
+            return
+        if not body.startswith('<?xml'):
+            body = '<osm version="0.6">' + body + '</osm>'
+
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            compressed = gzip.GzipFile(fileobj = buf, mode = 'w',
+                                        compresslevel = 1)
+            compressed.write(body)
+            compressed.close()
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BenchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+def start_server(osm = ''):
+    """Start the local API in a thread, return its host:port."""
+    server = BenchServer(('127.0.0.1', 0), BenchHandler)
+    server.osm = osm
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return '127.0.0.1:%d' % server.server_address[1]
+
+#######################################################################
+# Benchmarks                                                          #
+#######################################################################
+#
+# Every benchmark gets the size, prepares its data and returns a function
+# to time, that returns the number of elements and bytes it processed.
+
+def bench_parse_osm_dom(size):
+    data = make_osm(size)
+    api = OsmApi(parser = 'dom')
+    return lambda: (len(api.ParseOsm(data)), len(data))
+
+def bench_parse_osm_stream(size):
+    data = make_osm(size)
+    api = OsmApi(parser = 'stream')
+    return lambda: (len(api.ParseOsm(data)), len(data))
+
+def bench_parse_osm_iter(size):
+    data = make_osm(size)
+    api = OsmApi()
+    def run():
+        count = 0
+        for element in api.ParseOsmIter(data):
+            count += 1
+        return count, len(data)
+    return run
+
+def bench_parse_osc_dom(size):
+    data = make_osc(size)
+    api = OsmApi(parser = 'dom')
+    return lambda: (len(api.ParseOsc(data)), len(data))
+
+def bench_parse_osc_stream(size):
+    data = make_osc(size)
+    api = OsmApi(parser = 'stream')
+    return lambda: (len(api.ParseOsc(data)), len(data))
+
+def bench_dom_parse_way(size):
+    import xml.dom.minidom
+    data = make_osm(size)
+    ways = xml.dom.minidom.parseString(data).getElementsByTagName('way')
+    api = OsmApi()
+    def run():
+        for way in ways:
+            api._DomParseWay(way)
+        return len(ways), 0
+    return run
+
+def bench_xml_build(size):
+    nodes, ways, relations = make_elements(size)
+    elements = [ ('node', x) for x in nodes ] + [ ('way', x) for x in ways ] + \
+                [ ('relation', x) for x in relations ]
+    api = OsmApi()
+    def run():
+        length = 0
+        for osm_type, data in elements:
+            length += len(api._XmlBuild(osm_type, data))
+        return len(elements), length
+    return run
+
+def bench_upload_body(size):
+    changes = make_changes(size)
+    api = OsmApi()
+    def run():
+        data = []
+        api._OscWrite(data.append, changes)
+        return len(changes), len(''.join(data))
+    return run
+
+def bench_nodes_get(size):
+    host = start_server()
+    api = OsmApi(api = host, parser = 'stream')
+    ids = range(1, size + 1)
+    return lambda: (len(api.NodesGet(ids)), 0)
+
+def bench_map_tiled(size):
+    host = start_server(make_osm(size))
+    api = OsmApi(api = host, parser = 'stream')
+    #4 tiles with the same content, each element returned once
+    return lambda: (len(api.MapTiled(0, 0, 1, 1, maxarea = 0.25)), 0)
+
+def _load(name):
+    """Module name, None if its dependencies (bsddb, PyQt4) aren't
+    installed."""
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+def bench_lru_cache(size):
+    OsmCache = _load('OsmCache')
+    if OsmCache is None:
+        return None
+    cache = OsmCache.LRUCache(size / 2)
+    keys = [ random.randint(0, size) for i in xrange(size) ]
+    def run():
+        for key in keys:
+            if cache.get(key) is None:
+                cache[key] = key
+        return len(keys), 0
+    return run
+
+def bench_disk_cache(size):
+    OsmCache = _load('OsmCache')
+    if OsmCache is None or _load('bsddb') is None:
+        return None
+    nodes = make_elements(size)[0]
+    directory = tempfile.mkdtemp()
+    cache = OsmCache.OsmDiskCache(os.path.join(directory, 'cache.db'), size)
+    def run():
+        for node in nodes:
+            cache.put('node', node['id'], node)
+        for node in nodes:
+            cache.get('node', node['id'])
+        cache.close()
+        shutil.rmtree(directory, True)
+        return 2 * len(nodes), 0
+    return run
+
+def bench_karl_nodes(size):
+    karl = _load('karl')
+    if karl is None:
+        return None
+    nodes = make_elements(size)[0]
+    api = karl.MyOsmApi(memory_cache_size = size, node_cache_size = size)
+    api.load_elements([ { 'type': 'node', 'data': x } for x in nodes ])
+    ids = [ x['id'] for x in nodes ]
+    def run():
+        for node_id in ids:
+            api.NodeGet(node_id).lat
+        return len(ids), 0
+    return run
+
+def bench_karl_disk(size):
+    karl = _load('karl')
+    if karl is None or _load('bsddb') is None:
+        return None
+    nodes = make_elements(size)[0]
+    directory = tempfile.mkdtemp()
+    api = karl.MyOsmApi(memory_cache_size = size, node_cache_size = size,
+                        cache_file = os.path.join(directory, 'cache.db'))
+    for node in nodes:
+        api.disk_cache.put('node', node['id'], node)
+    ids = [ x['id'] for x in nodes ]
+    def run():
+        count = len(api.NodesGet(ids))
+        api.disk_cache.close()
+        shutil.rmtree(directory, True)
+        return count, 0
+    return run
+
+BENCHMARKS = [
+    ('parse_osm_dom', bench_parse_osm_dom),
+    ('parse_osm_stream', bench_parse_osm_stream),
+    ('parse_osm_iter', bench_parse_osm_iter),
+    ('parse_osc_dom', bench_parse_osc_dom),
+    ('parse_osc_stream', bench_parse_osc_stream),
+    ('dom_parse_way', bench_dom_parse_way),
+    ('xml_build', bench_xml_build),
+    ('upload_body', bench_upload_body),
+    ('nodes_get', bench_nodes_get),
+    ('map_tiled', bench_map_tiled),
+    ('lru_cache', bench_lru_cache),
+    ('disk_cache', bench_disk_cache),
+    ('karl_nodes', bench_karl_nodes),
+    ('karl_disk', bench_karl_disk),
+]
+
+#######################################################################
+# Runner                                                              #
+#######################################################################
+
+def _rss():
+    """Current resident memory in MB, the peak so far if unknown."""
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+        return pages * resource.getpagesize() / 2.0 ** 20
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _measure(func, size, results):
+    try:
+        run = func(size)
+        if run is None:
+            results.put(None)
+            return
+        gc.collect()
+        before = _rss()
+        start = time.time()
+        count, length = run()
+        seconds = time.time() - start
+        #ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        results.put({ 'seconds': seconds, 'elements': count,
+                        'bytes': length, 'peak_mb': peak,
+                        'growth_mb': max(0.0, peak - before) })
+    except Exception, e:
+        results.put({ 'error': '%s: %s' % (type(e).__name__, e) })
+
+def measure(func, size):
+    """Run the benchmark func of size in a new process, return its result
+    dictionary or None if it can't run here."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target = _measure,
+                                        args = (func, size, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def format_result(name, size, result, previous = None):
+    if 'error' in result:
+        return '%-18s %8d  ERROR %s' % (name, size, result['error'])
+    line = '%-18s %8d %9.3f %12.0f %8.1f %8.1f %8.1f' % (name, size,
+            result['seconds'], result['elements'] / max(result['seconds'], 1e-9),
+            result['bytes'] / max(result['seconds'], 1e-9) / 2 ** 20,
+            result['peak_mb'], result['growth_mb'])
+    if previous and 'seconds' in previous:
+        line += ' %+6.0f%%' % ((result['seconds'] / previous['seconds'] - 1)
+                                * 100)
+    return line
+
+def parse_opts():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+
+    parser.add_option("--sizes", dest = "sizes", default = "1000,10000,100000",
+                        help = "Comma separated element counts.")
+
+    parser.add_option("--only", dest = "only",
+                        help = "Comma separated benchmarks to run.")
+
+    parser.add_option("--save", dest = "save",
+                        help = "Write the results to this json file.")
+
+    parser.add_option("--compare", dest = "compare",
+                        help = "Show the time change against this json file.")
+
+    return parser.parse_args()
+
+def main():
+    options, args = parse_opts()
+    sizes = [ int(x) for x in options.sizes.split(',') ]
+    only = options.only and options.only.split(',')
+    previous = {}
+    if options.compare:
+        previous = json.load(open(options.compare))
+
+    print '%-18s %8s %9s %12s %8s %8s %8s' % ('benchmark', 'size',
+                        'seconds', 'elements/s', 'MB/s', 'peak MB', 'grew MB')
+    results = {}
+    for name, func in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for size in sizes:
+            result = measure(func, size)
+            if result is None:
+                print '%-18s %8d  skipped, missing dependencies' % (name, size)
+                break
+            key = '%s/%d' % (name, size)
+            results[key] = result
+            print format_result(name, size, result, previous.get(key))
+            sys.stdout.flush()
+
+    if options.save:
+        json.dump(results, open(options.save, 'w'), indent = 1,
+                    sort_keys = True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Caches for OsmApi data
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import time
+import cPickle as pickle
+from collections import OrderedDict
+
+CLOCK_KEY = '\0clock'
+FORMAT_KEY = '\0format'
+#Entries are (version, data), their ticks are in another database
+FORMAT = '2'
+
+class LRUCache(object):
+    """Dictionary like cache holding at most maxsize entries.
+
+    The least recently used entry is evicted when the cache is full and,
+    if ttl is given, entries expire ttl seconds after they were stored.
+    on_evict(key, value) is called for every evicted, expired, deleted or
+    cleared entry, but not for the ones returned by pop().
+    hits, misses, evictions and expirations count the cache activity."""
+
+    def __init__(self, maxsize = None, ttl = None, on_evict = None,
+                    timer = time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.timer = timer
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def _expired(self, key, stored):
+        if self.ttl is None or self.timer() - stored < self.ttl:
+            return False
+        value = self.data.pop(key)[1]
+        self.expirations += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+        return True
+
+    def __contains__(self, key):
+        """Doesn't count as a hit or a miss, nor refresh the entry."""
+        if key not in self.data:
+            return False
+        return not self._expired(key, self.data[key][0])
+
+    def get(self, key, default = None):
+        entry = self.data.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.data[key] = entry
+        if self._expired(key, entry[0]):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key, default = None):
+        """Like get but without counting nor refreshing the entry."""
+        if key not in self:
+            return default
+        return self.data[key][1]
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = (self.timer(), value)
+        if self.maxsize is not None:
+            while len(self.data) > self.maxsize:
+                old_key, entry = self.data.popitem(last = False)
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(old_key, entry[1])
+
+    def __delitem__(self, key):
+        value = self.data.pop(key)[1]
+        if self.on_evict:
+            self.on_evict(key, value)
+
+    def pop(self, key, *default):
+        entry = self.data.pop(key, None)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return entry[1]
+
+    def clear(self):
+        data, self.data = self.data, OrderedDict()
+        if self.on_evict:
+            for key, entry in data.iteritems():
+                self.on_evict(key, entry[1])
+
+    def stats(self):
+        return { 'size': len(self.data), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations }
+
+
+class OsmDiskCache(object):
+    """Persistent cache of the elements returned by OsmApi.
+
+    Every entry is stored under "<type>/<id>" with the element version, so
+    a newer version can invalidate it. The tick of its last access is kept
+    under the same key in filename.ticks, a small database read at startup
+    instead of the entries, and the least recently used entries are evicted
+    once the cache grows over maxsize. Unversioned data (like the ways of a
+    node) can be stored with version None."""
+
+    def __init__(self, filename, maxsize = 1000000, dbopen = None):
+        if dbopen is None:
+            #Only needed here, LRUCache works without bsddb
+            import bsddb
+            dbopen = bsddb.hashopen
+        self.db = dbopen(filename, 'c')
+        self.ticks = dbopen(filename + '.ticks', 'c')
+        self.maxsize = maxsize
+        self.atimes = {}
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.db.get(FORMAT_KEY) != FORMAT:
+            #Entries of older caches have the tick inside, start again
+            self.db.clear()
+            self.ticks.clear()
+            self.db[FORMAT_KEY] = FORMAT
+        self.clock = int(self.ticks.get(CLOCK_KEY, 0))
+        for key, tick in self.ticks.iteritems():
+            if key != CLOCK_KEY:
+                self.atimes[key] = int(tick)
+
+    def __len__(self):
+        return len(self.atimes)
+
+    def _key(self, osm_type, osm_id):
+        return '%s/%s' % (osm_type, osm_id)
+
+    def ids(self, osm_type):
+        """Return the ids of the osm_type entries, as strings."""
+        prefix = osm_type + '/'
+        return [ key[len(prefix):] for key in self.atimes
+                    if key.startswith(prefix) ]
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get(self, osm_type, osm_id):
+        """Return the cached data or None."""
+        entry = self.get_entry(osm_type, osm_id)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def get_entry(self, osm_type, osm_id):
+        """Return the cached (version, data) tuple or None."""
+        key = self._key(osm_type, osm_id)
+        if key not in self.atimes:
+            self.misses += 1
+            return None
+        self.hits += 1
+        version, data = pickle.loads(self.db[key])
+        self.atimes[key] = self._tick()
+        self.dirty.add(key)
+        return version, data
+
+    def peek(self, osm_type, osm_id):
+        """Like get but without counting nor refreshing the entry."""
+        key = self._key(osm_type, osm_id)
+        if key not in self.atimes:
+            return None
+        return pickle.loads(self.db[key])[1]
+
+    def version(self, osm_type, osm_id):
+        key = self._key(osm_type, osm_id)
+        if key not in self.atimes:
+            return None
+        return pickle.loads(self.db[key])[0]
+
+    def put(self, osm_type, osm_id, data, version = None):
+        key = self._key(osm_type, osm_id)
+        if version is None and isinstance(data, dict):
+            version = data.get('version')
+        tick = self._tick()
+        self.db[key] = pickle.dumps((version, data), pickle.HIGHEST_PROTOCOL)
+        self.ticks[key] = str(tick)
+        self.atimes[key] = tick
+        self.dirty.discard(key)
+
+        if len(self.atimes) > self.maxsize:
+            self.evict()
+
+    def invalidate(self, osm_type, osm_id, version = None):
+        """Drop the entry if version is None or newer than the cached one."""
+        key = self._key(osm_type, osm_id)
+        if key not in self.atimes:
+            return False
+        if version is not None:
+            cached_version = pickle.loads(self.db[key])[0]
+            if cached_version is not None and cached_version >= version:
+                return False
+
+        del self.db[key]
+        del self.ticks[key]
+        del self.atimes[key]
+        self.dirty.discard(key)
+        return True
+
+    def apply_changes(self, changes):
+        """Invalidate entries outdated by the list of osmChange dicts
+        returned by OsmApi.ChangesetDownload or OsmApi.ParseOsc."""
+        for change in changes:
+            osm_type = change['type']
+            data = change['data']
+            if osm_type == 'way':
+                #The ways of the old and new nodes of the way changed
+                nodes = set(data.get('nd', []))
+                old_way = self.peek('way', data['id'])
+                if old_way:
+                    nodes.update(old_way.get('nd', []))
+                for node_id in nodes:
+                    self.invalidate('node_ways', node_id)
+
+            if change['action'] == 'delete':
+                self.invalidate(osm_type, data['id'])
+            else:
+                self.invalidate(osm_type, data['id'], data.get('version'))
+
+    def evict(self):
+        """Drop the least recently used tenth of maxsize entries."""
+        count = len(self.atimes) - self.maxsize + self.maxsize / 10
+        oldest = sorted(self.atimes.iteritems(), key = lambda x: x[1])
+        for key, tick in oldest[:count]:
+            del self.db[key]
+            del self.ticks[key]
+            del self.atimes[key]
+            self.dirty.discard(key)
+            self.evictions += 1
+
+    def stats(self):
+        return { 'size': len(self.atimes), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions }
+
+    def sync(self):
+        """Write back access ticks and flush the databases to disk."""
+        for key in self.dirty:
+            self.ticks[key] = str(self.atimes[key])
+        self.dirty.clear()
+        self.ticks[CLOCK_KEY] = str(self.clock)
+        self.ticks.sync()
+        self.db.sync()
+
+    def close(self):
+        self.sync()
+        self.ticks.close()
+        self.db.close()
+
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# OsmApi read methods served from a local OSM extract
+#
+# Usage: OsmOffline.py extract.osm[.gz|.bz2] store.db
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import sys
+import gzip
+import bz2
+import marshal
+import sqlite3
+from OsmApi import OsmApi, ApiError
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS node (id INTEGER PRIMARY KEY, lat REAL, lon REAL,
+                                version INTEGER, data BLOB);
+CREATE TABLE IF NOT EXISTS way (id INTEGER PRIMARY KEY, version INTEGER,
+                                data BLOB);
+CREATE TABLE IF NOT EXISTS relation (id INTEGER PRIMARY KEY, version INTEGER,
+                                    data BLOB);
+CREATE TABLE IF NOT EXISTS way_node (node_id INTEGER, way_id INTEGER,
+                                    pos INTEGER);
+CREATE TABLE IF NOT EXISTS relation_member (type TEXT, member_id INTEGER,
+                                            relation_id INTEGER);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+CREATE INDEX IF NOT EXISTS node_bbox ON node (lat, lon);
+CREATE INDEX IF NOT EXISTS way_node_node ON way_node (node_id);
+CREATE INDEX IF NOT EXISTS way_node_way ON way_node (way_id);
+CREATE INDEX IF NOT EXISTS relation_member_member
+    ON relation_member (type, member_id);
+CREATE INDEX IF NOT EXISTS relation_member_relation
+    ON relation_member (relation_id);
+"""
+
+#sqlite limits the number of variables of a statement
+MAX_VARIABLES = 500
+
+def open_extract(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    elif filename.endswith('.bz2'):
+        return bz2.BZ2File(filename)
+    return open(filename)
+
+
+class OsmOffline(OsmApi):
+    """OsmApi whose read methods are answered from a sqlite store.
+
+    The store is filled once with Import() from an .osm or .osc extract
+    and keeps id indexes, a node -> ways reverse index, a relation member
+    index and a (lat, lon) B-tree index. Bounding box queries use it to
+    narrow by latitude and filter the longitude of every node in that band
+    from the index itself, without reading the table. Methods that need
+    the live API raise ApiError, like missing elements (404).
+
+    The sqlite connection can only be used by the thread that opened it, so
+    the OsmApi methods fetching in parallel run in the calling thread."""
+
+    def __init__(self, filename, *args, **kwargs):
+        #Local lookups don't gain anything from threads and the connection
+        #can't be shared
+        kwargs['threads'] = 1
+        super(OsmOffline, self).__init__(*args, **kwargs)
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        super(OsmOffline, self).close()
+        self.db.close()
+
+    #######################################################################
+    # Import                                                              #
+    #######################################################################
+
+    def Import(self, filename, batch = 10000):
+        """Load an .osm or .osc file, optionally gzip or bzip2 compressed."""
+        extract = open_extract(filename)
+        if '.osc' in filename:
+            changes = self.ParseOscIter(extract)
+        else:
+            changes = self._Creates(self.ParseOsmIter(extract))
+
+        count = 0
+        chunk = []
+        for change in changes:
+            chunk.append(change)
+            if len(chunk) >= batch:
+                count += self.ApplyChanges(chunk)
+                chunk = []
+        count += self.ApplyChanges(chunk)
+        extract.close()
+        return count
+
+    def _Creates(self, elements):
+        for element in elements:
+            element['action'] = u'create'
+            yield element
+
+    def ApplyChanges(self, changes, state = None):
+        """Apply the osmChange dicts of changes, as returned by ParseOsc or
+        ParseOscIter, in one transaction, storing the state dict with them.
+        Changes older than the stored elements are skipped, so overlapping
+        diffs can be applied. Returns the number of changes applied."""
+        count = 0
+        with self.db:
+            for change in changes:
+                if self._apply(change['action'], change['type'],
+                                change['data']):
+                    count += 1
+            for key, value in (state or {}).iteritems():
+                self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                                (key, str(value)))
+        return count
+
+    def GetState(self, key, default = None):
+        """Return the value stored with ApplyChanges under key."""
+        row = self.db.execute('SELECT value FROM state WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _apply(self, action, osm_type, data):
+        osm_id = data['id']
+        version = data.get('version')
+        if version is not None:
+            row = self.db.execute('SELECT version FROM %s WHERE id = ?'
+                                    % osm_type, (osm_id,)).fetchone()
+            if row is not None and row[0] is not None and row[0] >= version:
+                return False
+
+        if osm_type == 'way':
+            self.db.execute('DELETE FROM way_node WHERE way_id = ?',
+                            (osm_id,))
+        elif osm_type == 'relation':
+            self.db.execute('DELETE FROM relation_member '
+                            'WHERE relation_id = ?', (osm_id,))
+
+        if action == 'delete':
+            self.db.execute('DELETE FROM %s WHERE id = ?' % osm_type,
+                            (osm_id,))
+            return True
+
+        blob = buffer(marshal.dumps(data))
+        if osm_type == 'node':
+            self.db.execute('INSERT OR REPLACE INTO node VALUES (?, ?, ?, ?, ?)',
+                    (osm_id, data['lat'], data['lon'], data.get('version'),
+                    blob))
+        elif osm_type == 'way':
+            self.db.execute('INSERT OR REPLACE INTO way VALUES (?, ?, ?)',
+                    (osm_id, data.get('version'), blob))
+            self.db.executemany('INSERT INTO way_node VALUES (?, ?, ?)',
+                    [ (node_id, osm_id, pos)
+                        for pos, node_id in enumerate(data.get('nd', [])) ])
+        elif osm_type == 'relation':
+            self.db.execute('INSERT OR REPLACE INTO relation VALUES (?, ?, ?)',
+                    (osm_id, data.get('version'), blob))
+            self.db.executemany('INSERT INTO relation_member VALUES (?, ?, ?)',
+                    [ (member['type'], member['ref'], osm_id)
+                        for member in data.get('member', []) ])
+        return True
+
+    #######################################################################
+    # Internal queries                                                    #
+    #######################################################################
+
+    def _get_one(self, osm_type, osm_id):
+        row = self.db.execute('SELECT data FROM %s WHERE id = ?' % osm_type,
+                                (osm_id,)).fetchone()
+        if row is None:
+            raise ApiError(404, 'Not found offline', '%s %d' % (osm_type, osm_id))
+        return marshal.loads(str(row[0]))
+
+    def _query_in(self, sql, ids):
+        """Run sql, which has one "IN (%s)" placeholder, for every chunk of
+        ids and yield the rows."""
+        ids = list(ids)
+        for i in range(0, len(ids), MAX_VARIABLES):
+            chunk = ids[i:i + MAX_VARIABLES]
+            query = sql % ','.join('?' * len(chunk))
+            for row in self.db.execute(query, chunk):
+                yield row
+
+    def _get_many(self, osm_type, ids):
+        result = {}
+        sql = 'SELECT data FROM ' + osm_type + ' WHERE id IN (%s)'
+        for row in self._query_in(sql, ids):
+            data = marshal.loads(str(row[0]))
+            result[data['id']] = data
+        return result
+
+    def _relations_of(self, osm_type, ids):
+        sql = 'SELECT DISTINCT relation_id FROM relation_member ' \
+                'WHERE type = \'' + osm_type + '\' AND member_id IN (%s)'
+        return [ row[0] for row in self._query_in(sql, ids) ]
+
+    def _full(self, nodes, ways, relations):
+        """Returns the {type, data} list of the elements in OsmApi order."""
+        result = []
+        for osm_type, elements in (('node', nodes), ('way', ways),
+                                    ('relation', relations)):
+            for osm_id in sorted(elements):
+                result.append({ u'type': osm_type,
+                                u'data': elements[osm_id] })
+        return result
+
+    def _http(self, cmd, path, auth, send):
+        raise ApiError(501, 'Not available offline', path)
+
+    #######################################################################
+    # Read methods                                                        #
+    #######################################################################
+
+    def NodeGet(self, NodeId, NodeVersion = -1):
+        node = self._get_one('node', NodeId)
+        if NodeVersion != -1 and node.get('version') != NodeVersion:
+            raise ApiError(501, 'Only current versions available offline',
+                            'node %d v%d' % (NodeId, NodeVersion))
+        return node
+
+    def NodesGet(self, NodeIdList):
+        return self._get_many('node', NodeIdList)
+
+    def NodeWays(self, NodeId):
+        rows = self.db.execute('SELECT DISTINCT way_id FROM way_node '
+                                'WHERE node_id = ?', (NodeId,))
+        ways = self._get_many('way', [ row[0] for row in rows ])
+        return [ ways[way_id] for way_id in sorted(ways) ]
+
+    def NodeRelations(self, NodeId):
+        relations = self._get_many('relation',
+                                    self._relations_of('node', [NodeId]))
+        return [ relations[rel_id] for rel_id in sorted(relations) ]
+
+    def WayGet(self, WayId, WayVersion = -1):
+        way = self._get_one('way', WayId)
+        if WayVersion != -1 and way.get('version') != WayVersion:
+            raise ApiError(501, 'Only current versions available offline',
+                            'way %d v%d' % (WayId, WayVersion))
+        return way
+
+    def WaysGet(self, WayIdList):
+        return self._get_many('way', WayIdList)
+
+    def WayRelations(self, WayId):
+        relations = self._get_many('relation',
+                                    self._relations_of('way', [WayId]))
+        return [ relations[rel_id] for rel_id in sorted(relations) ]
+
+    def WayFull(self, WayId):
+        way = self._get_one('way', WayId)
+        return self._full(self._get_many('node', way['nd']),
+                            { WayId: way }, {})
+
+    def RelationGet(self, RelationId, RelationVersion = -1):
+        relation = self._get_one('relation', RelationId)
+        if RelationVersion != -1 and \
+                relation.get('version') != RelationVersion:
+            raise ApiError(501, 'Only current versions available offline',
+                            'relation %d v%d' % (RelationId, RelationVersion))
+        return relation
+
+    def RelationsGet(self, RelationIdList):
+        return self._get_many('relation', RelationIdList)
+
+    def RelationRelations(self, RelationId):
+        relations = self._get_many('relation',
+                                    self._relations_of('relation', [RelationId]))
+        return [ relations[rel_id] for rel_id in sorted(relations) ]
+
+    def RelationFull(self, RelationId):
+        relation = self._get_one('relation', RelationId)
+        members = { 'node': [], 'way': [], 'relation': [] }
+        for member in relation['member']:
+            members[member['type']].append(member['ref'])
+
+        ways = self._get_many('way', members['way'])
+        node_ids = set(members['node'])
+        for way in ways.itervalues():
+            node_ids.update(way['nd'])
+        relations = self._get_many('relation', members['relation'])
+        relations[RelationId] = relation
+        return self._full(self._get_many('node', node_ids), ways, relations)
+
+    def Map(self, min_lon, min_lat, max_lon, max_lat):
+        rows = self.db.execute('SELECT id FROM node '
+                                'WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?',
+                                (min_lat, max_lat, min_lon, max_lon))
+        bbox_ids = set(row[0] for row in rows)
+        way_ids = set(row[0] for row in self._query_in('SELECT way_id '
+                                'FROM way_node WHERE node_id IN (%s)', bbox_ids))
+
+        ways = self._get_many('way', way_ids)
+        node_ids = set(bbox_ids)
+        for way in ways.itervalues():
+            node_ids.update(way['nd'])
+
+        #Like the API, the relations of the nodes inside the bbox only
+        relation_ids = set(self._relations_of('node', bbox_ids))
+        relation_ids.update(self._relations_of('way', way_ids))
+        return self._full(self._get_many('node', node_ids), ways,
+                            self._get_many('relation', relation_ids))
+
+    def MapIter(self, min_lon, min_lat, max_lon, max_lat):
+        return iter(self.Map(min_lon, min_lat, max_lon, max_lat))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print 'Usage: %s extract.osm[.gz|.bz2] store.db' % sys.argv[0]
+        sys.exit(1)
+    store = OsmOffline(sys.argv[2])
+    print store.Import(sys.argv[1]), 'elements imported'
+    store.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Keep an OsmOffline store up to date with replication diffs
+#
+# Usage: OsmReplication.py [--start N] [--interval S] store.db replication
+#
+# replication is a directory or http url in the planet.osm replication
+# layout (state.txt and 000/001/234.osc.gz). The first update of a store
+# needs the sequence following its extract (--start). Without --interval
+# the store is brought up to date once, otherwise it's polled every S
+# seconds.
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import os
+import sys
+import time
+import gzip
+import socket
+import httplib
+import urllib2
+from optparse import OptionParser
+from cStringIO import StringIO
+from OsmOffline import OsmOffline
+
+SEQUENCE_KEY = 'replication_sequence'
+#Errors of the source that a later poll can get over
+TRANSIENT_ERRORS = (urllib2.URLError, IOError, socket.error,
+                    httplib.HTTPException)
+TIMESTAMP_KEY = 'replication_timestamp'
+
+def parse_state(data):
+    """Return the dictionary of a replication state.txt."""
+    state = {}
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        state[key] = value.replace('\\:', ':')
+    return state
+
+
+class ReplicationSource(object):
+    """Replication diffs in the planet.osm layout, from a local directory
+    or an http url."""
+
+    def __init__(self, base):
+        self.base = base.rstrip('/')
+
+    def _read(self, path):
+        if self.base.startswith('http://') or self.base.startswith('https://'):
+            return urllib2.urlopen(self.base + '/' + path).read()
+        return open(os.path.join(self.base, path)).read()
+
+    def path(self, sequence):
+        """000/001/234 for sequence 1234."""
+        sequence = '%09d' % sequence
+        return '/'.join((sequence[0:3], sequence[3:6], sequence[6:9]))
+
+    def state(self, sequence = None):
+        """Return the state of sequence, or the latest one if None."""
+        if sequence is None:
+            return parse_state(self._read('state.txt'))
+        return parse_state(self._read(self.path(sequence) + '.state.txt'))
+
+    def latest(self):
+        return int(self.state()['sequenceNumber'])
+
+    def open(self, sequence):
+        """Return a file object with the osmChange of sequence."""
+        data = self._read(self.path(sequence) + '.osc.gz')
+        return gzip.GzipFile(fileobj = StringIO(data))
+
+
+class ReplicationConsumer(object):
+    """Applies replication diffs to an OsmOffline store.
+
+    Every diff is applied in one transaction with its sequence number, so
+    an interrupted update resumes from the last diff applied. caches are
+    objects with an invalidate_changes(changes) method, like MyOsmApi,
+    or an apply_changes(changes) one, like OsmDiskCache, updated after
+    every diff. The cost of an update depends only on the changes."""
+
+    def __init__(self, store, source, caches = ()):
+        self.store = store
+        self.source = source
+        self.caches = list(caches)
+
+    def sequence(self):
+        """Sequence number of the last diff applied, None if none was."""
+        sequence = self.store.GetState(SEQUENCE_KEY)
+        if sequence is None:
+            return None
+        return int(sequence)
+
+    def apply(self, changes, sequence = None, timestamp = None):
+        """Apply the list of osmChange dicts and record sequence with them.
+        Returns the number of changes applied."""
+        state = {}
+        if sequence is not None:
+            state[SEQUENCE_KEY] = sequence
+        if timestamp is not None:
+            state[TIMESTAMP_KEY] = timestamp
+        count = self.store.ApplyChanges(changes, state)
+        for cache in self.caches:
+            if hasattr(cache, 'invalidate_changes'):
+                cache.invalidate_changes(changes)
+            else:
+                cache.apply_changes(changes)
+        return count
+
+    def apply_file(self, filename, sequence = None):
+        """Apply an .osc file, optionally gzip compressed."""
+        if filename.endswith('.gz'):
+            osc = gzip.open(filename)
+        else:
+            osc = open(filename)
+        changes = list(self.store.ParseOscIter(osc))
+        osc.close()
+        return self.apply(changes, sequence)
+
+    def apply_sequence(self, sequence):
+        osc = self.source.open(sequence)
+        changes = list(self.store.ParseOscIter(osc))
+        timestamp = None
+        try:
+            timestamp = self.source.state(sequence).get('timestamp')
+        except (IOError, urllib2.URLError):
+            pass
+        return self.apply(changes, sequence, timestamp)
+
+    def update(self, start = None, limit = None):
+        """Apply the diffs after the last one applied (or from start) up to
+        the latest of the source, at most limit of them. Returns the number
+        of diffs applied."""
+        sequence = self.sequence()
+        if sequence is None:
+            if start is None:
+                raise ValueError('No sequence applied yet, a start is needed')
+            sequence = start - 1
+        latest = self.source.latest()
+        if limit is not None:
+            latest = min(latest, sequence + limit)
+        count = 0
+        for sequence in xrange(sequence + 1, latest + 1):
+            self.apply_sequence(sequence)
+            count += 1
+        return count
+
+    def run(self, interval = 60, start = None):
+        """Keep applying new diffs, polling the source every interval.
+        Network errors are printed to stderr and retried at the next poll,
+        the diffs already applied are kept."""
+        while True:
+            try:
+                self.update(start)
+            except TRANSIENT_ERRORS, e:
+                print >>sys.stderr, '%s update failed, retrying in %ds: %s' % \
+                    (time.strftime('%Y-%m-%d %H:%M:%S'), interval, e)
+            time.sleep(interval)
+
+
+def parse_opts():
+    usage = "usage: %prog [options] store.db replication"
+    parser = OptionParser(usage)
+
+    parser.add_option("--start", dest = "start", type = "int",
+                        help = "First sequence to apply to a new store.")
+
+    parser.add_option("--interval", dest = "interval", type = "float",
+                        help = "Keep polling every INTERVAL seconds.")
+
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("store.db and replication are needed")
+    return options, args
+
+def main():
+    options, args = parse_opts()
+    store = OsmOffline(args[0])
+    consumer = ReplicationConsumer(store, ReplicationSource(args[1]))
+    if options.interval:
+        consumer.run(options.interval, options.start)
+    else:
+        before = consumer.sequence()
+        count = consumer.update(options.start)
+        print '%d diffs applied, sequence %s -> %s' % (count, before,
+                                                    consumer.sequence())
+    store.close()
+
+if __name__ == '__main__':
+    main()
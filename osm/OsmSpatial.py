@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Spatial index of OSM nodes and way segments
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import math
+import heapq
+from array import array
+
+#Meters per degree of latitude, and of longitude at the equator
+METERS_LAT = 110574.0
+METERS_LON = 111320.0
+
+def _segment_distance(x, y, x1, y1, x2, y2):
+    """Distance from (x, y) to the segment and the nearest point of it."""
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length > 0:
+        t = min(1.0, max(0.0, ((x - x1) * dx + (y - y1) * dy) / length))
+    px = x1 + t * dx
+    py = y1 + t * dy
+    return math.hypot(x - px, y - py), px, py
+
+
+class GridIndex(object):
+    """Uniform grid over lon/lat of points (nodes) and segments (ways).
+
+    Every point is kept in the cell it falls in and every segment in all
+    the cells its bounding box touches, so updates are O(1) per cell and
+    queries only look at the cells around the query. Distances are in
+    meters, on a plane tangent to the query point, which is accurate at
+    street scale. cell_size is in degrees.
+
+    Points are rows of points, an object with lons and lats arrays like a
+    NodeStore. Only the rows are kept in the cells, the coordinates are
+    read from points, so a row must be removed before it changes."""
+
+    def __init__(self, cell_size = 0.002, points = None):
+        self.cell_size = cell_size
+        self.points = points
+        self.point_cells = {}
+        self.point_count = 0
+        self.segments = {}
+        self.segment_cells = {}
+        self.ways = {}
+        #Cell bounds of everything ever added, they end the ring searches
+        self.bounds = None
+
+    def __len__(self):
+        return self.point_count
+
+    def __contains__(self, row):
+        return row in self.point_cells.get(self._point_cell(row), ())
+
+    def _cell(self, lon, lat):
+        return (int(math.floor(lon / self.cell_size)),
+                int(math.floor(lat / self.cell_size)))
+
+    def _point_cell(self, row):
+        return self._cell(self.points.lons[row], self.points.lats[row])
+
+    def _grow(self, cx, cy):
+        if self.bounds is None:
+            self.bounds = [cx, cy, cx, cy]
+        else:
+            bounds = self.bounds
+            bounds[0] = min(bounds[0], cx)
+            bounds[1] = min(bounds[1], cy)
+            bounds[2] = max(bounds[2], cx)
+            bounds[3] = max(bounds[3], cy)
+
+    def _cells(self, min_lon, min_lat, max_lon, max_lat):
+        min_cx, min_cy = self._cell(min_lon, min_lat)
+        max_cx, max_cy = self._cell(max_lon, max_lat)
+        for cx in xrange(min_cx, max_cx + 1):
+            for cy in xrange(min_cy, max_cy + 1):
+                yield cx, cy
+
+    def _ring(self, center, radius):
+        """Cells at Chebyshev distance radius from center."""
+        cx, cy = center
+        if radius == 0:
+            yield center
+            return
+        for dx in xrange(-radius, radius + 1):
+            yield cx + dx, cy - radius
+            yield cx + dx, cy + radius
+        for dy in xrange(-radius + 1, radius):
+            yield cx - radius, cy + dy
+            yield cx + radius, cy + dy
+
+    def _max_radius(self, center):
+        bounds = self.bounds
+        if bounds is None:
+            return -1
+        cx, cy = center
+        return max(cx - bounds[0], bounds[2] - cx, cy - bounds[1],
+                    bounds[3] - cy)
+
+    def _meters(self, lat):
+        """Meters per degree of longitude and latitude around lat."""
+        return METERS_LON * math.cos(math.radians(lat)), METERS_LAT
+
+    #######################################################################
+    # Updates                                                             #
+    #######################################################################
+
+    def add_node(self, row):
+        """Add the point at row, it must not be in the index."""
+        cell = self._point_cell(row)
+        self.point_cells.setdefault(cell, array('l')).append(row)
+        self.point_count += 1
+        self._grow(*cell)
+
+    def remove_node(self, row):
+        """Remove the point at row, while it has the coordinates it was
+        added with."""
+        cell = self._point_cell(row)
+        rows = self.point_cells.get(cell)
+        if rows is None or row not in rows:
+            return False
+        rows.remove(row)
+        if not rows:
+            del self.point_cells[cell]
+        self.point_count -= 1
+        return True
+
+    def add_way(self, way_id, coords):
+        """Add or replace the segments of way_id, coords is the list of
+        (lon, lat) of its nodes."""
+        if way_id in self.ways:
+            self.remove_way(way_id)
+        self.ways[way_id] = len(coords) - 1
+        for pos in range(len(coords) - 1):
+            (lon1, lat1), (lon2, lat2) = coords[pos], coords[pos + 1]
+            key = (way_id, pos)
+            self.segments[key] = (lon1, lat1, lon2, lat2)
+            for cell in self._cells(min(lon1, lon2), min(lat1, lat2),
+                                    max(lon1, lon2), max(lat1, lat2)):
+                self.segment_cells.setdefault(cell, set()).add(key)
+                self._grow(*cell)
+
+    def remove_way(self, way_id):
+        count = self.ways.pop(way_id, None)
+        if count is None:
+            return False
+        for pos in range(count):
+            key = (way_id, pos)
+            lon1, lat1, lon2, lat2 = self.segments.pop(key)
+            for cell in self._cells(min(lon1, lon2), min(lat1, lat2),
+                                    max(lon1, lon2), max(lat1, lat2)):
+                keys = self.segment_cells[cell]
+                keys.discard(key)
+                if not keys:
+                    del self.segment_cells[cell]
+        return True
+
+    def clear(self):
+        self.point_cells.clear()
+        self.point_count = 0
+        self.segments.clear()
+        self.segment_cells.clear()
+        self.ways.clear()
+        self.bounds = None
+
+    #######################################################################
+    # Queries                                                             #
+    #######################################################################
+
+    def nodes_in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the rows of the points inside the bounding box."""
+        lons = self.points.lons
+        lats = self.points.lats
+        result = []
+        for cell in self._cells(min_lon, min_lat, max_lon, max_lat):
+            for row in self.point_cells.get(cell, ()):
+                if min_lon <= lons[row] <= max_lon and \
+                        min_lat <= lats[row] <= max_lat:
+                    result.append(row)
+        return result
+
+    def ways_in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the ids of the ways with a segment whose bounding box
+        intersects the bounding box."""
+        result = set()
+        for cell in self._cells(min_lon, min_lat, max_lon, max_lat):
+            for key in self.segment_cells.get(cell, ()):
+                lon1, lat1, lon2, lat2 = self.segments[key]
+                if min(lon1, lon2) <= max_lon and \
+                        max(lon1, lon2) >= min_lon and \
+                        min(lat1, lat2) <= max_lat and \
+                        max(lat1, lat2) >= min_lat:
+                    result.add(key[0])
+        return list(result)
+
+    def _search(self, lon, lat, k, max_distance, cells, distance):
+        """Ring search around (lon, lat) of the k nearest items of cells.
+
+        distance(item, x_scale, y_scale) returns (meters, extra) or None to
+        skip the item. Stops when no unvisited cell can hold anything
+        nearer than the k-th result."""
+        x_scale, y_scale = self._meters(lat)
+        cell_meters = self.cell_size * min(x_scale, y_scale)
+        center = self._cell(lon, lat)
+        max_radius = self._max_radius(center)
+        if max_distance is not None:
+            max_radius = min(max_radius,
+                            int(max_distance / cell_meters) + 1)
+
+        best = []
+        seen = set()
+        radius = 0
+        while radius <= max_radius:
+            for cell in self._ring(center, radius):
+                for item in cells.get(cell, ()):
+                    if item in seen:
+                        continue
+                    seen.add(item)
+                    found = distance(item, x_scale, y_scale)
+                    if found is None:
+                        continue
+                    if max_distance is not None and found[0] > max_distance:
+                        continue
+                    heapq.heappush(best, (-found[0], item, found[1]))
+                    if len(best) > k:
+                        heapq.heappop(best)
+            #Anything outside the rings visited is at least this far
+            if len(best) == k and -best[0][0] <= radius * cell_meters:
+                break
+            radius += 1
+
+        best.sort(reverse = True)
+        return [ (-dist, item, extra) for dist, item, extra in best ]
+
+    def nearest_nodes(self, lon, lat, k = 1, max_distance = None):
+        """Return up to k (meters, row) of the points nearest to
+        (lon, lat), nearest first."""
+        lons = self.points.lons
+        lats = self.points.lats
+        def distance(row, x_scale, y_scale):
+            return math.hypot((lons[row] - lon) * x_scale,
+                                (lats[row] - lat) * y_scale), None
+
+        return [ (dist, row) for dist, row, extra in
+                    self._search(lon, lat, k, max_distance,
+                                self.point_cells, distance) ]
+
+    def nearest_segments(self, lon, lat, k = 1, max_distance = None,
+                            ways = None):
+        """Return up to k (meters, way_id, pos, (lon, lat)) of the segments
+        nearest to (lon, lat), nearest first. pos is the index of the
+        first node of the segment in the way and (lon, lat) the nearest
+        point of the segment. If ways is given only its ways are looked."""
+        def distance(key, x_scale, y_scale):
+            if ways is not None and key[0] not in ways:
+                return None
+            lon1, lat1, lon2, lat2 = self.segments[key]
+            dist, x, y = _segment_distance(0, 0,
+                                (lon1 - lon) * x_scale, (lat1 - lat) * y_scale,
+                                (lon2 - lon) * x_scale, (lat2 - lat) * y_scale)
+            return dist, (lon + x / x_scale, lat + y / y_scale)
+
+        return [ (dist, key[0], key[1], point) for dist, key, point in
+                    self._search(lon, lat, k, max_distance,
+                                self.segment_cells, distance) ]
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Instrumentation of OsmApi: latency, size and parse time histograms
+#
+# Diego Woitasen - <diego@woitasen.com.ar>
+#
+
+import re
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+_ID = re.compile(r'/-?\d+(?=/|$)')
+
+def endpoint(path):
+    """Name of the API endpoint of path, without ids nor query string:
+    /api/0.6/node/123/history -> /api/0.6/node/:id/history"""
+    return _ID.sub('/:id', path.split('?')[0])
+
+
+class Instrument(object):
+    """Hooks called by OsmApi (pass it as instrument) and MyOsmApi. This
+    one does nothing, subclasses record what they need."""
+
+    def request(self, cmd, path, status, seconds, size):
+        """An http request ended, status is None if it failed without an
+        answer. size is the number of bytes received."""
+
+    def parse(self, kind, seconds, count):
+        """count elements of kind (osm, osc, node, way, ...) were parsed."""
+
+    def retry(self, cmd, path, attempt, delay, error):
+        """A request failed with error and will be retried after delay."""
+
+    def cache(self, name, result):
+        """A lookup in the cache name was a 'memory' or 'disk' hit or a
+        'miss'."""
+
+
+class Histogram(object):
+    """Histogram with logarithmic buckets, per_octave per power of two, so
+    percentiles are accurate within a few percent at any scale."""
+
+    def __init__(self, per_octave = 16):
+        self.per_octave = per_octave
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value > 0:
+            bucket = int(math.ceil(math.log(value, 2) * self.per_octave))
+        else:
+            bucket = None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def upper(self, bucket):
+        """Upper bound of the values of bucket."""
+        if bucket is None:
+            return 0.0
+        return 2 ** (float(bucket) / self.per_octave)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the percent-th value."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key = self.upper):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.upper(bucket), self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def stats(self):
+        return { 'count': self.count, 'total': self.total,
+                'min': self.min, 'max': self.max, 'mean': self.mean(),
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99) }
+
+
+class Recorder(Instrument):
+    """Instrument keeping histograms of everything by endpoint:
+
+        latency[endpoint]   seconds of the requests
+        size[endpoint]      bytes received
+        parse[kind]         seconds parsing, elements counts elements
+        retries[endpoint]   retried requests
+        errors[endpoint]    requests without an answer or not 200
+        caches[name]        {'memory': hits, 'disk': hits, 'miss': misses}
+
+    It's thread safe, so it can be shared by OsmApi threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.started = time.time()
+        self.wall = None
+        self.clear()
+
+    def clear(self):
+        self.latency = {}
+        self.size = {}
+        self.parse_time = {}
+        self.elements = {}
+        self.retries = {}
+        self.errors = {}
+        self.caches = {}
+
+    def _add(self, histograms, key, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.add(value)
+
+    def _count(self, counters, key, value = 1):
+        counters[key] = counters.get(key, 0) + value
+
+    def request(self, cmd, path, status, seconds, size):
+        name = cmd + ' ' + endpoint(path)
+        with self.lock:
+            self._add(self.latency, name, seconds)
+            self._add(self.size, name, size)
+            if status != 200:
+                self._count(self.errors, name)
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.request(cmd, path, status, seconds, size)
+
+    def parse(self, kind, seconds, count):
+        with self.lock:
+            self._add(self.parse_time, kind, seconds)
+            self._count(self.elements, kind, count)
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.parse(kind, seconds, count)
+
+    def retry(self, cmd, path, attempt, delay, error):
+        with self.lock:
+            self._count(self.retries, cmd + ' ' + endpoint(path))
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.retry(cmd, path, attempt, delay, error)
+
+    def cache(self, name, result):
+        with self.lock:
+            self._count(self.caches.setdefault(name, {}), result)
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.cache(name, result)
+
+    @contextmanager
+    def profile(self):
+        """Record what happens inside the with block in a new Recorder:
+
+            with recorder.profile() as profile:
+                do_karl(first, last)
+            print profile.report()
+        """
+        profile = Recorder()
+        with self.lock:
+            self.profiles.append(profile)
+        try:
+            yield profile
+        finally:
+            with self.lock:
+                self.profiles.remove(profile)
+            profile.wall = time.time() - profile.started
+
+    def network_time(self):
+        return sum(h.total for h in self.latency.values())
+
+    def parsing_time(self):
+        return sum(h.total for h in self.parse_time.values())
+
+    def stats(self):
+        """Everything recorded as a dict of plain values."""
+        with self.lock:
+            return {
+                'wall': self.wall,
+                'latency': dict((k, h.stats()) for k, h in self.latency.items()),
+                'size': dict((k, h.stats()) for k, h in self.size.items()),
+                'parse': dict((k, h.stats()) for k, h in self.parse_time.items()),
+                'elements': dict(self.elements),
+                'retries': dict(self.retries),
+                'errors': dict(self.errors),
+                'caches': dict((k, dict(v)) for k, v in self.caches.items()),
+            }
+
+    def report(self):
+        """Human readable summary, times in milliseconds."""
+        lines = []
+        with self.lock:
+            if self.wall is not None:
+                lines.append('wall %.0f ms, network %.0f ms, parsing %.0f ms'
+                            % (self.wall * 1000, self.network_time() * 1000,
+                                self.parsing_time() * 1000))
+            lines.append('%-40s %6s %8s %8s %8s %10s' % ('request', 'count',
+                        'p50', 'p90', 'max', 'bytes'))
+            for name in sorted(self.latency):
+                h = self.latency[name]
+                lines.append('%-40s %6d %8.1f %8.1f %8.1f %10d' % (name,
+                        h.count, h.percentile(50) * 1000,
+                        h.percentile(90) * 1000, h.max * 1000,
+                        self.size[name].total))
+            lines.append('%-40s %6s %8s %8s %8s %10s' % ('parse', 'count',
+                        'p50', 'p90', 'max', 'elements'))
+            for kind in sorted(self.parse_time):
+                h = self.parse_time[kind]
+                lines.append('%-40s %6d %8.1f %8.1f %8.1f %10d' % (kind,
+                        h.count, h.percentile(50) * 1000,
+                        h.percentile(90) * 1000, h.max * 1000,
+                        self.elements[kind]))
+            for name in sorted(self.retries):
+                lines.append('retries %s: %d' % (name, self.retries[name]))
+            for name in sorted(self.errors):
+                lines.append('errors %s: %d' % (name, self.errors[name]))
+            for name in sorted(self.caches):
+                counts = self.caches[name]
+                lines.append('cache %s: %s' % (name, ', '.join('%s %d' %
+                            (k, counts[k]) for k in sorted(counts))))
+        return '\n'.join(lines)
@@ -3,16 +3,32 @@
 #
 # Script that helps to map using the Karlsruhe Schema
 #
+# Usage:
+#   karl.py [first_node last_node]           dialog for one street
+#   karl.py --segments FILE --output karl.osc  batch, "first last" per line
+#   karl.py --bbox W,S,E,N --output karl.osc   batch, every street inside
+#
+# Add --offline store.db to read an OsmOffline store instead of the API and
+# --profile to see where the time goes.
+#
 # Diego Woitasen - <diego@woitasen.com.ar>
 #
  
 import sys
-import math
-from PyQt4.QtGui import *
-from PyQt4.QtCore import *
+import os
+import atexit
+import multiprocessing
+import itertools
+import time
+import calendar
+from array import array
+from optparse import OptionParser
 from OsmApi import OsmApi
-import bsddb
-from copy import copy
+from OsmOffline import OsmOffline
+from OsmCache import OsmDiskCache, LRUCache
+from OsmSpatial import GridIndex
+from OsmStats import Recorder
+import KarlGeometry
 
 class OsmObject(object):
     def __init__(self, osm_data = None):
@@ -28,7 +44,7 @@ class OsmObject(object):
     def load_osm_data(self, osm_data):
         self.osm_data = osm_data
         for attr in self.osm_attrs:
-            setattr(self, attr, osm_data[attr])
+            setattr(self, attr, osm_data.get(attr))
 
         self.tags = osm_data.setdefault('tag', {})
 
@@ -39,29 +55,295 @@ class OsmObject(object):
             return False
 
 
-class OsmNode(OsmObject):
-    def __init__(self, osm_data = None):
-        self.osm_attrs = [ 'lat', 'lon' ]
-        super(OsmNode, self).__init__(osm_data)
+def _store_attr(name):
+    """Property reading the view's slot in the NodeStore array called name."""
+    return property(lambda self: getattr(self.store, name)[self.index])
 
-    def load_osm_data(self, osm_data):
-        super(OsmNode, self).load_osm_data(osm_data)
+
+class OsmNode(object):
+    """Lightweight view of a node held in a NodeStore."""
+    __slots__ = [ 'store', 'id', 'row' ]
+
+    def __init__(self, store, node_id, row):
+        self.store = store
+        self.id = node_id
+        self.row = row
+
+    @property
+    def index(self):
+        """Row of the node, found again if it was evicted meanwhile."""
+        if self.store.ids[self.row] != self.id:
+            self.row = self.store.row(self.id)
+        return self.row
+
+    lat = _store_attr('lats')
+    lon = _store_attr('lons')
+    version = _store_attr('versions')
+    changeset = _store_attr('changesets')
+    uid = _store_attr('uids')
+
+    @property
+    def visible(self):
+        return bool(self.store.visibles[self.index])
+
+    @property
+    def user(self):
+        return self.store.strings[self.store.users[self.index]]
+
+    @property
+    def timestamp(self):
+        return self.store.get_timestamp(self.index)
+
+    @property
+    def tags(self):
+        """Shared with every node having the same tags, don't modify it."""
+        return self.store.tag_table[self.store.tags[self.index]]
+
+    @property
+    def osm_data(self):
+        return self.store.osm_data(self.index)
+
+    @property
+    def adjacent_nodes(self):
+        return self.store.adjacent_nodes.get(self.id, [])
+
+    def get_tag(self, name):
+        if name in self.tags:
+            return self.tags[name]
+        else:
+            return False
 
     def get_adjacent_nodes(self):
-        ways = osm_api.NodeWays(self.id)
-        self.adjacent_nodes = []
-        ways = osm_api.WaysGet(ways)
-        for way in ways:
-            for node in enumerate(way.nodes):
-                if node[1] == self.id:
-                    if node[0] > 0:
-                        self.adjacent_nodes.append(way.nodes[node[0]-1])
-                    if node[0] < len(way.nodes)-1:
-                        self.adjacent_nodes.append(way.nodes[node[0]+1])
+        self.store.adjacent_nodes[self.id] = osm_api.adjacent_nodes(self.id)
 
     def q_point(self):
+        from PyQt4.QtCore import QPointF
         return QPointF(self.lon, self.lat)
 
+
+class NodeStore(object):
+    """Compact in-memory storage for OSM nodes.
+
+    Ids, coordinates and numeric attributes live in typed arrays, found
+    through an id -> index map. Tags and user names are interned in shared
+    tables and timestamps are kept as seconds since the epoch. A node takes
+    74 bytes of the arrays, and with its id -> index entry and the grid
+    row about 240 bytes in all, against some 1 KB as an OsmApi dict (64
+    bit CPython 2.7, measured on a million nodes).
+
+    The id -> index map is a plain dictionary. Once it holds maxsize nodes
+    a clock (second chance) policy over the rows evicts the nodes not used
+    since the hand last passed, nodes older than ttl seconds expire too,
+    and the rows of evicted nodes are reused. A view checks its row still
+    holds its node and otherwise looks it up again, through loader (a
+    NodeGet like function) if it was evicted. If spatial is set to a
+    GridIndex of the store rows, it follows the nodes stored."""
+
+    TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+    def __init__(self, maxsize = None, ttl = None, loader = None,
+                    timer = time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        #GridIndex over the rows of the store, if any
+        self.spatial = None
+        self.loader = loader
+        self.index = {}
+        self.free_rows = []
+        #Next row looked at by the clock when a node must be evicted
+        self.hand = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        #'l' is 64 bits wide on LP64 platforms, wide enough for node ids
+        self.ids = array('l')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.versions = array('l')
+        self.changesets = array('l')
+        self.uids = array('l')
+        self.users = array('l')
+        self.timestamps = array('l')
+        self.visibles = array('b')
+        self.tags = array('l')
+        #Set when the node is used, the clock spares it once
+        self.referenced = array('b')
+        #When every node was stored, only kept if ttl is given
+        self.stored = array('d')
+        self.strings = []
+        self.strings_index = {}
+        self.tag_table = []
+        self.tag_table_index = {}
+        self.adjacent_nodes = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, node_id):
+        """Doesn't count as a hit or a miss, nor refresh the node."""
+        return self.peek(node_id) is not None
+
+    def __getitem__(self, node_id):
+        node = self.get(node_id)
+        if node is None:
+            raise KeyError(node_id)
+        return node
+
+    def peek(self, node_id):
+        """Row of node_id or None, without counting nor refreshing it."""
+        index = self.index.get(node_id)
+        if index is not None and self.ttl is not None and \
+                self.timer() - self.stored[index] >= self.ttl:
+            self.expirations += 1
+            self.discard(node_id)
+            return None
+        return index
+
+    def get(self, node_id):
+        index = self.peek(node_id)
+        if index is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.referenced[index] = 1
+        return OsmNode(self, node_id, index)
+
+    def row(self, node_id):
+        """Row of node_id, loading it again if it isn't stored."""
+        node = self.get(node_id)
+        if node is None:
+            if self.loader is None:
+                raise KeyError(node_id)
+            node = self.loader(node_id)
+        return node.row
+
+    def has_key(self, node_id):
+        return node_id in self
+
+    def discard(self, node_id):
+        """Forget node_id, its row will be reused."""
+        index = self.index.pop(node_id, None)
+        if index is not None:
+            self._free_row(node_id, index)
+
+    def _free_row(self, node_id, index):
+        #Views of the node see it's gone
+        self.ids[index] = 0
+        self.free_rows.append(index)
+        self.adjacent_nodes.pop(node_id, None)
+        if self.spatial is not None:
+            self.spatial.remove_node(index)
+
+    def _make_room(self):
+        """Evict nodes until another one fits. The clock hand goes around
+        the rows, clearing the referenced flags it finds set and evicting
+        the first node whose flag is clear."""
+        ids = self.ids
+        referenced = self.referenced
+        while self.index and len(self.index) >= self.maxsize:
+            if self.hand >= len(ids):
+                self.hand = 0
+            index = self.hand
+            self.hand += 1
+            if ids[index] == 0:
+                continue
+            if referenced[index]:
+                referenced[index] = 0
+                continue
+            self.evictions += 1
+            self.discard(ids[index])
+
+    def stats(self):
+        return { 'size': len(self.index), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations }
+
+    def _intern(self, table, table_index, key, value):
+        try:
+            return table_index[key]
+        except KeyError:
+            table_index[key] = len(table)
+            table.append(value)
+            return table_index[key]
+
+    def intern_string(self, value):
+        return self._intern(self.strings, self.strings_index, value, value)
+
+    def intern_tags(self, tags):
+        return self._intern(self.tag_table, self.tag_table_index,
+                            frozenset(tags.iteritems()), tags)
+
+    def get_timestamp(self, index):
+        timestamp = self.timestamps[index]
+        if timestamp < 0:
+            return None
+        return time.strftime(self.TIMESTAMP_FORMAT, time.gmtime(timestamp))
+
+    def add(self, osm_data):
+        """Store the node dictionary returned by OsmApi, return its view."""
+        node_id = osm_data['id']
+        row = (node_id, osm_data['lat'], osm_data['lon'],
+                osm_data.get('version', 0), osm_data.get('changeset', 0),
+                osm_data.get('uid', 0),
+                self.intern_string(osm_data.get('user', u'')),
+                self.parse_timestamp(osm_data.get('timestamp')),
+                osm_data.get('visible', True),
+                self.intern_tags(osm_data.get('tag', {})), 1)
+        columns = (self.ids, self.lats, self.lons, self.versions,
+                    self.changesets, self.uids, self.users, self.timestamps,
+                    self.visibles, self.tags, self.referenced)
+
+        index = self.index.get(node_id)
+        if index is None and self.maxsize is not None:
+            self._make_room()
+        if index is not None and self.spatial is not None:
+            #The node could have moved
+            self.spatial.remove_node(index)
+        if index is None and not self.free_rows:
+            index = len(self.ids)
+            for column, value in zip(columns, row):
+                column.append(value)
+            if self.ttl is not None:
+                self.stored.append(self.timer())
+        else:
+            if index is None:
+                index = self.free_rows.pop()
+            for column, value in zip(columns, row):
+                column[index] = value
+            if self.ttl is not None:
+                self.stored[index] = self.timer()
+        self.index[node_id] = index
+        if self.spatial is not None:
+            self.spatial.add_node(index)
+
+        return OsmNode(self, node_id, index)
+
+    def parse_timestamp(self, timestamp):
+        if not timestamp:
+            return -1
+        return calendar.timegm(time.strptime(timestamp, self.TIMESTAMP_FORMAT))
+
+    def osm_data(self, index):
+        """Rebuild the OsmApi node dictionary stored at index."""
+        osm_data = {
+            'id': self.ids[index],
+            'lat': self.lats[index],
+            'lon': self.lons[index],
+            'version': self.versions[index],
+            'changeset': self.changesets[index],
+            'uid': self.uids[index],
+            'user': self.strings[self.users[index]],
+            'visible': bool(self.visibles[index]),
+            'tag': dict(self.tag_table[self.tags[index]]),
+        }
+        timestamp = self.get_timestamp(index)
+        if timestamp:
+            osm_data['timestamp'] = timestamp
+        return osm_data
+
+
 class OsmWay(OsmObject):
     def __init__(self, osm_data = None):
         super(OsmWay, self).__init__(osm_data)
@@ -73,186 +355,492 @@ class OsmWay(OsmObject):
             self.nodes = osm_data['nd']
 
 
+class AdjacencyIndex(object):
+    """Node id -> (way id, position) index of the ways loaded so far.
+
+    Neighbours of a node are found in O(1) from its positions in the ways.
+    A node is complete once all the ways it belongs to were added, then
+    its neighbours can be trusted without asking the API."""
+
+    def __init__(self):
+        self.ways = {}
+        self.node_ways = {}
+        self.complete = set()
+
+    def add_way(self, way_id, nodes):
+        if way_id in self.ways:
+            self.remove_way(way_id)
+        self.ways[way_id] = nodes
+        for pos, node_id in enumerate(nodes):
+            self.node_ways.setdefault(node_id, []).append((way_id, pos))
+
+    def remove_way(self, way_id):
+        nodes = self.ways.pop(way_id, [])
+        for node_id in set(nodes):
+            positions = [ x for x in self.node_ways.get(node_id, [])
+                            if x[0] != way_id ]
+            if positions:
+                self.node_ways[node_id] = positions
+            else:
+                self.node_ways.pop(node_id, None)
+        return nodes
+
+    def neighbours(self, node_id):
+        """Return the ids of the previous and next nodes in every way."""
+        neighbours = []
+        for way_id, pos in self.node_ways.get(node_id, []):
+            nodes = self.ways[way_id]
+            if pos > 0:
+                neighbours.append(nodes[pos - 1])
+            if pos < len(nodes) - 1:
+                neighbours.append(nodes[pos + 1])
+        return neighbours
+
+    def way_ids(self, node_id):
+        way_ids = []
+        for way_id, pos in self.node_ways.get(node_id, []):
+            if way_id not in way_ids:
+                way_ids.append(way_id)
+        return way_ids
+
+
 class MyOsmApi(OsmApi):
+    #Any class with the interface of LRUCache can be plugged here
+    cache_class = LRUCache
+
     def __init__(self, *args, **kwargs):
+        cache_file = kwargs.pop('cache_file', None)
+        cache_size = kwargs.pop('cache_size', 1000000)
+        memory_cache_size = kwargs.pop('memory_cache_size', 100000)
+        #Nodes are compact, keep the millions of a large city
+        node_cache_size = kwargs.pop('node_cache_size', 5000000)
+        memory_cache_ttl = kwargs.pop('memory_cache_ttl', None)
+        source = kwargs.pop('source', None)
         super(MyOsmApi, self).__init__(*args, **kwargs)
-        self.ways_cache = {}
-        self.nodes_cache = {}
-        self.nodes_ways_cache = {}
 
-    def NodeWays(self, node_id):
-        if self.nodes_ways_cache.has_key(node_id):
-            return self.nodes_ways_cache[node_id]
+        #Where the data comes from when it's not cached: the OSM API or
+        #another object with the same read methods, like OsmOffline
+        self.source = source
+        if source is None:
+            self.source = super(MyOsmApi, self)
+        self.ways_cache = self.cache_class(memory_cache_size,
+                                            memory_cache_ttl)
+        self.nodes_cache = NodeStore(node_cache_size, memory_cache_ttl,
+                                    self.NodeGet)
+        #Cached nodes and the ways loaded with their nodes, by location
+        self.spatial = GridIndex(points = self.nodes_cache)
+        self.nodes_cache.spatial = self.spatial
+        self.nodes_ways_cache = self.cache_class(memory_cache_size,
+                                                memory_cache_ttl)
+        self.adjacency = AdjacencyIndex()
+        #(type, id) of the nodes and ways of every bbox loaded
+        self.bbox_cache = self.cache_class(memory_cache_size,
+                                            memory_cache_ttl)
+
+        #Persistent cache, it avoids downloading again the same data on
+        #every run
+        self.disk_cache = None
+        if cache_file:
+            self.disk_cache = OsmDiskCache(cache_file, cache_size)
+            atexit.register(self.disk_cache.close)
+
+    def cache_stats(self):
+        """Return the size, hits, misses and evictions of every cache."""
+        stats = {
+            'nodes': self.nodes_cache.stats(),
+            'ways': self.ways_cache.stats(),
+            'nodes_ways': self.nodes_ways_cache.stats(),
+            'bbox': self.bbox_cache.stats(),
+        }
+        if self.disk_cache is not None:
+            stats['disk'] = self.disk_cache.stats()
+        return stats
+
+    def _cache_event(self, name, result):
+        if self._instrument is not None:
+            self._instrument.cache(name, result)
+
+    def _disk_get(self, osm_type, osm_id):
+        if self.disk_cache is not None:
+            return self.disk_cache.get(osm_type, osm_id)
+        return None
+
+    def _disk_put(self, osm_type, osm_id, data):
+        if self.disk_cache is not None:
+            self.disk_cache.put(osm_type, osm_id, data)
+
+    def _cache_way(self, way_data):
+        self._disk_put('way', way_data['id'], way_data)
+        way = OsmWay(way_data)
+        self.ways_cache[way.id] = way
+        return way
 
-        ways = super(MyOsmApi, self).NodeWays(node_id)
-        way_ids = []
-        for way in ways:
-            way_ids.append(way['id'])
-        #cache ways here. I don't remember why I did this, review! :P
-        self.WaysGet(way_ids)
+    def NodeWays(self, node_id):
+        way_ids = self.nodes_ways_cache.get(node_id)
+        if way_ids is not None:
+            self._cache_event('node_ways', 'memory')
+            return way_ids
+
+        way_ids = self._disk_get('node_ways', node_id)
+        if way_ids is None:
+            self._cache_event('node_ways', 'miss')
+            ways = self.source.NodeWays(node_id)
+            way_ids = []
+            for way in ways:
+                #The API returns the whole ways, cache them here
+                self._cache_way(way)
+                way_ids.append(way['id'])
+            self._disk_put('node_ways', node_id, way_ids)
+        else:
+            self._cache_event('node_ways', 'disk')
+            self.WaysGet(way_ids)
         self.nodes_ways_cache[node_id] = way_ids
 
+        for way_id in way_ids:
+            way = self.ways_cache.peek(way_id)
+            if way is not None and way_id not in self.adjacency.ways:
+                self.adjacency.add_way(way_id, way.nodes)
+        self.adjacency.complete.add(node_id)
+
         return way_ids
 
-    def WayGet(self, way_id):
-        if self.ways_cache.has_key(way_id):
-            return self.ways_cache[way_id]
+    def adjacent_nodes(self, node_id):
+        """Return the neighbours of node_id in all its ways."""
+        if node_id not in self.adjacency.complete:
+            self.NodeWays(node_id)
+        return self.adjacency.neighbours(node_id)
+
+    def load_elements(self, elements, bbox = None):
+        """Cache the {type, data} list of a Map or WayFull download and index
+        its ways. Map returns every way of the nodes inside its bbox, so
+        those nodes get their adjacency marked as complete."""
+        for element in elements:
+            data = element['data']
+            if element['type'] == 'node':
+                self._disk_put('node', data['id'], data)
+                self.nodes_cache.add(data)
+            elif element['type'] == 'way':
+                self._cache_way(data)
+                self.adjacency.add_way(data['id'], data['nd'])
+
+        #Nodes come first, so the geometry of the ways is known by now
+        for element in elements:
+            if element['type'] == 'way':
+                self.index_way(element['data']['id'])
+
+        if bbox:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            for element in elements:
+                data = element['data']
+                if element['type'] == 'node' and \
+                        min_lon <= data['lon'] <= max_lon and \
+                        min_lat <= data['lat'] <= max_lat:
+                    self.adjacency.complete.add(data['id'])
+
+    def index_way(self, way_id):
+        """Add the segments of a cached way to the spatial index. Returns
+        False if some of its nodes aren't cached."""
+        way = self.ways_cache.peek(way_id)
+        if way is None:
+            return False
+        coords = []
+        for node_id in way.nodes:
+            index = self.nodes_cache.peek(node_id)
+            if index is None:
+                return False
+            coords.append((self.nodes_cache.lons[index],
+                            self.nodes_cache.lats[index]))
+        self.spatial.add_way(way_id, coords)
+        return True
+
+    def nodes_near(self, lon, lat, k = 1, max_distance = None):
+        """Return up to k (meters, node) of the cached nodes nearest to
+        (lon, lat), without asking the API."""
+        ids = self.nodes_cache.ids
+        return [ (dist, self.NodeGet(ids[row])) for dist, row in
+                    self.spatial.nearest_nodes(lon, lat, k, max_distance) ]
+
+    def ways_near(self, lon, lat, k = 1, max_distance = None):
+        """Return up to k (meters, way, pos, (lon, lat)) of the indexed way
+        segments nearest to (lon, lat), see GridIndex.nearest_segments."""
+        return [ (dist, self.WayGet(way_id), pos, point)
+                    for dist, way_id, pos, point in
+                    self.spatial.nearest_segments(lon, lat, k, max_distance) ]
+
+    def snap(self, lon, lat, max_distance, ways = None):
+        """Return the (lon, lat) of the nearest point of the indexed ways
+        (only the ids in ways if given) or None if all are farther than
+        max_distance meters."""
+        found = self.spatial.nearest_segments(lon, lat, 1, max_distance, ways)
+        if not found:
+            return None
+        return found[0][3]
+
+    def load_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Download and index everything inside the bounding box. A bbox
+        loaded before is read from the caches instead, unless some of its
+        elements changed (see invalidate_changes) or were evicted."""
+        bbox = (min_lon, min_lat, max_lon, max_lat)
+        elements = self._cached_bbox(bbox)
+        if elements is None:
+            elements = self.source.MapTiled(*bbox)
+            refs = [ (element['type'], element['data']['id'])
+                        for element in elements
+                        if element['type'] in ('node', 'way') ]
+            self.bbox_cache[bbox] = refs
+            self._disk_put('bbox', self._bbox_key(bbox), refs)
+        self.load_elements(elements, bbox)
+
+    def _bbox_key(self, bbox):
+        return '%.7f,%.7f,%.7f,%.7f' % bbox
+
+    def _cached_bbox(self, bbox):
+        """Return the elements of a bbox from the caches or None."""
+        refs = self.bbox_cache.get(bbox)
+        if refs is not None:
+            self._cache_event('bbox', 'memory')
+        else:
+            refs = self._disk_get('bbox', self._bbox_key(bbox))
+            if refs is None:
+                self._cache_event('bbox', 'miss')
+                return None
+            self._cache_event('bbox', 'disk')
+            self.bbox_cache[bbox] = refs
+
+        elements = []
+        for osm_type, osm_id in refs:
+            data = None
+            if osm_type == 'node':
+                index = self.nodes_cache.peek(osm_id)
+                if index is not None:
+                    data = self.nodes_cache.osm_data(index)
+            else:
+                way = self.ways_cache.peek(osm_id)
+                if way is not None:
+                    data = way.osm_data
+            if data is None:
+                data = self._disk_get(osm_type, osm_id)
+            if data is None:
+                #Evicted, download the bbox again
+                return None
+            elements.append({ 'type': osm_type, 'data': data })
+        return elements
 
-        way = super(MyOsmApi, self).WayGet(way_id)
+    def WayGet(self, way_id):
+        way = self.ways_cache.get(way_id)
+        if way is not None:
+            self._cache_event('ways', 'memory')
+            return way
+
+        way = self._disk_get('way', way_id)
+        if way is None:
+            self._cache_event('ways', 'miss')
+            way = self.source.WayGet(way_id)
+            self._disk_put('way', way_id, way)
+        else:
+            self._cache_event('ways', 'disk')
         way = OsmWay(way)
         self.ways_cache[way_id] = way
         return way
 
     def NodeGet(self, node_id):
-        if self.nodes_cache.has_key(node_id):
-            return self.nodes_cache[node_id]
-
-        node = super(MyOsmApi, self).NodeGet(node_id)
-        node = OsmNode(node)
-        self.nodes_cache[node_id] = node
-        return node
+        node = self.nodes_cache.get(node_id)
+        if node is not None:
+            self._cache_event('nodes', 'memory')
+            return node
+
+        node = self._disk_get('node', node_id)
+        if node is None:
+            self._cache_event('nodes', 'miss')
+            node = self.source.NodeGet(node_id)
+            self._disk_put('node', node_id, node)
+        else:
+            self._cache_event('nodes', 'disk')
+        return self.nodes_cache.add(node)
 
     def NodesGet(self, node_ids):
-        node_ids = copy(node_ids)
         nodes = []
+        missing = []
         for node_id in node_ids:
-            if self.nodes_cache.has_key(node_id):
-                nodes.append(self.nodes_cache[node_id])
-                node_ids.remove(node_id)
-
-        if len(node_ids) > 0:
-            osm_nodes = super(MyOsmApi, self).NodesGet(node_ids)
-            for node_id, node_data in osm_nodes.iteritems():
-                node = OsmNode(node_data)
-                self.nodes_cache[node_id] = node
+            node = self.nodes_cache.get(node_id)
+            if node is not None:
+                self._cache_event('nodes', 'memory')
                 nodes.append(node)
+                continue
+            node = self._disk_get('node', node_id)
+            if node is None:
+                self._cache_event('nodes', 'miss')
+                missing.append(node_id)
+            else:
+                self._cache_event('nodes', 'disk')
+                nodes.append(self.nodes_cache.add(node))
+
+        if len(missing) > 0:
+            osm_nodes = self.source.NodesGet(missing)
+            for node_id, node_data in osm_nodes.iteritems():
+                self._disk_put('node', node_id, node_data)
+                nodes.append(self.nodes_cache.add(node_data))
 
         return nodes
 
     def WaysGet(self, way_ids):
-        way_ids = copy(way_ids)
         ways = []
+        missing = []
         for way_id in way_ids:
-            if self.ways_cache.has_key(way_id):
-                ways.append(self.ways_cache[way_id])
-                way_ids.remove(way_id)
-
-        if len(way_ids) > 0:
-            osm_ways = super(MyOsmApi, self).WaysGet(way_ids)
-            for way_id, way_data in osm_ways.iteritems():
-                way = OsmWay(way_data)
+            way = self.ways_cache.get(way_id)
+            if way is not None:
+                self._cache_event('ways', 'memory')
+                ways.append(way)
+                continue
+            way = self._disk_get('way', way_id)
+            if way is None:
+                self._cache_event('ways', 'miss')
+                missing.append(way_id)
+            else:
+                self._cache_event('ways', 'disk')
+                way = OsmWay(way)
                 self.ways_cache[way_id] = way
                 ways.append(way)
 
-        return ways
-
-
-
-class MiniWay(QLineF):
-    DEST = 30
-    LEFT = 0
-    RIGHT = 1
-    def __init__(self, lat1, long1, lat2, long2):
-        super(MiniWay, self).__init__(QPointF(lat1, long1),
-                                        QPointF(lat2, long2))
-
-    def start_end(self):
-        line_start = QLineF(self)
-        line_end = QLineF(self.p2(), self.p1())
-
-        return line_start, line_end
- 
-    def line(self, angle1 = 45, angle2 = 10, side = 0):
-#Seguir probando esto, la idea es usar los angulos y la tangente
-#para calcular la longitud del cateto que coincide con el highway
-        line_start, line_end = self.start_end()
-        hypotenuse = self.DEST / math.sin(math.radians(angle1))
-        line_start.setLength(hypotenuse)
-        hypotenuse = self.DEST / math.sin(math.radians(angle2))
-        line_end.setLength(hypotenuse)
-        if side == 0:
-            line_start.setAngle(line_start.angle() + angle1)
-            line_end.setAngle(line_end.angle() - angle2)
-        else:
-            line_start.setAngle(line_start.angle() - angle1)
-            line_end.setAngle(line_end.angle() + angle2)
-
-        return QLineF(line_start.x2(), line_start.y2(), 
-                        line_end.x2(), line_end.y2())
-
-    def right(self, angle1, angle2):
-        return self.line(45, 45, self.LEFT)
+        if len(missing) > 0:
+            osm_ways = self.source.WaysGet(missing)
+            for way_id, way_data in osm_ways.iteritems():
+                ways.append(self._cache_way(way_data))
 
-    def left(self, angle1, angle2):
-        return self.line(45, 45, self.RIGHT)
+        return ways
 
+    def ChangesetDownload(self, changeset_id):
+        changes = self.source.ChangesetDownload(changeset_id)
+        self.invalidate_changes(changes)
+        return changes
+
+    def invalidate_changes(self, changes):
+        """Drop the cached data outdated by a list of osmChange dicts."""
+        if self.disk_cache is not None:
+            self.disk_cache.apply_changes(changes)
+
+        for change in changes:
+            data = change['data']
+            deleted = change['action'] == 'delete'
+            if change['type'] == 'node':
+                index = self.nodes_cache.peek(data['id'])
+                if index is not None:
+                    version = self.nodes_cache.versions[index]
+                    if deleted or version < data.get('version'):
+                        self.nodes_cache.discard(data['id'])
+                        #The node could have moved
+                        for way_id in self.adjacency.way_ids(data['id']):
+                            self.spatial.remove_way(way_id)
+            elif change['type'] == 'way':
+                nodes = data.get('nd', []) + \
+                        self.adjacency.remove_way(data['id'])
+                self.spatial.remove_way(data['id'])
+                self.adjacency.complete.difference_update(nodes)
+                way = self.ways_cache.peek(data['id'])
+                if way is not None:
+                    nodes = nodes + way.nodes
+                    if deleted or way.version < data.get('version'):
+                        del self.ways_cache[data['id']]
+                for node_id in nodes:
+                    self.nodes_ways_cache.pop(node_id, None)
+
+        self._invalidate_bboxes(changes)
+
+    def _invalidate_bboxes(self, changes):
+        """Drop the loaded bboxes holding a changed element, a changed node
+        or a node of a changed way."""
+        changed = set()
+        nodes = set()
+        points = []
+        for change in changes:
+            data = change['data']
+            changed.add((change['type'], data['id']))
+            if change['type'] == 'node' and 'lat' in data:
+                points.append((data['lon'], data['lat']))
+            elif change['type'] == 'way':
+                nodes.update(data.get('nd', []))
+        if not changed:
+            return
+
+        def outdated(bbox, refs):
+            min_lon, min_lat, max_lon, max_lat = bbox
+            for lon, lat in points:
+                if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+                    return True
+            for ref in refs:
+                if ref in changed or (ref[0] == 'node' and ref[1] in nodes):
+                    return True
+            return False
 
-osm_api = MyOsmApi()
+        for bbox in list(self.bbox_cache):
+            refs = self.bbox_cache.peek(bbox)
+            if refs is not None and outdated(bbox, refs):
+                self.bbox_cache.pop(bbox)
+        if self.disk_cache is not None:
+            for key in self.disk_cache.ids('bbox'):
+                refs = self.disk_cache.peek('bbox', key)
+                bbox = tuple(float(x) for x in key.split(','))
+                if outdated(bbox, refs):
+                    self.disk_cache.invalidate('bbox', key)
+
+
+#MyOsmApi instance used by the engine, see make_api()
+osm_api = None
+CACHE_FILE = os.path.expanduser('~/.karl-cache.db')
+#Distance in meters between the street and the address lines
 DEST = 30
-
-def get_nodes(node1, node2, line):
-    max_angle = 0
-    min_angle = 360
-    left1 = None
-    right1 = None
-    for adj_node in node1.adjacent_nodes:
-        if node2.id == adj_node:
-            continue
-        adj_node_obj = osm_api.NodeGet(adj_node)
-        line_node = QLineF(node1.q_point(), adj_node_obj.q_point())
-        angle = line.angleTo(line_node)
-        if angle < min_angle:
-            min_angle = angle
-            right1 = adj_node
-        if angle > max_angle:
-            max_angle = angle
-            left1 = adj_node
-
-    print node1.id, left1, right1
-
-    angle_left = (max_angle / 2) - 10
-    angle_right = (min_angle / 2) + 10
-
-    hypo_len_left = DEST / math.sin(math.radians(angle_left))
-    hypo_len_right = DEST / math.sin(math.radians(angle_right))
-
-    line_left = QLineF(line)
-    line_left.setLength(hypo_len_left)
-    line_right = QLineF(line)
-    line_right.setLength(hypo_len_right)
-
-    line_left.setAngle(line_left.angle() + angle_left)
-    line_right.setAngle(line_right.angle() + angle_right)
-    
-    return (line_left.x2, line_left.y2), (line_right.x2, line_right.y2)
-
-
-def draw_lines(node1, node2):
-    node1 = osm_api.NodeGet(node1)
-    node2 = osm_api.NodeGet(node2)
-    print 'NODES:', node1.id, node2.id
-
-    line1 = QLineF(node1.q_point(), node2.q_point())
-    line2 = QLineF(node2.q_point(), node1.q_point())
-
-    node1_nodes = get_nodes(node1, node2, line1)
-    node2_nodes = get_nodes(node2, node1, line2)
-    print 'NODE1 - nodes:', node1_nodes
-    print 'NODE2 - nodes:', node2_nodes
-    #raise NameError("Continuar aca")
-#XXX: ya tengo los nodos para dibujar las rectas, auqnue hay que probarlo.
-#los nodos del karl. Tomar en cuenta como las intersecciones en T o
-#los nodos que solo son para hacer una curva en el camino
-
-def do_karl(first_node, last_node):
-    first_node = int(first_node)
-    last_node = int(last_node)
+#The nearest adjacent street is considered at least this angle away
+MIN_ANGLE = 10
+#Degrees around the street nodes downloaded to find their adjacent nodes
+BBOX_MARGIN = 0.0005
+
+def make_api(offline = None, cache_file = None, instrument = None):
+    """MyOsmApi reading from the OsmOffline store offline or the OSM API."""
+    source = None
+    if offline:
+        source = OsmOffline(offline, instrument = instrument)
+    return MyOsmApi(cache_file = cache_file, source = source,
+                    instrument = instrument)
+
+def address_nodes(nodes):
+    """Return the (lon, lat) lists of the left and right address nodes of
+    the street going through nodes. They are DEST meters away from the
+    street, on the bisector of the angle between the street and the
+    nearest adjacent street of each side."""
+    #Every node looks towards the next one, the last one to the previous
+    towards = nodes[1:] + nodes[-2:-1]
+    adj_index = []
+    adj_lon = []
+    adj_lat = []
+    for index, node in enumerate(nodes):
+        for adj_node in node.adjacent_nodes:
+            if adj_node == towards[index].id:
+                continue
+            adj_node_obj = osm_api.NodeGet(adj_node)
+            adj_index.append(index)
+            adj_lon.append(adj_node_obj.lon)
+            adj_lat.append(adj_node_obj.lat)
+
+    left_lon, left_lat, right_lon, right_lat = KarlGeometry.address_points(
+                    [ node.lon for node in nodes ],
+                    [ node.lat for node in nodes ],
+                    [ node.lon for node in towards ],
+                    [ node.lat for node in towards ],
+                    adj_index, adj_lon, adj_lat, DEST, MIN_ANGLE)
+
+    left = zip(left_lon.tolist(), left_lat.tolist())
+    right = zip(right_lon.tolist(), right_lat.tolist())
+    #Seen from the last node the sides are swapped
+    left[-1], right[-1] = right[-1], left[-1]
+    return left, right
+
+
+def street_nodes(first_node, last_node):
+    """Return the way joining first_node and last_node and its node ids
+    from first_node to last_node."""
     ways_first = osm_api.NodeWays(first_node)
     ways_last = osm_api.NodeWays(last_node)
 
-    print ways_first
-    print ways_last
-
     way = False
     for way_i in ways_first:
         if way_i in ways_last:
@@ -273,110 +861,203 @@ def do_karl(first_node, last_node):
     else:
         node_ids = node_ids[first_index:last_index + 1]
 
+    return way, node_ids
+
+def karl_lines(first_node, last_node):
+    """Return the street way and its left and right address lines, lists
+    of (lon, lat), between first_node and last_node."""
+    way, node_ids = street_nodes(first_node, last_node)
+
     #We need all the adjacents node to calculate the nodes of the ways
-    #of the KarlShrue schema
+    #of the KarlShrue schema. Download the area once instead of asking
+    #the ways of every node.
     nodes = osm_api.NodesGet(node_ids)
+    osm_api.load_bbox(min([ node.lon for node in nodes ]) - BBOX_MARGIN,
+                    min([ node.lat for node in nodes ]) - BBOX_MARGIN,
+                    max([ node.lon for node in nodes ]) + BBOX_MARGIN,
+                    max([ node.lat for node in nodes ]) + BBOX_MARGIN)
+    nodes = [ osm_api.NodeGet(node_id) for node_id in node_ids ]
     for node in nodes:
         node.get_adjacent_nodes()
 
-    print node_ids
-    for index in range(len(node_ids)-1):
-        draw_lines(node_ids[index], node_ids[index+1])
-
-    return True
+#XXX: Tomar en cuenta como las intersecciones en T o los nodos que solo
+#son para hacer una curva en el camino
+    left, right = address_nodes(nodes)
 
-class Karl(QDialog):
-    def __init__(self, args):
-        super(Karl, self).__init__()
- 
-        self.setGeometry(200, 200, 400, 200)
-        self.setWindowTitle('Address numbers helper')
-
-        main_layout = QGridLayout(self)
-
-        main_layout.addWidget(QLabel('First node: '), 0, 0)
-        self.first = QLineEdit()
-        main_layout.addWidget(self.first, 0, 1)
-        if len(args) >= 2:
-            self.first.setText(args[1])
-
-        main_layout.addWidget(QLabel('Last node: '), 1, 0)
-        self.last = QLineEdit()
-        main_layout.addWidget(self.last, 1, 1)
-        if len(args) >= 3:
-            self.last.setText(args[2])
-
-        button_ok = QPushButton('OK')
-        button_cancel = QPushButton('Cancel')
-        main_layout.addWidget(button_ok, 2, 0)
-        main_layout.addWidget(button_cancel, 2, 1)
-
-        self.connect(button_ok, SIGNAL("clicked()"),
-                        self, SLOT('accept()'))
-        self.connect(button_cancel, SIGNAL("clicked()"),
-                        self, SLOT('reject()'))
-
-    def accept(self):
-        print 'ACCEPTED', self.first.text(), self.last.text()
-        do_karl(self.first.text(), self.last.text())
-
-    def in_range(self, node):
-        for way in Ways.node_ways[node]:
-            try:
-                way_name = Ways.ways_d[way]['tag']['name']
-            except KeyError:
-                print 'ERROR: name tag missing'
-                return False
+    return way, left, right
 
-            if self.in_range_f < 0 and way_name == self.start_name:
-                self.in_range_f = 0
-            elif self.in_range_f <= int(self.n_blocks):
-                self.in_range_f = -1
-            elif self.in_range_f >= 0:
-                self.in_range_f += 1 
-
-        return self.in_range_f
-
-    def interpolate(self, way_id):
-        way = Ways.ways_d[way_id]
-        nodes = way['nd']
-        self.in_range_f = -1
-        for i in range(0, len(nodes) - 1):
-            if not self.in_range(nodes[i]):
-                continue
-
-            print 'UUU'
-
-
-    def reject(self):
-        print 'REJECTED'
-        sys.exit(0)
- 
-    def paintEvent(self, e):
-        qp = QPainter()
- 
-        qp.begin(self)        
-        self.doDrawing(qp)        
-        qp.end()
-        
-    def doDrawing(self, qp):
-        miniway1 = MiniWay(600, 100, 400, 100)        
+def do_karl(first_node, last_node):
+    way, left, right = karl_lines(int(first_node), int(last_node))
+    print 'WAY:', way.id, way.get_tag('name')
+    print 'LEFT:', left
+    print 'RIGHT:', right
 
-        pen = QPen(Qt.black, 2, Qt.SolidLine)
-        qp.setPen(pen)
+    return True
 
-        qp.drawLine(miniway1)
 
-        pen.setColor(Qt.blue)
-        qp.setPen(pen)
-        qp.drawLine(miniway1.right(45, 45))
-        pen.setColor(Qt.yellow)
-        qp.setPen(pen)
-        qp.drawLine(miniway1.left(45, 45))
+#######################################################################
+# Headless batch mode                                                 #
+#######################################################################
 
- 
-app = QApplication(sys.argv)
-k = Karl(sys.argv)
-k.show()
-app.exec_()
+def bbox_segments(bbox):
+    """Return the (first_node, last_node) segments between intersections
+    of the named highways inside bbox."""
+    osm_api.load_bbox(*bbox)
+    segments = []
+    for way_id, nodes in osm_api.adjacency.ways.items():
+        way = osm_api.WayGet(way_id)
+        if not way.get_tag('highway') or not way.get_tag('name'):
+            continue
+        start = 0
+        for pos in range(1, len(nodes)):
+            if pos == len(nodes) - 1 or \
+                    len(osm_api.adjacency.way_ids(nodes[pos])) > 1:
+                if nodes[start] != nodes[pos]:
+                    segments.append((nodes[start], nodes[pos]))
+                start = pos
+    return segments
+
+def read_segments(filename):
+    """Read "first_node last_node" lines, # starts a comment."""
+    segments = []
+    for line in open(filename):
+        line = line.split('#')[0].split()
+        if line:
+            segments.append((int(line[0]), int(line[1])))
+    return segments
+
+def _init_worker(offline):
+    global osm_api
+    osm_api = make_api(offline)
+
+def _segment_lines(segment):
+    try:
+        way, left, right = karl_lines(*segment)
+    except Exception, e:
+        return segment, None, None, None, str(e)
+    return segment, way.get_tag('name'), left, right, None
+
+def write_osc(lines, output):
+    """Write the (street name, left, right) address lines as new
+    interpolation ways in an osmChange file."""
+    changes = []
+    node_id = 0
+    way_id = 0
+    for name, left, right in lines:
+        for points in (left, right):
+            nds = []
+            for lon, lat in points:
+                node_id -= 1
+                changes.append({ 'action': 'create', 'type': 'node',
+                    'data': { 'id': node_id, 'lat': lat, 'lon': lon,
+                            'tag': {} } })
+                nds.append(node_id)
+            tags = { u'addr:interpolation': u'all' }
+            if name:
+                tags[u'addr:street'] = name
+            way_id -= 1
+            changes.append({ 'action': 'create', 'type': 'way',
+                'data': { 'id': way_id, 'nd': nds, 'tag': tags } })
+
+    out = open(output, 'w')
+    osm_api._OscWrite(out.write, changes)
+    out.close()
+
+def batch(segments, output, processes = None, offline = None):
+    """Compute the address lines of all the segments with a pool of
+    processes (in this one with osm_api if processes is 0) and write them
+    to the osmChange file output."""
+    if processes == 0:
+        pool = None
+        results = itertools.imap(_segment_lines, segments)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (offline,))
+        results = pool.imap(_segment_lines, segments, 8)
+    lines = []
+    for segment, name, left, right, error in results:
+        if error:
+            print >>sys.stderr, 'ERROR: segment %d-%d: %s' % \
+                (segment[0], segment[1], error)
+            continue
+        lines.append((name, left, right))
+    if pool:
+        pool.close()
+        pool.join()
+
+    write_osc(lines, output)
+    return len(lines)
+
+def run_profiled(instrument, func, *args):
+    """Call func, printing to stderr where its time went if instrument."""
+    if instrument is None:
+        return func(*args)
+    with instrument.profile() as profile:
+        result = func(*args)
+    print >>sys.stderr, profile.report()
+    return result
+
+def parse_opts():
+    usage = "usage: %prog [first_node last_node]"
+    parser = OptionParser(usage)
+
+    parser.add_option("--segments", dest = "segments",
+                        help = "Batch mode: file of first_node last_node lines.")
+
+    parser.add_option("--bbox", dest = "bbox",
+                        help = "Batch mode: min_lon,min_lat,max_lon,max_lat " \
+                            "to process every named street inside.")
+
+    parser.add_option("--output", dest = "output", default = "karl.osc",
+                        help = "Batch mode: osmChange file to write.")
+
+    parser.add_option("--processes", dest = "processes", type = "int",
+                        help = "Batch mode: number of worker processes, 0 " \
+                            "to compute the streets in the main one.")
+
+    parser.add_option("--profile", dest = "profile", action = "store_true",
+                        default = False,
+                        help = "Print the time spent in requests and parsing " \
+                            "and the cache hits. With first_node last_node " \
+                            "runs them without the dialog. Worker processes " \
+                            "aren't profiled, see --processes.")
+
+    parser.add_option("--offline", dest = "offline",
+                        help = "OsmOffline store to read instead of the API.")
+
+    return parser.parse_args()
+
+def main():
+    global osm_api
+    options, args = parse_opts()
+    instrument = None
+    if options.profile:
+        instrument = Recorder()
+
+    if options.segments or options.bbox:
+        #The disk cache can't be shared with the worker processes
+        osm_api = make_api(options.offline, instrument = instrument)
+        if options.segments:
+            segments = read_segments(options.segments)
+        else:
+            segments = run_profiled(instrument, bbox_segments,
+                            [ float(x) for x in options.bbox.split(',') ])
+        count = run_profiled(instrument, batch, segments, options.output,
+                            options.processes, options.offline)
+        print '%d of %d streets written to %s' % \
+            (count, len(segments), options.output)
+        return
+
+    osm_api = make_api(options.offline, CACHE_FILE, instrument)
+    if options.profile and len(args) == 2:
+        run_profiled(instrument, do_karl, args[0], args[1])
+        return
+    #The dialog is the only part needing PyQt4
+    from KarlGui import QApplication, Karl
+    app = QApplication(sys.argv)
+    k = Karl([ sys.argv[0] ] + args, do_karl)
+    k.show()
+    app.exec_()
+
+if __name__ == '__main__':
+    main()
 